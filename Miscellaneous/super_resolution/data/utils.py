@@ -44,16 +44,11 @@ def create_tiles(arr, x_size, y_size, stride=None, fill=False):
 def to_cloud_flag(num, flag_idx=LANDSAT_CLOUD_FLAG_BIT):
     
     """
-    Convert a number to a cloud mask.
+    Convert a QA_PIXEL array to a cloud mask, bit flag_idx counted from the least significant bit.
     """
-    if np.isnan(num):
-        return np.nan
-    else:
-        bit_string = f'{int(num):b}'
-        if bit_string[flag_idx]==1:
-            return CLOUD_FLAG
-        else:  
-            return NON_CLOUD_FLAG
+    num = np.asarray(num, dtype=np.float64)
+    flags = np.where((np.nan_to_num(num).astype(np.uint16) >> flag_idx) & 1 == 1, CLOUD_FLAG, NON_CLOUD_FLAG)
+    return np.where(np.isnan(num), np.nan, flags)
     
 def cloud_percentage(mask):
     return np.sum(mask)/mask.size
@@ -69,7 +64,7 @@ def generate_tiles(arr, x_size, y_size, stride=256, fill=False, filter_clouds=Fa
     if not filter_clouds: 
         return tiles
     
-    cloud_mask = np.vectorize(to_cloud_flag)
+    cloud_mask = to_cloud_flag
     tile_shape = tiles[0].shape
     for tile in tqdm(tiles):
         tile_cloud_mask = cloud_mask(tile[LANDSAT_CLOUD_MASK_BAND_IDX])
@@ -1,17 +1,21 @@
-import ee
-import pandas as pd
-import numpy as np
 from datetime import datetime
-import glob
-import multiprocessing
+import os
+import sys
 import argparse
 import subprocess
-import requests
 import logging
-from retry import retry
+from transfer_engine import TransferEngine
+from request_controller import RequestController, RetryPolicy
+from url_pipeline import URLProvider, DownloadPipeline
+from transfer_telemetry import TransferTelemetry
+from tif_check import check_tif, is_complete_tif
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data-process'))
+from pipeline_ledger import PipelineLedger
+from goes_calibration import GOES_FILL_VALUE, scale_offset_path, save_scale_offset
 
-# Initialize Google Earth Engine project
-ee.Initialize(project='ee-jonstar', opt_url='https://earthengine-highvolume.googleapis.com')
+# Google Earth Engine API, imported and initialized by initialize_ee so that importing
+# this module makes no network calls
+ee = None
 
 
 """
@@ -69,6 +73,28 @@ export_coords = {
     'Caracas':[19, True, 687497, 1176029]
 }
 
+# Cities imaged by GOES-West (GOES-17, then GOES-18 from 2023-01-04), every other city is imaged by GOES-East (GOES-16)
+GOES_WEST_CITIES = ['Seattle', 'San_Francisco', 'Los_Angeles', 'San_Diego', 'Phoenix', 'Las_Vegas', 'Salt_Lake_City']
+
+GOES_BANDS = ['CMI_C13', 'CMI_C14', 'CMI_C15', 'CMI_C16']
+
+
+def initialize_ee():
+    """
+    Imports and initializes the Google Earth Engine project, once per process. The scripts
+    call this before their first Earth Engine request, and so should any worker process
+    that makes Earth Engine requests, e.g. from its pool initializer.
+
+    Returns:
+    (module): The initialized ee module
+    """
+    global ee
+    if ee is None:
+        import ee as earthengine
+        earthengine.Initialize(project='ee-jonstar', opt_url='https://earthengine-highvolume.googleapis.com')
+        ee = earthengine
+    return ee
+
 
 def scale_and_offset_GOES(image):
     """
@@ -120,17 +146,37 @@ def process_GOES(image):
     return GOES_image
 
 
-@retry(tries=10, delay=1, backoff=2)
-def getResultGOES_new(city, city_export, dt, filename, verbose=False):
+def GOES_collection(city, dt):
     """
-    Handle the HTTP requests to download an image.
-
     Args:
         city (str): City name from valid list of cities.
-        city_export (list): [UTM zone, Boolean T/F for Northern Hemisphere/Southern Hemisphere, UTM x for export, UTM y for export]
         dt (str): Date in format of 'YYYYmmddHHMM'.
-        filename (str): Name of the file to save the export data in. '.tif' Should be included at the end of the file name.
-        verbose (boolean): Whether or not to print out the filename when export is done.
+
+    Returns:
+        (str): ID of the Earth Engine GOES ImageCollection that images the city at the time
+    """
+    # GOES-West
+    if city in GOES_WEST_CITIES:
+        if int(dt) < 202301040000:
+            return "NOAA/GOES/17/MCMIPF"
+        return "NOAA/GOES/18/MCMIPF"
+    # GOES-East
+    return "NOAA/GOES/16/MCMIPF"
+
+
+def get_GOES_image(collection, dt, native=False):
+    """
+    Finds the GOES image of a timestamp and scales it to brightness temperatures.
+    The image covers the whole disk, so it can be shared by every city the satellite images.
+
+    Args:
+        collection (str): ID of the GOES ImageCollection, see GOES_collection
+        dt (str): Date in format of 'YYYYmmddHHMM'.
+        native (boolean): Keep the bands as their packed 12-bit integers instead of scaling them,
+                          with masked pixels set to GOES_FILL_VALUE
+
+    Returns:
+        (ee.Image): Processed GOES image
     """
     # Sets up dates to be able to filter the GOES ImageCollection
     date_format = "%Y%m%d%H%M"
@@ -138,20 +184,74 @@ def getResultGOES_new(city, city_export, dt, filename, verbose=False):
     date2 = datetime.strptime(str(int(dt)+1), date_format)
 
     # Initialize GOES ImageCollection, process the images, and load in the corresponding timestamps
-    # GOES-West
-    if city in ['Seattle', 'San_Francisco', 'Los_Angeles', 'San_Diego', 'Phoenix', 'Las_Vegas', 'Salt_Lake_City']:
-        if int(dt) < 202301040000:
-            GOES = ee.ImageCollection("NOAA/GOES/17/MCMIPF").filterDate(date1, date2)
-        else:
-            GOES = ee.ImageCollection("NOAA/GOES/18/MCMIPF").filterDate(date1, date2)
-    # GOES-East
-    else:
-        GOES = ee.ImageCollection("NOAA/GOES/16/MCMIPF").filterDate(date1, date2)
+    GOES = ee.ImageCollection(collection).filterDate(date1, date2)
+    if native:
+        return GOES.first().select(GOES_BANDS).unmask(GOES_FILL_VALUE).toInt16()
     processed = GOES.map(process_GOES)
 
     # Get the image from the filtered result
     # (should only be one in the result)
-    image = processed.first()
+    return processed.first()
+
+
+def get_GOES_scale_offset(collection, dt):
+    """
+    Fetches the scale and offset of the bands of the GOES image of a timestamp.
+
+    Args:
+        collection (str): ID of the GOES ImageCollection, see GOES_collection
+        dt (str): Date in format of 'YYYYmmddHHMM'.
+
+    Returns:
+        scales (list): Scale of each band
+        offsets (list): Offset of each band
+    """
+    date_format = "%Y%m%d%H%M"
+    image = ee.ImageCollection(collection).filterDate(datetime.strptime(dt, date_format), datetime.strptime(str(int(dt)+1), date_format)).first()
+    properties = image.toDictionary([f'{band}_scale' for band in GOES_BANDS] + [f'{band}_offset' for band in GOES_BANDS]).getInfo()
+    return [properties[f'{band}_scale'] for band in GOES_BANDS], [properties[f'{band}_offset'] for band in GOES_BANDS]
+
+
+def save_GOES_scale_offsets(collection, time_strs, tif_dirs, call=lambda func, *args: func(*args)):
+    """
+    Writes the scale/offset sidecar of each day of native integer downloads, read from the day's
+    first image. The scale and offset of a band are fixed by the product version, so one image a day
+    is enough and days that already have a sidecar are skipped.
+
+    Args:
+        collection (str): ID of the GOES ImageCollection, see GOES_collection
+        time_strs (list): Dates in format of 'YYYYmmddHHMM' of the downloads
+        tif_dirs (list): Directories of the cities the downloads are saved to
+        call (function): Makes the request, e.g. through the retry policy and request controller
+    """
+    first_times = {}
+    for time_str in sorted(time_strs):
+        first_times.setdefault(time_str[:8], time_str)
+    for date_str, time_str in first_times.items():
+        paths = [scale_offset_path(tif_dir, date_str) for tif_dir in tif_dirs]
+        paths = [path for path in paths if not os.path.exists(path)]
+        if paths:
+            scales, offsets = call(get_GOES_scale_offset, collection, time_str)
+            for path in paths:
+                save_scale_offset(path, scales, offsets, source=f'{collection} {time_str}')
+
+
+def get_GOES_download_url(city, city_export, dt, image=None, native=False):
+    """
+    Fetches the URL from which to download a city's window of the GOES image of a timestamp.
+
+    Args:
+        city (str): City name from valid list of cities.
+        city_export (list): [UTM zone, Boolean T/F for Northern Hemisphere/Southern Hemisphere, UTM x for export, UTM y for export]
+        dt (str): Date in format of 'YYYYmmddHHMM'.
+        image (ee.Image, optional): Processed GOES image of the timestamp, shared between cities. Found if not given
+        native (boolean): Export the packed integer bands instead of brightness temperatures, see get_GOES_image
+
+    Returns:
+        (str): URL of the GeoTIFF export
+    """
+    if image is None:
+        image = get_GOES_image(GOES_collection(city, dt), dt, native)
 
     if city_export[1]:
         crs_prefix = '326' # Northern hemisphere
@@ -166,74 +266,179 @@ def getResultGOES_new(city, city_export, dt, filename, verbose=False):
 
     # Fetch the URL from which to download the image.
     url = image.getDownloadURL({
-        'bands':['CMI_C13', 'CMI_C14', 'CMI_C15', 'CMI_C16'],
+        'bands':GOES_BANDS,
         'crs':crs,
         'region':region, 'scale':2000,
         'format': 'GEO_TIFF', 'filePerBand':False})
+    return url
 
-    # Handle downloading the actual pixels.
-    r = requests.get(url, stream=True)
-    if r.status_code != 200:
-        #print('Unsuccessful request')
-        raise r.raise_for_status()
-    #print('request successful')
 
-    with open(filename, 'wb') as out_file:
-        out_file.write(r.content)
-    if verbose:
-        print("Done: ", filename)
+class EarthEngineURLProvider(URLProvider):
+    """
+    Mints GOES download URLs with Earth Engine, see get_GOES_download_url.
+    """
+    # Earth Engine download URLs are short-lived, so they are not reused for long
+    ttl = 1800
+
+    def __init__(self, native=False):
+        """
+        Args:
+        native (boolean): Mint URLs of the packed integer bands instead of brightness temperatures
+        """
+        self.native = native
+
+    def mint(self, city, city_export, dt):
+        return get_GOES_download_url(city, city_export, dt, native=self.native)
+
+    def mint_batch(self, batch):
+        """
+        Mints the URLs of a batch of (city, city_export, dt), building the processed image of
+        each satellite and timestamp once and cutting every city's window out of it.
+
+        Args:
+        batch (list): (city, city_export, dt) of each image
+
+        Returns:
+        (list): Download URL of each image
+        """
+        images = {}
+        urls = []
+        for city, city_export, dt in batch:
+            key = (GOES_collection(city, dt), dt)
+            if key not in images:
+                images[key] = get_GOES_image(*key, native=self.native)
+            urls.append(get_GOES_download_url(city, city_export, dt, images[key], self.native))
+        return urls
 
 
 if __name__ == '__main__':
+    import pandas as pd
+
     logging.basicConfig()
 
     parser = argparse.ArgumentParser(
                     prog='GOES_download',
                     description='Fast downloading for GOES images from GEE')
     parser.add_argument('--city', help='String of city from list of valid cities to make data for')
+    parser.add_argument('--cities', nargs='?', default=None,
+                        help='Comma-separated cities imaged by the same satellite to download together instead of --city, e.g. DMV,NYC,Miami')
     parser.add_argument('--n', nargs='?', const=105120, help='Number of files to create')
     parser.add_argument('--startFile', nargs='?', const=0, help='File index to start from')
-    parser.add_argument('--cpus', nargs='?', const=100, help='Number of CPU cores to run in parallel')
+    parser.add_argument('--cpus', nargs='?', const=100, help='Number of downloads to run at once (threads of one process)')
+    parser.add_argument('--mint_concurrency', nargs='?', type=int, default=16, help='Number of threads fetching download URLs from Earth Engine')
+    parser.add_argument('--mint_batch_size', nargs='?', type=int, default=None,
+                        help='Number of download URLs each minting thread fetches at a time (a multiple of the number of cities near 8 by default)')
+    parser.add_argument('--url_queue_size', nargs='?', type=int, default=512, help='Largest number of fetched URLs waiting to be downloaded')
+    parser.add_argument('--request_rate', nargs='?', type=float, default=20, help='Largest number of Earth Engine requests started per second')
+    parser.add_argument('--max_in_flight', nargs='?', type=int, default=None,
+                        help='Largest number of Earth Engine requests in flight at once (--cpus by default); the controller adjusts the limit below this')
+    parser.add_argument('--telemetry', nargs='?', default=None,
+                        help='File to write download telemetry to: JSON lines, or a Prometheus text file if it ends in .prom')
+    parser.add_argument('--telemetry_every', nargs='?', type=float, default=30, help='Seconds between telemetry snapshots')
+    parser.add_argument('--native', action='store_true',
+                        help='Download the packed int16 bands and a daily scale/offset sidecar instead of float brightness temperatures, '
+                             'calibrated by process_GOES.py')
+    parser.add_argument('--report_every', nargs='?', type=int, default=1000, help='Number of downloads between reports of the request rate')
+    parser.add_argument('--ledger', nargs='?', default='/scratch/zt1/project/mjmolina-prj/user/jonstar/pipeline_ledger.db',
+                        help='SQLite ledger of the state of every frame')
+    parser.add_argument('--ledger_bootstrap', action='store_true',
+                        help='Record the complete files already on disk in the ledger (done automatically the first time a city is downloaded)')
     args = parser.parse_args()
+    initialize_ee()
 
-    # Pull points to make data for a specific city (look above for options)
-    city = args.city
-    city_export = export_coords[city]
+    # Pull points to make data for the cities (look above for options). Cities imaged by the same
+    # satellite can be downloaded together, sharing the lookup and scaling of each timestamp's image
+    cities = args.cities.split(',') if args.cities else [args.city]
+    if len({city in GOES_WEST_CITIES for city in cities}) > 1:
+        raise Exception("Please set --cities to cities imaged by the same satellite, either all GOES-West or all GOES-East.")
+    city_exports = {city: export_coords[city] for city in cities}
 
     num = int(args.n)
     start = int(args.startFile)
     if num > 105120: # Largest number of files possible
         num = processed.size().getInfo()
 
-    # Ensure there is a GOES directory made for the city and set it as the prefix to the filename
-    subprocess.call(['mkdir', '-p', f'/home/jonstar/scratch/{city}_GOES'])
-    file_prefix = f'/home/jonstar/scratch/{city}_GOES'
+    # Ensure there is a GOES directory made for each city and set it as the prefix to the filename
+    file_prefixes = {}
+    for city in cities:
+        subprocess.call(['mkdir', '-p', f'/home/jonstar/scratch/{city}_GOES'])
+        file_prefixes[city] = f'/home/jonstar/scratch/{city}_GOES'
 
     # GOES-West
-    if city in ['Seattle', 'San_Francisco', 'Los_Angeles', 'San_Diego', 'Phoenix', 'Las_Vegas', 'Salt_Lake_City']:
+    if cities[0] in GOES_WEST_CITIES:
         g_times = pd.read_csv('/home/jonstar/urban_heat_dataset/GOES_West_times.csv')
     # GOES-East
     else:
         g_times = pd.read_csv('/home/jonstar/urban_heat_dataset/GOES_East_times.csv')
 
-    # Finds indices of files that are not currently created
-    time_strs = g_times.datetime[start:start+num]
-    full_file_list = [f'{file_prefix}/GOES_image_{time_str}.tif' for time_str in time_strs] 
-    current_file_list = sorted(glob.glob(f'{file_prefix}/*'))
-    missing_indices = np.where([x not in current_file_list for x in full_file_list])[0]
-    print('Length of missing indices:', len(missing_indices))
-
-    # Sets up inputs for multiprocessing pool
-    inputs = [[str(city), city_export, str(time_str), f'{file_prefix}/GOES_image_{time_str}.tif'] for time_str in time_strs[missing_indices]]
-
-    # Run multiprocessing pool
-    print('Starting multiprocessing')
+    # Remove the partial downloads of a stopped job, they are redone below
+    for file_prefix in file_prefixes.values():
+        with os.scandir(file_prefix) as entries:
+            for entry in entries:
+                if entry.name.endswith('.tif.part'):
+                    os.remove(entry.path)
+
+    # Finds indices of files that are not currently created, from the ledger. Files downloaded
+    # before the ledger was used are recorded from one listing of the directory, leaving out
+    # files truncated by a stopped job so they are downloaded again
+    time_strs = g_times.datetime.values[start:start+num]
+    frame_times = g_times.value.values[start:start+num]//1000
+    ledger = PipelineLedger(args.ledger)
+    done_times = {}
+    for city in cities:
+        if args.ledger_bootstrap or not ledger.has_stage(city, 'download'):
+            ledger.bootstrap(city, 'download', {t: f'{file_prefixes[city]}/GOES_image_{time_str}.tif' for t, time_str in zip(frame_times, time_strs)},
+                             check=is_complete_tif)
+        done_times[city] = ledger.times(city, 'download')
+
+    # Sets up the download tasks, keyed by city and frame time: the arguments to fetch the URL and the file to save it to.
+    # The cities of a timestamp are next to each other, so a minting batch covers them with one image
+    tasks = [((city, int(frame_times[i])), (str(city), city_exports[city], str(time_strs[i])), f'{file_prefixes[city]}/GOES_image_{time_strs[i]}.tif')
+             for i in range(len(frame_times)) for city in cities if frame_times[i] not in done_times[city]]
+    print('Length of missing indices:', len(tasks))
+
+    # Fetch the URLs and download them in separate stages, recording each download in the ledger as it finishes.
+    # A failed transfer is retried with the same URL, only fetching a new one if the URL is rejected
+    print('Starting downloads')
     start = datetime.now()
-    nCPUs = int(args.cpus)
-    pool = multiprocessing.Pool(nCPUs)
-    pool.starmap(getResultGOES_new, inputs)
-    pool.close()
-    pool.join()
+    mint_batch_size = args.mint_batch_size if args.mint_batch_size else len(cities)*max(1, 8//len(cities))
+    # Concurrent downloads over one keep-alive HTTP session. Files only get their final name once they are complete GeoTIFFs
+    transfer_engine = TransferEngine(int(args.cpus), validate=check_tif)
+    # Throttle shared by every request to Earth Engine, URL minting and transfers alike
+    request_controller = RequestController(args.request_rate, max_in_flight=args.max_in_flight if args.max_in_flight else int(args.cpus))
+    telemetry = TransferTelemetry(args.telemetry, interval=args.telemetry_every)
+    telemetry.gauge('in_flight', lambda: request_controller.in_flight)
+    telemetry.gauge('concurrency_limit', lambda: request_controller.limit)
+    pipeline = DownloadPipeline(EarthEngineURLProvider(args.native), transfer_engine, args.mint_concurrency, mint_batch_size, args.url_queue_size,
+                                mint_retry=RetryPolicy(tries=10, delay=1, backoff=2, controller=request_controller),
+                                transfer_retry=RetryPolicy(tries=5, delay=1, backoff=2, controller=request_controller),
+                                controller=request_controller, telemetry=telemetry)
+    # Native integer downloads need the scale and offset of each day to be calibrated
+    if args.native:
+        collection_times = {}
+        for time_str in time_strs:
+            collection_times.setdefault(GOES_collection(cities[0], str(time_str)), []).append(str(time_str))
+        sidecar_retry = RetryPolicy(tries=10, delay=1, backoff=2, controller=request_controller)
+        for collection, collection_strs in collection_times.items():
+            save_GOES_scale_offsets(collection, collection_strs, list(file_prefixes.values()),
+                                    call=lambda func, *a: sidecar_retry.call(request_controller.call, (func, *a)))
+    telemetry.start()
+    try:
+        for n_done, ((city, frame_time), size, error, seconds) in enumerate(pipeline.run(tasks), 1):
+            if n_done % args.report_every == 0:
+                print(f'{n_done}/{len(tasks)} downloads: {request_controller.report()}')
+            if error is None:
+                ledger.record(city, 'download', frame_time, size=size, seconds=seconds)
+            else:
+                print(f'Failed {city} {frame_time}: {error}')
+                ledger.record(city, 'download', frame_time, state='failed', seconds=seconds, error=str(error))
+    finally:
+        # Keep the record of the finished downloads even if the job is stopped
+        ledger.close()
+        transfer_engine.close()
+        telemetry.close()
+    print(request_controller.report())
+    print(telemetry.summary())
 
     time_diff = datetime.now() - start
     print(f'Total time: {time_diff.total_seconds()} seconds')
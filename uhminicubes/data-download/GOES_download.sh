@@ -24,3 +24,5 @@ echo "First argument: $1"
 
 cd /home/jonstar/ML_UH_datasets/Jon_dataset_code
 /tmp/$USER/heat/bin/python GOES_download.py --city=$1 --n=105120 --startFile=0 --cpus=32
+# Cities on the same satellite can share one job instead, e.g. sbatch GOES_download.sh with
+# /tmp/$USER/heat/bin/python GOES_download.py --cities=DMV,NYC,Philadelphia --n=105120 --startFile=0 --cpus=32
@@ -0,0 +1,247 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from transfer_engine import TransferEngine
+from request_controller import RequestController, RetryPolicy
+from url_pipeline import DownloadPipeline
+from transfer_telemetry import TransferTelemetry
+from tif_check import check_tif
+from GOES_download import (initialize_ee, export_coords, GOES_WEST_CITIES, EarthEngineURLProvider, GOES_collection,
+                           save_GOES_scale_offsets)
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data-process'))
+from process_GOES import (init_GOES_worker, process_GOES_frame, build_GOES_frame, load_GOES_latlons,
+                          get_processed_dir, get_processed_fname, get_frame_time, city_ICAO_codes, MW_DIR)
+from goes_store import GOESStoreWriter
+from pipeline_ledger import PipelineLedger
+from goes_calibration import scale_offset_path, load_scale_offset
+from encoding_profiles import ENCODING_PROFILES
+
+
+"""
+Fused download and processing of GOES frames. Instead of writing each GeoTIFF to
+scratch with GOES_download.py and reading it back with process_GOES.py, the
+downloaded bytes are kept in memory and processed straight away with the same
+code as process_GOES.py, so the raw GeoTIFFs never have to touch the filesystem.
+
+The download threads are the producer and this process's main thread is the
+consumer. They are joined by a bounded queue, so at most --queue_size downloaded
+frames wait in memory and the downloads pause when processing falls behind.
+Frames are processed on one thread, which is enough since a frame takes a few
+milliseconds to process and write against the much slower downloads.
+
+Example:
+    python GOES_fused.py --city=DMV --n=105120 --startFile=0 --cpus=32 --output=files
+"""
+
+
+def write_tif(path, body):
+    """
+    Writes the bytes of a downloaded GeoTIFF to a file, under a temporary name first
+    so that a partial file is never left at path.
+
+    Args:
+    path (str): Full path of where to store the file
+    body (bytes): Contents of the file
+    """
+    tmp_path = f'{path}.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+
+
+def produce_frames(pipeline, tasks, frames, errors):
+    """
+    Producer of the fused pipeline. Downloads every frame into memory and puts it on the
+    queue, followed by None once all downloads are finished.
+
+    Args:
+    pipeline (DownloadPipeline): Pipeline that mints the URLs and downloads them
+    tasks (list): Download tasks of the pipeline, with None as the file name to keep the frames in memory
+    frames (queue.Queue): Bounded queue of (key, bytes, error, seconds) of the downloaded frames
+    errors (list): Errors that stopped the producer, passed back to the consumer
+    """
+    try:
+        for result in pipeline.run(tasks):
+            # Blocks while the queue is full, which stops new downloads from starting
+            frames.put(result)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        frames.put(None)
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+
+    parser = argparse.ArgumentParser(
+                    prog='GOES_fused',
+                    description='Downloads GOES images from GEE and processes them in memory, without writing the GeoTIFFs to disk')
+    parser.add_argument('--city', help='String of city from list of valid cities to make data for')
+    parser.add_argument('--n', nargs='?', const=105120, help='Number of files to create')
+    parser.add_argument('--startFile', nargs='?', const=0, help='File index to start from')
+    parser.add_argument('--cpus', nargs='?', const=32, help='Number of downloads to run at once (threads of one process)')
+    parser.add_argument('--mint_concurrency', nargs='?', type=int, default=16, help='Number of threads fetching download URLs from Earth Engine')
+    parser.add_argument('--mint_batch_size', nargs='?', type=int, default=8, help='Number of download URLs each minting thread fetches at a time')
+    parser.add_argument('--url_queue_size', nargs='?', type=int, default=512, help='Largest number of fetched URLs waiting to be downloaded')
+    parser.add_argument('--request_rate', nargs='?', type=float, default=20, help='Largest number of Earth Engine requests started per second')
+    parser.add_argument('--max_in_flight', nargs='?', type=int, default=None,
+                        help='Largest number of Earth Engine requests in flight at once (--cpus by default)')
+    parser.add_argument('--telemetry', nargs='?', default=None,
+                        help='File to write download telemetry to: JSON lines, or a Prometheus text file if it ends in .prom')
+    parser.add_argument('--telemetry_every', nargs='?', type=float, default=30, help='Seconds between telemetry snapshots')
+    parser.add_argument('--queue_size', nargs='?', type=int, default=64,
+                        help='Largest number of downloaded frames held in memory waiting to be processed')
+    parser.add_argument('--keep_tif', action='store_true',
+                        help='Also save the downloaded GeoTIFFs, as GOES_download.py does')
+    parser.add_argument('--native', action='store_true',
+                        help='Download the packed int16 bands and calibrate them locally with the daily scale/offset sidecars')
+    parser.add_argument('--output', nargs='?', default='files', choices=['files', 'store'],
+                        help='Write one netCDF file per frame (files) or append frames to consolidated time-chunked files (store)')
+    parser.add_argument('--store_period', nargs='?', default='city', choices=['city', 'month'],
+                        help='With --output=store, write one consolidated file per city or per city and month')
+    parser.add_argument('--writer', nargs='?', default='template', choices=['template', 'xarray'],
+                        help='With --output=files, write frames by filling in a per-city template file (template) or with xarray (xarray)')
+    parser.add_argument('--encoding', nargs='?', default='float64', choices=ENCODING_PROFILES,
+                        help='Encoding profile of the data variables, see encoding_profiles.py')
+    parser.add_argument('--complevel', nargs='?', type=int, default=None,
+                        help="gzip level 0-9 of the data variables (the encoding profile's default for per-frame files, 4 for --output=store)")
+    parser.add_argument('--ledger', nargs='?', default='/scratch/zt1/project/mjmolina-prj/user/jonstar/pipeline_ledger.db',
+                        help='SQLite ledger of the state of every frame')
+    parser.add_argument('--latlon_cache', nargs='?', default='/scratch/zt1/project/mjmolina-prj/user/jonstar/latlon_cache',
+                        help='Directory of cached latitude/longitude grids')
+    parser.add_argument('--mw_dir', nargs='?', default=MW_DIR,
+                        help='Directory of the daily microwave LST files')
+    parser.add_argument('--mw_cache_days', nargs='?', type=int, default=8,
+                        help='Number of daily microwave LST city windows kept in memory')
+    args = parser.parse_args()
+    initialize_ee()
+
+    city = args.city
+    city_export = export_coords[city]
+    num = int(args.n)
+    start = int(args.startFile)
+    file_prefix = f'/home/jonstar/scratch/{city}_GOES'
+    if args.keep_tif or args.native:
+        os.makedirs(file_prefix, exist_ok=True)
+
+    # GOES-West
+    if city in GOES_WEST_CITIES:
+        g_times = pd.read_csv('/home/jonstar/urban_heat_dataset/GOES_West_times.csv')
+    # GOES-East
+    else:
+        g_times = pd.read_csv('/home/jonstar/urban_heat_dataset/GOES_East_times.csv')
+    time_strs = g_times.datetime.values[start:start+num].astype(str)
+    frame_times = (g_times.value.values[start:start+num]//1000).astype(np.int64)
+
+    # Frames already processed are looked up in the ledger
+    ledger = PipelineLedger(args.ledger)
+    stage = 'store' if args.output == 'store' else 'process'
+    done_times = ledger.times(city, stage)
+    missing = [(int(t), time_str) for t, time_str in zip(frame_times, time_strs) if t not in done_times]
+    print('Length of missing indices:', len(missing))
+    for processed_dir in sorted({get_processed_dir(city, t) for t, _ in missing}):
+        os.makedirs(processed_dir, exist_ok=True)
+
+    # With --output=store there is one writer per processed directory
+    writers = {}
+    def get_writer(t):
+        """
+        Args:
+        t (int): Frame time in UTC seconds
+
+        Returns:
+        (GOESStoreWriter): Writer of the processed directory of the frame
+        """
+        processed_dir = get_processed_dir(city, t)
+        if processed_dir not in writers:
+            writers[processed_dir] = GOESStoreWriter(processed_dir, city_ICAO_codes[city], period=args.store_period,
+                                                     complevel=4 if args.complevel is None else args.complevel,
+                                                     encoding=args.encoding)
+        return writers[processed_dir]
+
+    # Download tasks keyed by frame time, with no file name so the frames are kept in memory
+    tasks = [((t, time_str), (city, city_export, time_str), None) for t, time_str in missing]
+    transfer_engine = TransferEngine(int(args.cpus), validate=check_tif)
+    request_controller = RequestController(args.request_rate, max_in_flight=args.max_in_flight if args.max_in_flight else int(args.cpus))
+    telemetry = TransferTelemetry(args.telemetry, interval=args.telemetry_every)
+    telemetry.gauge('in_flight', lambda: request_controller.in_flight)
+    telemetry.gauge('concurrency_limit', lambda: request_controller.limit)
+    pipeline = DownloadPipeline(EarthEngineURLProvider(args.native), transfer_engine, args.mint_concurrency, args.mint_batch_size, args.url_queue_size,
+                                mint_retry=RetryPolicy(tries=10, delay=1, backoff=2, controller=request_controller),
+                                transfer_retry=RetryPolicy(tries=5, delay=1, backoff=2, controller=request_controller),
+                                controller=request_controller, telemetry=telemetry)
+
+    # Native integer frames are calibrated with the scale and offset of their day, saved next to the GeoTIFFs
+    if args.native:
+        collection_times = {}
+        for _, time_str in missing:
+            collection_times.setdefault(GOES_collection(city, time_str), []).append(time_str)
+        sidecar_retry = RetryPolicy(tries=10, delay=1, backoff=2, controller=request_controller)
+        for collection, collection_strs in collection_times.items():
+            save_GOES_scale_offsets(collection, collection_strs, [file_prefix],
+                                    call=lambda func, *a: sidecar_retry.call(request_controller.call, (func, *a)))
+
+    print('Starting downloads')
+    start = datetime.now()
+    frames = queue.Queue(maxsize=args.queue_size)
+    telemetry.gauge('frame_queue_depth', frames.qsize)
+    telemetry.start()
+    producer_errors = []
+    producer = threading.Thread(target=produce_frames, args=(pipeline, tasks, frames, producer_errors), daemon=True)
+    producer.start()
+
+    # Process each frame as it arrives. The lat/lon grid and microwave LST store are set up from the first frame
+    latlon_pts_2km = None
+    finished = []
+    n_failed = 0
+    try:
+        for (t, time_str), body, error, download_seconds in iter(frames.get, None):
+            process_start = time.perf_counter()
+            if error is None:
+                try:
+                    scale_offset = load_scale_offset(scale_offset_path(file_prefix, time_str[:8])) if args.native else None
+                    if args.keep_tif:
+                        write_tif(f'{file_prefix}/GOES_image_{time_str}.tif', body)
+                        ledger.record(city, 'download', t, size=len(body), seconds=download_seconds)
+                    if latlon_pts_2km is None:
+                        latlon_pts_2km = load_GOES_latlons(city, body, args.latlon_cache)
+                        init_GOES_worker(city, latlon_pts_2km, args.mw_dir, args.mw_cache_days, args.writer, args.encoding, args.complevel)
+                    if args.output == 'store':
+                        # Frames are recorded in the ledger once the writers have committed them
+                        get_writer(t).append(build_GOES_frame(body, get_frame_time(t), scale_offset))
+                        finished.append((t, download_seconds + time.perf_counter() - process_start))
+                    else:
+                        size, write_seconds = process_GOES_frame(body, get_frame_time(t), get_processed_fname(city, t, time_str), scale_offset)
+                        ledger.record(city, stage, t, size=size, seconds=download_seconds + time.perf_counter() - process_start,
+                                      write_seconds=write_seconds)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                n_failed += 1
+                print(f'Failed {time_str}: {type(error).__name__}: {error}')
+                ledger.record(city, stage, t, state='failed', seconds=download_seconds, error=f'{type(error).__name__}: {error}')
+        producer.join()
+        if producer_errors:
+            raise producer_errors[0]
+    finally:
+        # Keep the record of the finished frames even if the job is stopped
+        for writer in writers.values():
+            writer.close()
+        for t, seconds in finished:
+            ledger.record(city, stage, t, seconds=seconds)
+        ledger.close()
+        transfer_engine.close()
+        telemetry.close()
+
+    print(f'{len(missing) - n_failed}/{len(missing)} frames processed, {n_failed} failed')
+    print(request_controller.report())
+    print(telemetry.summary())
+    time_diff = datetime.now() - start
+    print(f'Total time: {time_diff.total_seconds()} seconds')
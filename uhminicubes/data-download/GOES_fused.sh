@@ -0,0 +1,29 @@
+#!/bin/bash
+
+# Downloads and processes a city's GOES frames in one job, without saving the GeoTIFFs
+# (add --keep_tif to save them as well), e.g. sbatch GOES_fused.sh DMV
+
+# Wall time limit
+#SBATCH -t 10:00:00
+
+# Number of CPU nodes
+#SBATCH -n 1
+
+# Number of CPU cores
+#SBATCH -c 30
+
+# Memory per CPU core
+#SBATCH --mem-per-cpu=512
+
+#export PATH=/home/jonstar/scratch/condaroot/miniforge3-24.11.3/bin:$PATH
+#source activate heat
+~/scratch/conda-pack-unpacker.sh -f ~/scratch/heat.tar.gz
+if [ $? -ne 0 ]; then
+    echo "[ERROR] Error unpackaging ~/scratch/foo.tar.gz"
+    exit 1
+fi
+
+echo "First argument: $1"
+
+cd /home/jonstar/ML_UH_datasets/Jon_dataset_code
+/tmp/$USER/heat/bin/python GOES_fused.py --city=$1 --n=105120 --startFile=0 --cpus=$SLURM_CPUS_PER_TASK --output=files
@@ -0,0 +1,133 @@
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data-process'))
+from synthetic_fixtures import GOES_tif_bytes
+
+
+"""
+Local HTTP stand-in for the Earth Engine download URLs. Every GET request is
+answered with a synthetic 4-band GOES GeoTIFF, after an optional delay, and a
+share of the requests can be made to fail or to be cut off partway through the
+body, like a dropped connection, so the download code can be tested
+and timed without Earth Engine.
+
+Example:
+    python local_tif_server.py --port=8000 --latency=0.2 --failure_rate=0.05
+"""
+
+# DMV export coordinates, see export_coords in GOES_download.py
+DMV_EXPORT = [18, True, 292000, 4372200]
+
+
+class GeoTIFFHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET requests with the server's synthetic GeoTIFF.
+    """
+    # HTTP/1.1 keeps connections alive between requests, like the real download server
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+
+        if random.random() < server.failure_rate:
+            with server.lock:
+                server.failures += 1
+            self.send_response(server.failure_status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/tiff')
+        self.send_header('Content-Length', str(len(server.body)))
+        self.end_headers()
+        if random.random() < server.truncate_rate:
+            with server.lock:
+                server.truncations += 1
+            # Send part of the body and drop the connection
+            self.wfile.write(server.body[:len(server.body)//2])
+            self.close_connection = True
+            return
+        self.wfile.write(server.body)
+
+    def log_message(self, format, *args):
+        # Do not print a line for every request
+        pass
+
+
+class GeoTIFFServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server with the settings and request counts of the stand-in.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, failure_rate=0.0, failure_status=500, truncate_rate=0.0, city_export=DMV_EXPORT, native=False):
+        """
+        Args:
+        address (tuple): (host, port) to listen on, port 0 for any free port
+        latency (float): Seconds to wait before answering each request
+        failure_rate (float): Share of requests answered with failure_status instead of a GeoTIFF
+        failure_status (int): HTTP status of the failed requests, e.g. 500 or 429
+        truncate_rate (float): Share of requests whose body is cut off halfway
+        city_export (list): City export coordinates of the synthetic GeoTIFF
+        native (boolean): Serve packed int16 bands, as exported with GOES_download.py --native
+        """
+        super().__init__(address, GeoTIFFHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.truncate_rate = truncate_rate
+        self.body = GOES_tif_bytes(city_export, native=native)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.truncations = 0
+
+
+@contextmanager
+def serve_in_thread(port=0, **kwargs):
+    """
+    Runs the stand-in server on a background thread.
+
+    Args:
+    port (int): Port to listen on, 0 for any free port
+    **kwargs: Settings of GeoTIFFServer
+
+    Yields:
+    (str): Base URL of the server, e.g. 'http://127.0.0.1:8000'
+    """
+    server = GeoTIFFServer(('127.0.0.1', port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    prog='local_tif_server',
+                    description='Local stand-in server for Earth Engine GeoTIFF downloads')
+    parser.add_argument('--port', nargs='?', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--latency', nargs='?', type=float, default=0.0, help='Seconds to wait before answering each request')
+    parser.add_argument('--failure_rate', nargs='?', type=float, default=0.0, help='Share of requests that fail')
+    parser.add_argument('--failure_status', nargs='?', type=int, default=500, help='HTTP status of the failed requests')
+    parser.add_argument('--truncate_rate', nargs='?', type=float, default=0.0, help='Share of requests whose body is cut off halfway')
+    parser.add_argument('--native', action='store_true', help='Serve packed int16 bands instead of brightness temperatures')
+    args = parser.parse_args()
+
+    server = GeoTIFFServer(('127.0.0.1', args.port), args.latency, args.failure_rate, args.failure_status, args.truncate_rate,
+                           native=args.native)
+    print(f'Serving synthetic GeoTIFFs on http://127.0.0.1:{args.port}')
+    server.serve_forever()
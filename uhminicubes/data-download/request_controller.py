@@ -0,0 +1,253 @@
+import time
+import random
+import threading
+from collections import deque
+import requests
+
+
+"""
+Shared throttle for the requests to Earth Engine. Every request, whether it
+mints a download URL or transfers the file, goes through one RequestController,
+which:
+- spaces requests out with a token bucket of a set rate and burst,
+- caps the number of requests in flight, with a limit that grows by one per
+  round of successful requests and is cut by a factor when the server throttles
+  (429, 5xx, dropped connections) or responses get slower than a target,
+  i.e. additive increase / multiplicative decrease,
+- and reports the effective request rate.
+
+Retries back off with full jitter (a random wait up to the exponential backoff),
+so threads that failed together do not all retry at the same moment.
+"""
+
+# HTTP status codes of a server that is overloaded or limiting requests
+THROTTLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+def is_throttle_error(error):
+    """
+    Args:
+    error (Exception): Error raised by a request
+
+    Returns:
+    (boolean): Whether the error means the server is overloaded or limiting requests, rather than a bad request
+    """
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'status_code', None) is not None:
+        return response.status_code in THROTTLE_STATUSES
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return True
+    # Earth Engine reports quota errors as exceptions with a message, e.g. 'Too many concurrent aggregations'
+    message = str(error).lower()
+    return any(s in message for s in ('429', 'too many', 'rate limit', 'quota', 'temporarily unavailable'))
+
+
+class RequestController:
+    """
+    Token bucket, in-flight cap and AIMD concurrency limit shared by every thread making requests.
+    """
+    def __init__(self, rate=None, burst=None, max_in_flight=32, min_in_flight=1, initial_in_flight=None,
+                 decrease=0.5, latency_target=None, cooldown=1.0, window=60.0):
+        """
+        Args:
+        rate (float, optional): Largest number of requests started per second, unlimited if not given
+        burst (int, optional): Number of requests that can start at once after an idle period, rate by default
+        max_in_flight (int): Largest number of requests in flight at once
+        min_in_flight (int): Smallest concurrency limit
+        initial_in_flight (int, optional): Starting concurrency limit, a quarter of max_in_flight by default
+        decrease (float): Factor the concurrency limit is multiplied by when the server throttles
+        latency_target (float, optional): Seconds a request should take at most, slower requests also cut the limit
+        cooldown (float): Seconds after a cut in which further throttling does not cut the limit again
+        window (float): Seconds over which the effective request rate is measured
+        """
+        self.rate = rate
+        self.burst = burst if burst else max(1, int(rate if rate else 1))
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.limit = float(initial_in_flight if initial_in_flight else max(min_in_flight, max_in_flight//4))
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.window = window
+
+        self._condition = threading.Condition()
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._last_cut = 0.0
+        self._finished = deque()
+        self.start_time = time.monotonic()
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.retries = 0
+
+    def _take_tokens(self, tokens):
+        """
+        Takes tokens from the bucket, called with the condition held. A call for more tokens
+        than the bucket holds goes into debt, which delays the following requests.
+
+        Args:
+        tokens (int): Number of requests to take tokens for
+
+        Returns:
+        (float): Seconds to wait for a token, 0 if the tokens were taken
+        """
+        if self.rate is None:
+            return 0
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill)*self.rate)
+        self._last_refill = now
+        if self._tokens >= 1:
+            self._tokens -= tokens
+            return 0
+        return (1 - self._tokens)/self.rate
+
+    def acquire(self, tokens=1):
+        """
+        Waits until a request may start, then counts it as in flight.
+
+        Args:
+        tokens (int): Number of requests made one after another while in flight, e.g. a batch of URLs
+
+        Returns:
+        (float): Start time of the request, to pass to release
+        """
+        with self._condition:
+            while True:
+                if self.in_flight < min(int(self.limit), self.max_in_flight):
+                    wait = self._take_tokens(tokens)
+                    if wait == 0:
+                        self.in_flight += 1
+                        self.requests += tokens
+                        return time.monotonic()
+                else:
+                    wait = None
+                # Wakes on a release or once a token is due
+                self._condition.wait(wait)
+
+    def release(self, start, error=None, tokens=1):
+        """
+        Counts a request as finished and adjusts the concurrency limit from its outcome.
+
+        Args:
+        start (float): Start time returned by acquire
+        error (Exception, optional): Error raised by the request
+        tokens (int): Number of tokens passed to acquire
+        """
+        now = time.monotonic()
+        with self._condition:
+            self.in_flight -= 1
+            self._finished.append((now, tokens))
+            while self._finished and self._finished[0][0] < now - self.window:
+                self._finished.popleft()
+
+            slow = self.latency_target is not None and (now - start)/tokens > self.latency_target
+            if error is not None:
+                self.errors += 1
+            if error is not None and is_throttle_error(error) or slow:
+                if error is not None:
+                    self.throttled += 1
+                # One cut per cooldown, so a burst of failures from the same overload only counts once
+                if now - self._last_cut > self.cooldown:
+                    self.limit = max(self.min_in_flight, self.limit*self.decrease)
+                    self._last_cut = now
+            elif error is None:
+                # About one more request in flight per round of limit successful requests
+                self.limit = min(self.max_in_flight, self.limit + 1/self.limit)
+            self._condition.notify_all()
+
+    def count_retry(self):
+        """
+        Counts a retried request in the report.
+        """
+        with self._condition:
+            self.retries += 1
+
+    def call(self, func, *args, tokens=1):
+        """
+        Makes one request through the controller.
+
+        Args:
+        func (function): Function making the request
+        *args: Arguments of the function
+        tokens (int): Number of requests the function makes one after another
+
+        Returns:
+        Return value of the function
+        """
+        start = self.acquire(tokens)
+        try:
+            result = func(*args)
+        except Exception as e:
+            self.release(start, e, tokens)
+            raise
+        self.release(start, tokens=tokens)
+        return result
+
+    def effective_rate(self):
+        """
+        Returns:
+        (float): Requests finished per second over the last window
+        """
+        with self._condition:
+            span = min(self.window, time.monotonic() - self.start_time)
+            return sum(tokens for _, tokens in self._finished)/span if span > 0 else 0.0
+
+    def report(self):
+        """
+        Returns:
+        (str): Effective request rate, concurrency limit and error counts
+        """
+        return (f'{self.effective_rate():.1f} requests/s, concurrency limit {self.limit:.1f} '
+                f'({self.in_flight} in flight), {self.requests} requests, {self.retries} retries, '
+                f'{self.throttled} throttled, {self.errors} errors')
+
+
+class RetryPolicy:
+    """
+    Number of tries and exponential backoff with full jitter between them.
+    """
+    def __init__(self, tries=5, delay=1, backoff=2, max_delay=60, jitter=True, controller=None):
+        """
+        Args:
+        tries (int): Largest number of tries
+        delay (float): Seconds of backoff after the first failure
+        backoff (float): Factor the backoff grows by after each failure
+        max_delay (float): Longest backoff between tries
+        jitter (boolean): Wait a random time up to the backoff instead of the backoff itself
+        controller (RequestController, optional): Controller whose retry count is updated
+        """
+        self.tries = tries
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.controller = controller
+
+    def call(self, func, args=(), exceptions=Exception, on_retry=None, give_up=None):
+        """
+        Calls func(*args), retrying it on failure.
+
+        Args:
+        func (function): Function to call
+        args (tuple): Arguments of the function
+        exceptions (Exception or tuple): Errors that are retried, others are raised straight away
+        on_retry (function, optional): Called with the error before each retry, e.g. to count retries
+        give_up (function, optional): Called with each error, which is raised straight away if it returns True
+
+        Returns:
+        Return value of the function
+        """
+        for attempt in range(self.tries):
+            try:
+                return func(*args)
+            except exceptions as e:
+                if attempt == self.tries - 1 or (give_up is not None and give_up(e)):
+                    raise
+                if on_retry is not None:
+                    on_retry(e)
+            backoff = min(self.max_delay, self.delay*self.backoff**attempt)
+            time.sleep(random.uniform(0, backoff) if self.jitter else backoff)
+            if self.controller is not None:
+                self.controller.count_retry()
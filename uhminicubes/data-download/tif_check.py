@@ -0,0 +1,139 @@
+import io
+import os
+import struct
+import numpy as np
+
+
+"""
+Quick completeness check of a GeoTIFF from its header alone. Reads the TIFF
+header and image file directories (a few kB) and checks that every strip or
+tile they point to lies inside the file, so a truncated download is found
+without decoding any pixels. Handles classic TIFF and BigTIFF in either byte
+order.
+"""
+
+# Sizes in bytes of the TIFF field types
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 16: 8, 17: 8, 18: 8}
+TIFF_TYPE_CODES = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+SAMPLES_PER_PIXEL = 277
+STRIP_OFFSETS = 273
+STRIP_BYTE_COUNTS = 279
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+
+# Largest number of image file directories followed, e.g. the image and its overviews
+MAX_IFDS = 64
+
+
+def read_tif_header(path):
+    """
+    Reads the layout of a TIFF file from its header and image file directories.
+
+    Args:
+    path (str or bytes): Location of the file, or the contents of a file held in memory
+
+    Returns:
+    (dict): width, height and bands of the first image, the number of image file directories,
+            the end of the last strip or tile in bytes and the size of the file in bytes
+    """
+    if isinstance(path, bytes):
+        size = len(path)
+        f = io.BytesIO(path)
+        path = 'Downloaded file'
+    else:
+        size = os.path.getsize(path)
+        f = open(path, 'rb')
+    with f:
+        header = f.read(16)
+        if header[:4] in (b'II*\x00', b'MM\x00*'):
+            big = False
+        elif header[:4] in (b'II+\x00', b'MM\x00+'):
+            big = True
+        else:
+            raise ValueError(f'{path} is not a TIFF file')
+        order = '<' if header[:2] == b'II' else '>'
+        if big:
+            count_fmt, entry_fmt, entry_size, inline_size = 'Q', 'HHQ8s', 20, 8
+            ifd_offset = struct.unpack(order + 'Q', header[8:16])[0]
+        else:
+            count_fmt, entry_fmt, entry_size, inline_size = 'H', 'HHI4s', 12, 4
+            ifd_offset = struct.unpack(order + 'I', header[4:8])[0]
+
+        def read_values(field_type, count, value):
+            # Values that fit in the entry are stored in it, larger ones at the offset it holds
+            n_bytes = TIFF_TYPE_SIZES.get(field_type, 1)*count
+            if n_bytes <= inline_size:
+                data = value[:n_bytes]
+            else:
+                offset = struct.unpack(order + ('Q' if big else 'I'), value)[0]
+                if offset + n_bytes > size:
+                    raise ValueError(f'{path} is truncated: a header field ends at byte {offset + n_bytes} of {size}')
+                f.seek(offset)
+                data = f.read(n_bytes)
+            return np.frombuffer(data, dtype=np.dtype(order + TIFF_TYPE_CODES[field_type]), count=count)
+
+        layout = {'size': size, 'end': 0, 'ifds': 0}
+        while ifd_offset and layout['ifds'] < MAX_IFDS:
+            count_size = struct.calcsize(count_fmt)
+            if ifd_offset + count_size > size:
+                raise ValueError(f'{path} is truncated: an image file directory starts at byte {ifd_offset} of {size}')
+            f.seek(ifd_offset)
+            n_entries = struct.unpack(order + count_fmt, f.read(count_size))[0]
+            entries = f.read(n_entries*entry_size + inline_size)
+            if len(entries) < n_entries*entry_size + inline_size:
+                raise ValueError(f'{path} is truncated: an image file directory ends past byte {size}')
+
+            tags = {}
+            for i in range(n_entries):
+                tag, field_type, count, value = struct.unpack(order + entry_fmt, entries[i*entry_size:(i+1)*entry_size])
+                if tag in (IMAGE_WIDTH, IMAGE_LENGTH, SAMPLES_PER_PIXEL, STRIP_OFFSETS, STRIP_BYTE_COUNTS,
+                           TILE_OFFSETS, TILE_BYTE_COUNTS) and field_type in TIFF_TYPE_CODES:
+                    tags[tag] = read_values(field_type, count, value)
+
+            offsets = tags.get(TILE_OFFSETS, tags.get(STRIP_OFFSETS))
+            byte_counts = tags.get(TILE_BYTE_COUNTS, tags.get(STRIP_BYTE_COUNTS))
+            if offsets is None or byte_counts is None or len(offsets) != len(byte_counts):
+                raise ValueError(f'{path} has an image file directory without strip or tile locations')
+            layout['end'] = max(layout['end'], int((offsets.astype(np.uint64) + byte_counts.astype(np.uint64)).max(initial=0)))
+            if layout['ifds'] == 0:
+                layout['width'] = int(tags[IMAGE_WIDTH][0])
+                layout['height'] = int(tags[IMAGE_LENGTH][0])
+                layout['bands'] = int(tags[SAMPLES_PER_PIXEL][0]) if SAMPLES_PER_PIXEL in tags else 1
+            layout['ifds'] += 1
+            ifd_offset = struct.unpack(order + ('Q' if big else 'I'), entries[n_entries*entry_size:])[0]
+    return layout
+
+
+def check_tif(path):
+    """
+    Checks that a TIFF file is complete, raising a ValueError if it is not.
+
+    Args:
+    path (str or bytes): Location of the file, or the contents of a file held in memory
+
+    Returns:
+    (dict): Layout of the file, see read_tif_header
+    """
+    layout = read_tif_header(path)
+    if layout['end'] > layout['size']:
+        name = 'Downloaded file' if isinstance(path, bytes) else path
+        raise ValueError(f"{name} is truncated: the image data ends at byte {layout['end']} of {layout['size']}")
+    return layout
+
+
+def is_complete_tif(path):
+    """
+    Args:
+    path (str or bytes): Location of the file, or the contents of a file held in memory
+
+    Returns:
+    (boolean): Whether the file is a complete TIFF file
+    """
+    try:
+        check_tif(path)
+        return True
+    except (ValueError, OSError, KeyError, struct.error):
+        return False
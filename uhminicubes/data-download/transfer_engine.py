@@ -0,0 +1,180 @@
+import os
+import time
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from requests.adapters import HTTPAdapter
+
+
+"""
+Download engine for the Earth Engine exports. Transfers are network bound, so
+instead of one process per in-flight request, a thread pool in a single process
+runs many concurrent transfers over one requests.Session whose connection pool
+keeps connections to the server alive between files. Responses are streamed to
+disk instead of being held in memory, into a '.part' file that is only renamed to
+the final name once the transfer is complete and has passed its checks, so a
+stopped job never leaves a truncated file under the final name.
+
+Example against the local stand-in server (see local_tif_server.py):
+    python transfer_engine.py --n=500 --concurrency=32
+"""
+
+
+class TransferEngine:
+    """
+    Runs downloads concurrently over a pooled keep-alive HTTP session.
+    """
+    def __init__(self, max_concurrency=32, timeout=120, chunk_size=1 << 16, validate=None):
+        """
+        Args:
+        max_concurrency (int): Largest number of transfers in flight at once
+        timeout (float): Seconds to wait for the server to connect or send data
+        chunk_size (int): Bytes read from the response and written to disk at a time
+        validate (function, optional): Check of a downloaded file, called with its temporary path (or its bytes for fetch), that raises an error if the file is bad
+        """
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.validate = validate
+
+        # One connection per concurrent transfer, kept alive and reused for the following files
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self.bytes_downloaded = 0
+
+    def download(self, url, filename):
+        """
+        Streams a URL to a file. Safe to call from several threads. The body is written to
+        filename + '.part', checked against the Content-Length of the response and the
+        validate function, and then renamed to filename. A failed transfer leaves no file.
+
+        Args:
+        url (str): URL to download
+        filename (str): File to save the response body to
+
+        Returns:
+        (int): Number of bytes written
+        """
+        part_filename = f'{filename}.part'
+        size = 0
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as r:
+                r.raise_for_status()
+                with open(part_filename, 'wb') as out_file:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        out_file.write(chunk)
+                        size += len(chunk)
+                # Content-Length counts the encoded bytes, so it can only be compared with an unencoded body
+                expected = r.headers.get('Content-Length')
+                if expected is not None and 'Content-Encoding' not in r.headers and size != int(expected):
+                    raise IOError(f'Incomplete download of {filename}: {size} of {expected} bytes')
+            if self.validate:
+                self.validate(part_filename)
+            os.replace(part_filename, filename)
+        except BaseException:
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
+            raise
+        with self._lock:
+            self.bytes_downloaded += size
+        return size
+
+    def fetch(self, url):
+        """
+        Downloads a URL into memory instead of a file. Safe to call from several threads.
+        The body is checked against the Content-Length of the response and the validate function.
+
+        Args:
+        url (str): URL to download
+
+        Returns:
+        (bytes): Response body
+        """
+        with self.session.get(url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            body = b''.join(r.iter_content(chunk_size=self.chunk_size))
+            expected = r.headers.get('Content-Length')
+            if expected is not None and 'Content-Encoding' not in r.headers and len(body) != int(expected):
+                raise IOError(f'Incomplete download of {url}: {len(body)} of {expected} bytes')
+        if self.validate:
+            self.validate(body)
+        with self._lock:
+            self.bytes_downloaded += len(body)
+        return body
+
+    def map(self, func, tasks):
+        """
+        Runs func over every task on the thread pool, keeping at most max_concurrency
+        tasks in flight, and yields each result as it finishes. An error in one task is
+        returned with its result instead of stopping the others.
+
+        Args:
+        func (function): Function called as func(*args) for each task, usually calling download
+        tasks (iterable): (key, args) tuples. The key identifies the task in the results
+
+        Yields:
+        key: Key of the task
+        result: Return value of func, None if it failed
+        error (Exception or None): Error raised by func
+        seconds (float): Time taken by the task
+        """
+        def run(args):
+            start = time.perf_counter()
+            try:
+                return func(*args), None, time.perf_counter() - start
+            except Exception as e:
+                return None, e, time.perf_counter() - start
+
+        tasks = iter(tasks)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            pending = {}
+            while True:
+                # Only submit as many tasks as can run, so a long task list is not all queued at once
+                for key, args in tasks:
+                    pending[executor.submit(run, args)] = key
+                    if len(pending) >= self.max_concurrency:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    yield (key, *future.result())
+
+    def close(self):
+        """
+        Closes the connections of the session.
+        """
+        self.session.close()
+
+
+if __name__ == '__main__':
+    # Only needed for the local check, so the downloads do not depend on it
+    from local_tif_server import serve_in_thread
+    from tif_check import check_tif
+
+    parser = argparse.ArgumentParser(
+                    prog='transfer_engine',
+                    description='Downloads synthetic GeoTIFFs from a local stand-in server to check and time the transfer engine')
+    parser.add_argument('--n', nargs='?', type=int, default=200, help='Number of files to download')
+    parser.add_argument('--concurrency', nargs='?', type=int, default=32, help='Number of concurrent transfers')
+    parser.add_argument('--latency', nargs='?', type=float, default=0.05, help='Seconds the server waits before each response')
+    parser.add_argument('--truncate_rate', nargs='?', type=float, default=0.0, help='Share of responses the server cuts off halfway')
+    args = parser.parse_args()
+
+    with serve_in_thread(latency=args.latency, truncate_rate=args.truncate_rate) as base_url, tempfile.TemporaryDirectory() as out_dir:
+        engine = TransferEngine(args.concurrency, validate=check_tif)
+        tasks = [(i, (f'{base_url}/GOES_image_{i}.tif', f'{out_dir}/GOES_image_{i}.tif')) for i in range(args.n)]
+        start = time.perf_counter()
+        failures = [key for key, _, error, _ in engine.map(engine.download, tasks) if error is not None]
+        seconds = time.perf_counter() - start
+        engine.close()
+
+        print(f'{args.n - len(failures)}/{args.n} files in {seconds:.2f} seconds, {args.n/seconds:.1f} files/s, '
+              f'{engine.bytes_downloaded/seconds/1e6:.2f} MB/s, {len(os.listdir(out_dir))} files on disk')
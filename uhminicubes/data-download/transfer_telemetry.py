@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+
+
+"""
+Telemetry of the download path. Records, for each stage of the download
+pipeline ('mint' for fetching download URLs, 'transfer' for downloading them):
+- a histogram of request latencies,
+- the number of responses of each HTTP status (or error class when there was
+  no response),
+- the number of retries,
+- bytes and requests per second,
+and samples registered gauges such as queue depths and the concurrency limit.
+
+Snapshots are written every few seconds from a background thread, either
+appended as JSON lines or as a Prometheus text file that is replaced each time
+(for the node exporter's textfile collector). A summary is printed at the end of
+a run.
+"""
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, np.inf)
+
+# Prefix of the Prometheus metric names
+METRIC_PREFIX = 'goes_download'
+
+
+def response_status(error):
+    """
+    Args:
+    error (Exception or None): Error raised by a request, None if it succeeded
+
+    Returns:
+    (str): HTTP status code of the response, or the error class if there was no response
+    """
+    if error is None:
+        return '200'
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'status_code', None) is not None:
+        return str(response.status_code)
+    return type(error).__name__
+
+
+class StageStats:
+    """
+    Counts of one stage of the download pipeline.
+    """
+    def __init__(self):
+        self.buckets = np.zeros(len(LATENCY_BUCKETS), dtype=np.int64)
+        self.latency_sum = 0.0
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.statuses = {}
+
+    def quantile(self, q):
+        """
+        Args:
+        q (float): Quantile between 0 and 1
+
+        Returns:
+        (float): Upper bound of the histogram bucket holding the quantile, in seconds
+        """
+        if self.requests == 0:
+            return np.nan
+        return LATENCY_BUCKETS[int(np.searchsorted(np.cumsum(self.buckets), q*self.requests))]
+
+
+class TransferTelemetry:
+    """
+    Thread-safe recorder of the download telemetry, written periodically to a file.
+    """
+    def __init__(self, path=None, fmt=None, interval=30):
+        """
+        Args:
+        path (str, optional): File to write the snapshots to, none are written if not given
+        fmt (str, optional): 'jsonl' to append JSON lines or 'prometheus' to write a Prometheus text file.
+                             Chosen from the file extension ('.prom' for Prometheus) if not given
+        interval (float): Seconds between snapshots
+        """
+        if fmt is None:
+            fmt = 'prometheus' if path and path.endswith('.prom') else 'jsonl'
+        if fmt not in ('jsonl', 'prometheus'):
+            raise ValueError("Please set fmt to ``jsonl`` or ``prometheus``.")
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.stages = {}
+        self.gauges = {}
+        self.start_time = time.time()
+        self._last = (self.start_time, 0, 0)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _stage(self, stage):
+        if stage not in self.stages:
+            self.stages[stage] = StageStats()
+        return self.stages[stage]
+
+    def observe(self, stage, seconds, error=None, size=0):
+        """
+        Records one request.
+
+        Args:
+        stage (str): Pipeline stage, e.g. 'mint' or 'transfer'
+        seconds (float): Latency of the request
+        error (Exception, optional): Error raised by the request
+        size (int): Bytes received
+        """
+        status = response_status(error)
+        with self._lock:
+            stats = self._stage(stage)
+            stats.buckets[np.searchsorted(LATENCY_BUCKETS, seconds)] += 1
+            stats.latency_sum += seconds
+            stats.requests += 1
+            stats.bytes += size
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+    def count_retry(self, stage):
+        """
+        Args:
+        stage (str): Pipeline stage of the retried request
+        """
+        with self._lock:
+            self._stage(stage).retries += 1
+
+    def gauge(self, name, func):
+        """
+        Registers a value that is sampled at every snapshot, e.g. a queue depth.
+
+        Args:
+        name (str): Name of the value
+        func (function): Returns the current value
+        """
+        with self._lock:
+            self.gauges[name] = func
+
+    def snapshot(self):
+        """
+        Returns:
+        (dict): Counts of every stage, throughput over the run and since the last snapshot, and the gauges
+        """
+        now = time.time()
+        with self._lock:
+            stages = {stage: {'requests': stats.requests, 'bytes': stats.bytes, 'retries': stats.retries,
+                              'latency_sum': stats.latency_sum, 'latency_buckets': stats.buckets.tolist(),
+                              'statuses': dict(stats.statuses)}
+                      for stage, stats in self.stages.items()}
+            gauges = dict(self.gauges)
+            requests = sum(stats.requests for stats in self.stages.values())
+            n_bytes = sum(stats.bytes for stats in self.stages.values())
+            last_time, last_requests, last_bytes = self._last
+            self._last = (now, requests, n_bytes)
+
+        elapsed = now - self.start_time
+        interval = max(now - last_time, 1e-9)
+        return {'time': now, 'elapsed': elapsed,
+                'requests_per_s': requests/elapsed if elapsed > 0 else 0.0,
+                'bytes_per_s': n_bytes/elapsed if elapsed > 0 else 0.0,
+                'interval_requests_per_s': (requests - last_requests)/interval,
+                'interval_bytes_per_s': (n_bytes - last_bytes)/interval,
+                'latency_bucket_bounds': [b if np.isfinite(b) else 'inf' for b in LATENCY_BUCKETS],
+                'stages': stages,
+                'gauges': {name: func() for name, func in gauges.items()}}
+
+    def prometheus_text(self, snapshot):
+        """
+        Args:
+        snapshot (dict): Output of snapshot
+
+        Returns:
+        (str): The snapshot in the Prometheus text exposition format
+        """
+        p = METRIC_PREFIX
+        lines = [f'# TYPE {p}_request_seconds histogram']
+        for stage, stats in snapshot['stages'].items():
+            for bound, count in zip(snapshot['latency_bucket_bounds'], np.cumsum(stats['latency_buckets'])):
+                le = '+Inf' if bound == 'inf' else bound
+                lines.append(f'{p}_request_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+            lines.append(f'{p}_request_seconds_sum{{stage="{stage}"}} {stats["latency_sum"]}')
+            lines.append(f'{p}_request_seconds_count{{stage="{stage}"}} {stats["requests"]}')
+        lines.append(f'# TYPE {p}_responses_total counter')
+        for stage, stats in snapshot['stages'].items():
+            for status, count in stats['statuses'].items():
+                lines.append(f'{p}_responses_total{{stage="{stage}",status="{status}"}} {count}')
+        lines.append(f'# TYPE {p}_retries_total counter')
+        for stage, stats in snapshot['stages'].items():
+            lines.append(f'{p}_retries_total{{stage="{stage}"}} {stats["retries"]}')
+        lines.append(f'# TYPE {p}_bytes_total counter')
+        for stage, stats in snapshot['stages'].items():
+            lines.append(f'{p}_bytes_total{{stage="{stage}"}} {stats["bytes"]}')
+        lines.append(f'# TYPE {p}_gauge gauge')
+        for name, value in snapshot['gauges'].items():
+            lines.append(f'{p}_gauge{{name="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Writes a snapshot to the telemetry file.
+        """
+        if not self.path:
+            return
+        snapshot = self.snapshot()
+        if self.fmt == 'jsonl':
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+        else:
+            # Replaced in one step, so a collector never reads a partial file
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.prometheus_text(snapshot))
+            os.replace(tmp_path, self.path)
+
+    def start(self):
+        """
+        Starts writing a snapshot every interval seconds on a background thread.
+        """
+        def run():
+            while not self._stop.wait(self.interval):
+                self.write()
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """
+        Stops the background thread and writes a last snapshot.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+
+    def summary(self):
+        """
+        Returns:
+        (str): Table of the requests, latencies, retries and statuses of each stage, and the throughput of the run
+        """
+        lines = [f"{'stage':<10}{'requests':>10}{'mean s':>10}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'retries':>9}{'MB':>10}  statuses"]
+        with self._lock:
+            for stage, stats in self.stages.items():
+                mean = stats.latency_sum/stats.requests if stats.requests else np.nan
+                statuses = ', '.join(f'{status}: {count}' for status, count in sorted(stats.statuses.items()))
+                lines.append(f'{stage:<10}{stats.requests:>10}{mean:>10.3f}{stats.quantile(0.5):>8}{stats.quantile(0.95):>8}'
+                             f'{stats.quantile(0.99):>8}{stats.retries:>9}{stats.bytes/1e6:>10.1f}  {statuses}')
+            requests = sum(stats.requests for stats in self.stages.values())
+            n_bytes = sum(stats.bytes for stats in self.stages.values())
+        elapsed = time.time() - self.start_time
+        lines.append(f'{requests/elapsed:.1f} requests/s, {n_bytes/elapsed/1e6:.2f} MB/s over {elapsed:.0f} seconds')
+        return '\n'.join(lines)
@@ -0,0 +1,361 @@
+import abc
+import time
+import queue
+import random
+import threading
+import requests
+from request_controller import RetryPolicy
+
+
+"""
+Two-stage download pipeline. A minting stage asks a URL provider (Earth Engine,
+or a fake provider for offline tests) for the download URL of each image and puts
+it on a bounded queue, and a transfer stage downloads the queued URLs with the
+TransferEngine. Each stage has its own concurrency and retry policy, so a failed
+transfer is retried without redoing the Earth Engine calls that made its URL.
+Minted URLs are cached until they expire. Both stages can share a
+RequestController (see request_controller.py), which paces and caps their
+requests together.
+"""
+
+# HTTP status of a transfer whose URL has expired or is invalid, which is minted again instead of retried
+REJECTED_URL_STATUS = (400, 403, 404, 410)
+
+
+def is_rejected_url(error):
+    """
+    Args:
+    error (Exception): Error of a transfer
+
+    Returns:
+    (boolean): Whether the server rejected the URL itself, so retrying the same URL cannot succeed
+    """
+    return (isinstance(error, requests.HTTPError) and error.response is not None
+            and error.response.status_code in REJECTED_URL_STATUS)
+
+
+class URLProvider(abc.ABC):
+    """
+    Interface of the URL minting stage. A provider makes the download URL of an image.
+    """
+    # Seconds a minted URL can be used for
+    ttl = 3600
+
+    @abc.abstractmethod
+    def mint(self, *args):
+        """
+        Args:
+        *args: Arguments that identify the image to download
+
+        Returns:
+        (str): Download URL of the image
+        """
+
+    def mint_batch(self, batch):
+        """
+        Makes the URLs of a batch of images. Providers that can request several URLs at
+        once override this, the default mints them one at a time.
+
+        Args:
+        batch (list): Argument tuples of mint
+
+        Returns:
+        (list): Download URL of each image
+        """
+        return [self.mint(*args) for args in batch]
+
+
+class FakeURLProvider(URLProvider):
+    """
+    Provider for offline tests that makes URLs on a local stand-in server (see local_tif_server.py)
+    without any Earth Engine calls.
+    """
+    def __init__(self, base_url, ttl=3600, latency=0.0, failure_rate=0.0):
+        """
+        Args:
+        base_url (str): Base URL of the stand-in server, e.g. 'http://127.0.0.1:8000'
+        ttl (float): Seconds a minted URL can be used for
+        latency (float): Seconds each mint takes, like an Earth Engine round trip
+        failure_rate (float): Share of mints that fail
+        """
+        self.base_url = base_url
+        self.ttl = ttl
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.mints = 0
+        self._lock = threading.Lock()
+
+    def mint(self, *args):
+        time.sleep(self.latency)
+        with self._lock:
+            self.mints += 1
+        if random.random() < self.failure_rate:
+            raise ConnectionError('Simulated URL minting failure')
+        return f"{self.base_url}/{'_'.join(str(a) for a in args)}.tif?token={random.getrandbits(64):016x}"
+
+
+class URLCache:
+    """
+    Thread-safe cache of minted URLs. The pipeline forgets a URL once its image is downloaded,
+    and expired URLs are dropped whenever a URL is added, so the cache only holds the URLs of
+    images that are queued, in transfer or failed within the last ttl seconds.
+    """
+    def __init__(self, ttl, margin=60):
+        """
+        Args:
+        ttl (float): Seconds a minted URL can be used for
+        margin (float): URLs are treated as expired this many seconds early, so a transfer does not start on a URL about to expire
+        """
+        self.ttl = ttl
+        self.margin = margin
+        self._urls = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Args:
+        key: Key of the image
+
+        Returns:
+        (str or None): The cached URL, None if there is none or it has expired
+        """
+        with self._lock:
+            url, expires = self._urls.get(key, (None, 0))
+            if time.time() < expires:
+                return url
+            self._urls.pop(key, None)
+            return None
+
+    def put(self, key, url):
+        """
+        Args:
+        key: Key of the image
+        url (str): URL minted now
+        """
+        now = time.time()
+        with self._lock:
+            for expired_key in [k for k, (_, expires) in self._urls.items() if expires <= now]:
+                del self._urls[expired_key]
+            self._urls[key] = (url, now + self.ttl - self.margin)
+
+    def invalidate(self, key):
+        """
+        Forgets a URL, e.g. after the server has rejected it.
+
+        Args:
+        key: Key of the image
+        """
+        with self._lock:
+            self._urls.pop(key, None)
+
+
+class DownloadPipeline:
+    """
+    Mints download URLs and transfers them in two separate stages joined by a bounded queue.
+    """
+    def __init__(self, provider, engine, mint_concurrency=8, mint_batch_size=1, queue_size=256,
+                 mint_retry=None, transfer_retry=None, controller=None, telemetry=None):
+        """
+        Args:
+        provider (URLProvider): Makes the download URLs
+        engine (TransferEngine): Transfers the files; its max_concurrency is the concurrency of the transfer stage
+        mint_concurrency (int): Number of threads minting URLs
+        mint_batch_size (int): Number of URLs each minting thread requests at a time
+        queue_size (int): Largest number of minted URLs waiting for a transfer
+        mint_retry (RetryPolicy, optional): Retries of a failed mint
+        transfer_retry (RetryPolicy, optional): Retries of a failed transfer
+        controller (RequestController, optional): Throttle of the requests of both stages
+        telemetry (TransferTelemetry, optional): Recorder of the latency, status and retries of every request
+        """
+        self.provider = provider
+        self.engine = engine
+        self.mint_concurrency = mint_concurrency
+        self.mint_batch_size = mint_batch_size
+        self.queue_size = queue_size
+        self.mint_retry = mint_retry if mint_retry else RetryPolicy(tries=10, delay=1, backoff=2)
+        self.transfer_retry = transfer_retry if transfer_retry else RetryPolicy(tries=5, delay=0.5, backoff=2)
+        self.cache = URLCache(provider.ttl)
+        self.controller = controller
+        self.telemetry = telemetry
+
+    def _mint(self, batch):
+        """
+        Makes one try at minting the URLs of a batch, through the controller if there is one.
+
+        Args:
+        batch (list): Argument tuples of provider.mint
+
+        Returns:
+        (list): Download URL of each image
+        """
+        mint = self._timed('mint', self.provider.mint_batch, len(batch))
+        if self.controller is None:
+            return mint(batch)
+        return self.controller.call(mint, batch, tokens=len(batch))
+
+    def _download(self, url, filename):
+        """
+        Makes one try at a transfer, through the controller if there is one.
+
+        Args:
+        url (str): URL to download
+        filename (str or None): File to save the image to, None to keep it in memory
+
+        Returns:
+        (int or bytes): Size of the downloaded file in bytes, or the contents of the file if filename is None
+        """
+        if filename is None:
+            transfer, args = self._timed('transfer', self.engine.fetch), (url,)
+        else:
+            transfer, args = self._timed('transfer', self.engine.download), (url, filename)
+        if self.controller is None:
+            return transfer(*args)
+        return self.controller.call(transfer, *args)
+
+    def _timed(self, stage, func, n=1):
+        """
+        Wraps a request so that its latency, status and size are recorded in the telemetry. The time
+        spent waiting for the controller is not part of the latency.
+
+        Args:
+        stage (str): 'mint' or 'transfer'
+        func (function): Function making the request, returning a URL list, a size in bytes or the bytes downloaded
+        n (int): Number of URLs of a mint batch, each recorded with an equal share of the time
+
+        Returns:
+        (function): The wrapped function, or func itself if there is no telemetry
+        """
+        if self.telemetry is None:
+            return func
+
+        def timed(*args):
+            start = time.perf_counter()
+            try:
+                result = func(*args)
+            except Exception as e:
+                for _ in range(n):
+                    self.telemetry.observe(stage, (time.perf_counter() - start)/n, e)
+                raise
+            size = len(result) if isinstance(result, bytes) else result if isinstance(result, int) else 0
+            for _ in range(n):
+                self.telemetry.observe(stage, (time.perf_counter() - start)/n, size=size)
+            return result
+        return timed
+
+    def _on_retry(self, stage):
+        """
+        Args:
+        stage (str): 'mint' or 'transfer'
+
+        Returns:
+        (function or None): Callback counting the retries of the stage in the telemetry
+        """
+        if self.telemetry is None:
+            return None
+        return lambda error: self.telemetry.count_retry(stage)
+
+    def _mint_batch(self, batch):
+        """
+        Mints the URLs of a batch, using cached URLs where possible.
+
+        Args:
+        batch (list): (key, mint_args, filename) of each image
+
+        Returns:
+        (list): (key, (url, filename, error)) of each image, where error is the minting error or None
+        """
+        urls = {key: self.cache.get(key) for key, _, _ in batch}
+        to_mint = [(key, mint_args) for key, mint_args, _ in batch if urls[key] is None]
+        if to_mint:
+            try:
+                minted = self.mint_retry.call(self._mint, ([mint_args for _, mint_args in to_mint],), on_retry=self._on_retry('mint'))
+                for (key, _), url in zip(to_mint, minted):
+                    self.cache.put(key, url)
+                    urls[key] = url
+            except Exception as e:
+                return [(key, (urls[key], filename, e if urls[key] is None else None)) for key, _, filename in batch]
+        return [(key, (urls[key], filename, None)) for key, _, filename in batch]
+
+    def _minting_stage(self, tasks, minted):
+        """
+        Runs the minting threads, putting the minted URLs on the queue and a final None once all are minted.
+
+        Args:
+        tasks (iterable): (key, mint_args, filename) of each image
+        minted (queue.Queue): Queue of minted URLs
+        """
+        tasks = iter(tasks)
+        lock = threading.Lock()
+
+        def mint_worker():
+            while True:
+                with lock:
+                    batch = [task for _, task in zip(range(self.mint_batch_size), tasks)]
+                if not batch:
+                    return
+                for item in self._mint_batch(batch):
+                    # Blocks while the queue is full, so minting never runs far ahead of the transfers
+                    minted.put(item)
+
+        threads = [threading.Thread(target=mint_worker, daemon=True) for _ in range(self.mint_concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        minted.put(None)
+
+    def _transfer(self, key, url, filename, mint_error):
+        """
+        Transfers one minted URL. If the server rejects an expired or invalid URL, the URL
+        is minted again and the transfer retried.
+
+        Args:
+        key: Key of the image
+        url (str): Minted URL
+        filename (str or None): File to save the image to, None to keep it in memory
+        mint_error (Exception or None): Error of the minting stage, raised if the URL could not be minted
+
+        Returns:
+        (int or bytes): Size of the downloaded file in bytes, or the contents of the file if filename is None
+        """
+        if mint_error is not None:
+            raise mint_error
+        try:
+            # A rejected URL is not retried, it goes straight to being minted again
+            result = self.transfer_retry.call(self._download, (url, filename), on_retry=self._on_retry('transfer'),
+                                              give_up=is_rejected_url)
+        except requests.HTTPError as e:
+            if not is_rejected_url(e):
+                raise
+            self.cache.invalidate(key)
+            url = self.mint_retry.call(self._mint, ([self._mint_args[key]],), on_retry=self._on_retry('mint'))[0]
+            self.cache.put(key, url)
+            result = self.transfer_retry.call(self._download, (url, filename), on_retry=self._on_retry('transfer'))
+        # Each image is downloaded once, so its URL is not needed again
+        self.cache.invalidate(key)
+        return result
+
+    def run(self, tasks):
+        """
+        Downloads every image, yielding each result as its transfer finishes.
+
+        Args:
+        tasks (list): (key, mint_args, filename) of each image, where mint_args are the arguments of provider.mint.
+                      A filename of None keeps the image in memory
+
+        Yields:
+        key: Key of the image
+        size (int, bytes or None): Size of the downloaded file in bytes, or its contents if kept in memory. None if it failed
+        error (Exception or None): Minting or transfer error
+        seconds (float): Time taken by the transfer
+        """
+        self._mint_args = {key: mint_args for key, mint_args, _ in tasks}
+        minted = queue.Queue(maxsize=self.queue_size)
+        if self.telemetry is not None:
+            self.telemetry.gauge('url_queue_depth', minted.qsize)
+        minting = threading.Thread(target=self._minting_stage, args=(tasks, minted), daemon=True)
+        minting.start()
+
+        transfers = ((key, (key, *item)) for key, item in iter(minted.get, None))
+        yield from self.engine.map(self._transfer, transfers)
+        minting.join()
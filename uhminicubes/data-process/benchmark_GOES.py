@@ -0,0 +1,239 @@
+import os
+import sys
+import time
+import json
+import resource
+import tempfile
+import argparse
+import subprocess
+import datetime
+import numpy as np
+import rasterio
+import rioxarray as rxr
+import process_GOES
+from process_GOES import build_GOES_dataset, process_GOES_tif, process_GOES_frame, init_GOES_worker, interpolate_mw_LST
+from mw_store import MicrowaveStore, city_bbox
+from goes_writer import GOESFrameWriter
+from goes_scheduler import run_pool
+from time_align import to_utc_seconds
+from synthetic_fixtures import GOES_grid_latlons, write_GOES_tifs, write_MW_files
+
+
+"""
+Stage-level benchmark of the GOES processing on synthetic data. Makes synthetic
+4-band 45x45 GeoTIFFs and microwave LST files for one day of 10-minute frames,
+times each stage of processing a frame and a pool run over the whole day, and
+reports time per stage, frames/s and peak memory as a table and as JSON.
+
+Example:
+    python benchmark_GOES.py --n_frames=144 --cpus=4 --json=benchmark.json
+"""
+
+# DMV export coordinates, see export_coords in GOES_download.py
+DMV_EXPORT = [18, True, 292000, 4372200]
+
+
+def time_stage(func, inputs):
+    """
+    Times a function over a list of inputs.
+
+    Args:
+    func (function): Function to time, called as func(*args)
+    inputs (list): List of argument tuples, one call per tuple
+
+    Returns:
+    (float array): Seconds taken by each call
+    """
+    seconds = []
+    for args in inputs:
+        start = time.perf_counter()
+        func(*args)
+        seconds.append(time.perf_counter() - start)
+    return np.array(seconds)
+
+
+def time_import(module, n=3, path=None):
+    """
+    Times importing a module in a fresh interpreter, which is what each spawned pool worker pays before its first task.
+
+    Args:
+    module (str): Name of the module
+    n (int): Number of fresh interpreters to time
+    path (str, optional): Directory to import the module from, this directory by default
+
+    Returns:
+    (float array): Seconds taken by each import
+    """
+    path = path if path else os.path.dirname(os.path.abspath(__file__))
+    code = (f'import sys, time; sys.path[:0] = [{path!r}, {os.path.dirname(os.path.abspath(__file__))!r}]; '
+            f'start = time.perf_counter(); import {module}; print(time.perf_counter() - start)')
+    return np.array([float(subprocess.check_output([sys.executable, '-c', code], text=True).split()[-1]) for _ in range(n)])
+
+
+def summarize(seconds, frames_per_call=1):
+    """
+    Args:
+    seconds (float array): Seconds taken by each call of a stage
+    frames_per_call (int): Number of frames handled by each call
+
+    Returns:
+    (dict): Number of calls, mean and 95th percentile ms per call, and frames/s
+    """
+    return {'calls': len(seconds),
+            'mean_ms': float(np.mean(seconds)*1000),
+            'p95_ms': float(np.percentile(seconds, 95)*1000),
+            'frames_per_s': float(frames_per_call*len(seconds)/np.sum(seconds))}
+
+
+def peak_rss_mb():
+    """
+    Returns:
+    (float): Peak resident memory of this process and its finished children in MB
+    """
+    # ru_maxrss is in kB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children)/1024
+
+
+def make_fixtures(work_dir, n_frames, start='2022-06-15T00:00:00'):
+    """
+    Writes the synthetic GeoTIFFs and microwave LST files of the benchmark.
+
+    Args:
+    work_dir (str): Directory for the fixtures and outputs
+    n_frames (int): Number of 10-minute frames
+    start (str): Time of the first frame
+
+    Returns:
+    tifs (list): Paths of the GeoTIFFs
+    times (list): Frame times in format YYYY-MM-DDThh:mm:ssZ
+    latlon_pts (float array): (45,45,2) Array of (longitude, latitude) points of the GOES grid
+    """
+    frame_times = np.datetime64(start, 's') + np.arange(n_frames)*np.timedelta64(600, 's')
+    times = [f'{t}Z' for t in frame_times.astype(str)]
+    time_strs = [t.replace('-', '').replace('T', '').replace(':', '')[:12] for t in times]
+    latlon_pts = GOES_grid_latlons(DMV_EXPORT)
+
+    # Microwave LST of the day before and after is needed near local midnight
+    one_day = np.timedelta64(1, 'D')
+    days = np.arange(frame_times[0].astype('datetime64[D]') - one_day, frame_times[-1].astype('datetime64[D]') + 2*one_day)
+    write_MW_files(f'{work_dir}/mw', [str(d).replace('-', '') for d in days], latlon_pts)
+    tifs = write_GOES_tifs(f'{work_dir}/tifs', DMV_EXPORT, time_strs)
+    return tifs, times, latlon_pts
+
+
+def run_benchmark(work_dir, n_frames, cpus):
+    """
+    Runs every stage of the benchmark.
+
+    Args:
+    work_dir (str): Directory for the fixtures and outputs
+    n_frames (int): Number of 10-minute frames
+    cpus (int): Number of workers of the pool run
+
+    Returns:
+    (dict): Configuration, stage results and peak memory
+    """
+    start = time.perf_counter()
+    tifs, times, latlon_pts = make_fixtures(work_dir, n_frames)
+    fixture_seconds = time.perf_counter() - start
+    out_dir = f'{work_dir}/out'
+    os.makedirs(out_dir, exist_ok=True)
+    mw_dir = f'{work_dir}/mw'
+    init_GOES_worker('DMV', latlon_pts, mw_dir, 8)
+    stages = {}
+
+    #########################################################################################################
+    # Startup: importing the scripts' modules, with no network calls and heavy dependencies loaded on first use
+    stages['import_process_GOES'] = summarize(time_import('process_GOES'), 0)
+    stages['import_GOES_download'] = summarize(time_import('GOES_download', path=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                                              '..', 'data-download')), 0)
+
+    #########################################################################################################
+    # Reading the GeoTIFFs
+    stages['tif_open_rioxarray'] = summarize(time_stage(lambda tif: rxr.open_rasterio(tif).load().close(), [(tif,) for tif in tifs]))
+    def read_rasterio(tif):
+        with rasterio.open(tif) as src:
+            src.read()
+    stages['tif_read_rasterio'] = summarize(time_stage(read_rasterio, [(tif,) for tif in tifs]))
+
+    #########################################################################################################
+    # Microwave LST: reading the daily city window from a file, then interpolating from the cached window
+    bbox = city_bbox(latlon_pts)
+    date_strs = sorted({f'{t[:4]}{t[5:7]}{t[8:10]}' for t in times})
+    # Each daily read serves every frame of the day
+    stages['mw_open_clip'] = summarize(time_stage(lambda d: MicrowaveStore(mw_dir).get_subcube(d, bbox), [(d,) for d in date_strs]),
+                                       n_frames/len(date_strs))
+    stages['mw_interpolate_frame'] = summarize(time_stage(lambda t: interpolate_mw_LST(to_utc_seconds(t), latlon_pts), [(t,) for t in times]))
+    stages['mw_interpolate_batch'] = summarize(time_stage(lambda ts: interpolate_mw_LST(to_utc_seconds(ts), latlon_pts), [(times,)]), n_frames)
+
+    #########################################################################################################
+    # Building the dataset and writing it
+    datasets = []
+    def build(tif, t):
+        datasets.append(build_GOES_dataset(tif, t, latlon_pts).load())
+    stages['build_dataset'] = summarize(time_stage(build, list(zip(tifs, times))))
+    stages['write_xarray'] = summarize(time_stage(lambda i: datasets[i].to_netcdf(f'{out_dir}/xarray_{i}.nc', format='NETCDF4', engine='h5netcdf'),
+                                                  [(i,) for i in range(n_frames)]))
+    writer = GOESFrameWriter(datasets[0])
+    data = [{var: ds[var].values for var in writer.data_vars} for ds in datasets]
+    stages['write_template'] = summarize(time_stage(lambda i: writer.write(f'{out_dir}/template_{i}.nc', times[i], data[i]),
+                                                    [(i,) for i in range(n_frames)]))
+    del datasets, data
+
+    #########################################################################################################
+    # Whole frames, one process, then a pool over every frame
+    stages['frame_xarray'] = summarize(time_stage(lambda tif, t, i: process_GOES_tif(tif, t, latlon_pts, f'{out_dir}/frame_xarray_{i}.nc'),
+                                                  [(tifs[i], times[i], i) for i in range(n_frames)]))
+    process_GOES.frame_writer = None
+    stages['frame_template'] = summarize(time_stage(lambda tif, t, i: process_GOES_frame(tif, t, f'{out_dir}/frame_template_{i}.nc'),
+                                                    [(tifs[i], times[i], i) for i in range(n_frames)]))
+
+    tasks = [((tifs[i], times[i]), (tifs[i], times[i], f'{out_dir}/pool_{i}.nc')) for i in range(n_frames)]
+    start = time.perf_counter()
+    failures = run_pool(process_GOES_frame, tasks, cpus, init_GOES_worker, ('DMV', latlon_pts, mw_dir, 8), report_every=np.inf)
+    pool_seconds = time.perf_counter() - start
+    stages[f'pool_{cpus}_workers'] = {'calls': 1, 'mean_ms': pool_seconds*1000, 'p95_ms': pool_seconds*1000,
+                                      'frames_per_s': (n_frames - len(failures))/pool_seconds}
+
+    return {'config': {'n_frames': n_frames, 'cpus': cpus, 'fixture_seconds': fixture_seconds,
+                       'date': datetime.datetime.now().isoformat(timespec='seconds')},
+            'stages': stages,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def print_table(results):
+    """
+    Prints the stage results as a table.
+
+    Args:
+    results (dict): Output of run_benchmark
+    """
+    print(f"{'stage':<24}{'calls':>8}{'mean ms':>12}{'p95 ms':>12}{'frames/s':>12}")
+    for stage, r in results['stages'].items():
+        print(f"{stage:<24}{r['calls']:>8}{r['mean_ms']:>12.2f}{r['p95_ms']:>12.2f}{r['frames_per_s']:>12.1f}")
+    print(f"Peak RSS: {results['peak_rss_mb']:.1f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    prog='benchmark_GOES',
+                    description='Stage-level benchmark of GOES processing on synthetic data')
+    parser.add_argument('--n_frames', nargs='?', type=int, default=144, help='Number of 10-minute frames to process')
+    parser.add_argument('--cpus', nargs='?', type=int, default=4, help='Number of workers of the pool run')
+    parser.add_argument('--work_dir', nargs='?', default=None, help='Directory for the fixtures and outputs (a temporary directory by default)')
+    parser.add_argument('--json', nargs='?', default=None, help='File to save the results to as JSON')
+    args = parser.parse_args()
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run_benchmark(args.work_dir, args.n_frames, args.cpus)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmark(work_dir, args.n_frames, args.cpus)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
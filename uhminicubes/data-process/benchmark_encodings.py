@@ -0,0 +1,270 @@
+import os
+import glob
+import time
+import json
+import tempfile
+import argparse
+import datetime
+import numpy as np
+import xarray as xr
+import rasterio
+import process_GOES
+from process_GOES import init_GOES_worker, process_GOES_frame, build_GOES_frame
+from process_Landsat import LANDSAT_SIZE, plan_blocks, init_Landsat_worker, process_Landsat_scene
+from goes_store import GOESStoreWriter, open_GOES_store
+from encoding_profiles import ENCODING_PROFILES, LANDSAT_CHUNKS, variable_encoding
+from benchmark_GOES import DMV_EXPORT, make_fixtures
+from synthetic_fixtures import write_Landsat_tif
+
+
+"""
+Round-trip accuracy check and storage/read report of the encoding profiles of
+encoding_profiles.py. A Landsat/Sentinel-1 scene and a day of GOES frames are
+processed with every profile through the writers of process_Landsat.py and
+process_GOES.py (per-frame files from the template and xarray writers, and the
+consolidated store), and each output is compared with the float64 output:
+
+    - the largest error of each variable, which must be within half the packing step
+      for int16 and float32 rounding for float32, with missing values in the same places
+    - bytes on disk and bytes saved
+    - read throughput of whole files, and of 32x32 tiles of the Landsat files as read
+      by the autoencoder
+
+Synthetic fixtures are used unless a real scene is given with --landsat_tif.
+
+Example:
+    python benchmark_encodings.py --n_frames=144 --json=encodings.json
+"""
+
+# Tiles read from each Landsat file for the tile throughput, and the tile size and offset of the autoencoder
+N_TILES = 200
+TILE_SIZE = 32
+TILE_OFFSET = 12
+
+
+def check_round_trip(reference, encoded):
+    """
+    Compares the data variables of an encoded file with the float64 file of the same data.
+
+    Args:
+    reference (xr.Dataset): Dataset of the float64 file
+    encoded (xr.Dataset): Dataset of the encoded file, opened with xarray so packed variables are unpacked
+
+    Returns:
+    (dict): {variable: {'max_error', 'tolerance', 'nan_mismatches', 'ok'}}
+    """
+    results = {}
+    for var in reference.data_vars:
+        if var == 'spatial_ref' or var not in encoded:
+            continue
+        ref = reference[var].values.astype(np.float64)
+        enc = encoded[var].values.astype(np.float64)
+        encoding = encoded[var].encoding
+        if 'scale_factor' in encoding:
+            # Half a packing step, plus the float64 rounding of the unpacking
+            tolerance = encoding['scale_factor']/2*(1 + 1e-6) + 1e-12*np.nanmax(np.abs(ref), initial=0)
+        elif encoding.get('dtype') == np.float32:
+            tolerance = float(np.finfo(np.float32).eps)*np.nanmax(np.abs(ref), initial=0)
+        else:
+            tolerance = 0.0
+        valid = ~np.isnan(ref)
+        max_error = float(np.max(np.abs(enc[valid] - ref[valid]), initial=0))
+        nan_mismatches = int(np.sum(np.isnan(enc) != np.isnan(ref)))
+        results[var] = {'max_error': max_error, 'tolerance': float(tolerance), 'nan_mismatches': nan_mismatches,
+                        'ok': bool(max_error <= tolerance and nan_mismatches == 0)}
+    return results
+
+
+def time_reads(paths, open_func=xr.open_dataset, n=3):
+    """
+    Times reading every data variable of files, decoded as xarray does.
+
+    Args:
+    paths (list): Locations of the files
+    open_func (function): Function that opens a file as an xarray dataset
+    n (int): Number of times the files are read, the fastest is kept
+
+    Returns:
+    (float): Decoded MB read per second
+    """
+    best = np.inf
+    for _ in range(n):
+        start = time.perf_counter()
+        n_bytes = 0
+        for path in paths:
+            with open_func(path) as ds:
+                n_bytes += ds.load().nbytes
+        best = min(best, time.perf_counter() - start)
+    return n_bytes/2**20/best
+
+
+def time_tile_reads(path, var='Landsat_LST', n_tiles=N_TILES, seed=0):
+    """
+    Times reading random 32x32 tiles of a variable of a Landsat file, on the tile grid of the autoencoder.
+
+    Args:
+    path (str): Location of the file
+    var (str): Variable to read tiles from
+    n_tiles (int): Number of tiles to read
+    seed (int): Random seed of the tiles
+
+    Returns:
+    (float): Tiles read per second
+    """
+    rng = np.random.default_rng(seed)
+    n = (LANDSAT_SIZE - TILE_OFFSET)//TILE_SIZE
+    corners = TILE_OFFSET + TILE_SIZE*rng.integers(0, n, (n_tiles, 2))
+    with xr.open_dataset(path) as ds:
+        start = time.perf_counter()
+        for i, j in corners:
+            ds[var][i:i+TILE_SIZE, j:j+TILE_SIZE].values
+        return n_tiles/(time.perf_counter() - start)
+
+
+def summarize_profile(ref_paths, paths, open_func=xr.open_dataset):
+    """
+    Args:
+    ref_paths (list): Locations of the float64 files
+    paths (list): Locations of the encoded files of the same data
+    open_func (function): Function that opens a file as an xarray dataset
+
+    Returns:
+    (dict): Bytes on disk, round-trip check of every variable, and whole-file read throughput
+    """
+    checks = {}
+    for ref_path, path in zip(ref_paths, paths):
+        with open_func(ref_path) as reference, open_func(path) as encoded:
+            for var, check in check_round_trip(reference, encoded).items():
+                if var not in checks or check['max_error'] > checks[var]['max_error'] or not check['ok']:
+                    checks[var] = check
+    return {'bytes': int(sum(os.path.getsize(path) for path in paths)),
+            'round_trip': checks,
+            'ok': all(check['ok'] for check in checks.values()),
+            'read_mb_per_s': time_reads(paths, open_func)}
+
+
+def run_benchmark(work_dir, n_frames, profiles, complevel=None, landsat_tif=None, max_memory=256):
+    """
+    Processes the fixtures with every profile and compares the outputs with the float64 outputs.
+
+    Args:
+    work_dir (str): Directory for the fixtures and outputs
+    n_frames (int): Number of 10-minute GOES frames
+    profiles (list): Encoding profiles to compare, from ENCODING_PROFILES
+    complevel (int, optional): gzip level 0-9, each profile's default if not given
+    landsat_tif (str, optional): Landsat/Sentinel-1 GeoTIFF to use instead of a synthetic scene
+    max_memory (float): Memory budget of the Landsat processing in MB
+
+    Returns:
+    (dict): Configuration and the results of each output and profile
+    """
+    profiles = ['float64'] + [profile for profile in profiles if profile != 'float64']
+    out_dir = f'{work_dir}/out'
+    os.makedirs(out_dir, exist_ok=True)
+    results = {'Landsat': {}, 'GOES_files': {}, 'GOES_xarray': {}, 'GOES_store': {}}
+
+    #########################################################################################################
+    # Landsat/Sentinel-1 scene, processed in blocks of whole chunk rows when the profile compresses
+    if not landsat_tif:
+        landsat_tif = f'{work_dir}/Landsat9_Sentinel_image_DMV_202206151546.tif'
+        if not os.path.exists(landsat_tif):
+            write_Landsat_tif(landsat_tif, DMV_EXPORT)
+    with rasterio.open(landsat_tif) as src:
+        n_bands, itemsize = src.count, np.dtype(src.dtypes[0]).itemsize
+    for profile in profiles:
+        chunked = variable_encoding('Landsat_LST', 'float64', profile, complevel).get('zlib', False)
+        init_Landsat_worker(*plan_blocks(max_memory, n_bands, itemsize, chunk_height=LANDSAT_CHUNKS[0] if chunked else None),
+                            profile, complevel)
+        fname = f'{out_dir}/Landsat_{profile}.nc'
+        start = time.perf_counter()
+        process_Landsat_scene(landsat_tif, '2022-06-15T15:46:00Z', fname, 'DMV')
+        results['Landsat'][profile] = dict(summarize_profile([f'{out_dir}/Landsat_float64.nc'], [fname]),
+                                           write_seconds=time.perf_counter() - start,
+                                           tiles_per_s=time_tile_reads(fname))
+
+    #########################################################################################################
+    # GOES frames, as per-frame files written with the template writer ('GOES_files') and with xarray
+    # ('GOES_xarray'), and as a consolidated store
+    tifs, times, latlon_pts = make_fixtures(work_dir, n_frames)
+    for profile in profiles:
+        for output, writer in [('GOES_files', 'template'), ('GOES_xarray', 'xarray')]:
+            process_GOES.frame_writer = None
+            init_GOES_worker('DMV', latlon_pts, f'{work_dir}/mw', 8, writer, profile, complevel)
+            fnames = [f'{out_dir}/GOES_{writer}_{profile}_{i}.nc' for i in range(n_frames)]
+            start = time.perf_counter()
+            for tif, t, fname in zip(tifs, times, fnames):
+                process_GOES_frame(tif, t, fname)
+            write_seconds = time.perf_counter() - start
+            results[output][profile] = dict(summarize_profile([f'{out_dir}/GOES_{writer}_float64_{i}.nc' for i in range(n_frames)],
+                                                              fnames), write_seconds=write_seconds)
+
+        store_dir = f'{out_dir}/store_{profile}'
+        os.makedirs(store_dir, exist_ok=True)
+        for path in glob.glob(f'{store_dir}/*.nc'):
+            os.remove(path)
+        writer = GOESStoreWriter(store_dir, 'KDCA', complevel=4 if complevel is None else complevel, encoding=profile)
+        start = time.perf_counter()
+        for tif, t in zip(tifs, times):
+            writer.append(build_GOES_frame(tif, t))
+        writer.close()
+        results['GOES_store'][profile] = dict(summarize_profile([f'{out_dir}/store_float64/lresgrid_KDCA.nc'],
+                                                                [f'{store_dir}/lresgrid_KDCA.nc'], open_GOES_store),
+                                              write_seconds=time.perf_counter() - start)
+
+    #########################################################################################################
+    # Bytes saved and read throughput change against float64
+    for output in results.values():
+        for profile, r in output.items():
+            r['bytes_saved'] = output['float64']['bytes'] - r['bytes']
+            r['read_speedup'] = r['read_mb_per_s']/output['float64']['read_mb_per_s']
+
+    return {'config': {'n_frames': n_frames, 'profiles': profiles, 'complevel': complevel, 'landsat_tif': landsat_tif,
+                       'date': datetime.datetime.now().isoformat(timespec='seconds')},
+            'results': results}
+
+
+def print_table(results):
+    """
+    Prints the results of each output and profile as a table, and the variables that failed the round-trip check.
+
+    Args:
+    results (dict): Output of run_benchmark
+    """
+    print(f"{'output':<12}{'profile':<10}{'MB':>10}{'saved':>8}{'write s':>10}{'read MB/s':>11}{'speedup':>9}{'tiles/s':>10}{'check':>7}")
+    for output, profiles in results['results'].items():
+        for profile, r in profiles.items():
+            tiles = f"{r['tiles_per_s']:.0f}" if 'tiles_per_s' in r else '-'
+            print(f"{output:<12}{profile:<10}{r['bytes']/2**20:>10.2f}{r['bytes_saved']/max(r['bytes'] + r['bytes_saved'], 1):>8.0%}"
+                  f"{r['write_seconds']:>10.2f}{r['read_mb_per_s']:>11.1f}{r['read_speedup']:>9.2f}{tiles:>10}"
+                  f"{'ok' if r['ok'] else 'FAIL':>7}")
+            for var, check in r['round_trip'].items():
+                if not check['ok']:
+                    print(f"    {var}: max error {check['max_error']:.3g} > {check['tolerance']:.3g}, "
+                          f"{check['nan_mismatches']} missing values moved")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    prog='benchmark_encodings',
+                    description='Round-trip check and storage/read report of the encoding profiles of the processed files')
+    parser.add_argument('--n_frames', nargs='?', type=int, default=144, help='Number of 10-minute GOES frames to process')
+    parser.add_argument('--profiles', nargs='?', default=','.join(ENCODING_PROFILES),
+                        help='Comma-separated encoding profiles to compare with float64')
+    parser.add_argument('--complevel', nargs='?', type=int, default=None, help="gzip level 0-9 (each profile's default if not given)")
+    parser.add_argument('--landsat_tif', nargs='?', default=None, help='Landsat/Sentinel-1 GeoTIFF to use instead of a synthetic scene')
+    parser.add_argument('--work_dir', nargs='?', default=None, help='Directory for the fixtures and outputs (a temporary directory by default)')
+    parser.add_argument('--json', nargs='?', default=None, help='File to save the results to as JSON')
+    args = parser.parse_args()
+
+    profiles = args.profiles.split(',')
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run_benchmark(args.work_dir, args.n_frames, profiles, args.complevel, args.landsat_tif)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmark(work_dir, args.n_frames, profiles, args.complevel, args.landsat_tif)
+
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,188 @@
+import numpy as np
+
+
+"""
+Storage encodings of the processed Landsat/Sentinel-1 and GOES files, shared by
+process_Landsat.py, process_GOES.py (both of its writers) and the consolidated
+GOES store. A profile sets the stored data type, packing, chunking and compression
+of every (y,x) data variable:
+
+    'float64'  Full precision and contiguous, the layout the processed files have always had
+    'float32'  float32 values, chunked and compressed
+    'int16'    int16 values packed with a CF scale_factor and add_offset, chunked and compressed.
+               Landsat reflectances and LST use the scale and offset of the Landsat Collection 2
+               integers they are made from, and the microwave LST the K*50 integers of its files,
+               so for those packing loses nothing. Other variables are stored at a step well
+               below the precision of the data (see PACKING)
+
+xarray unpacks scale_factor/add_offset and masks _FillValue when it opens a file, so
+readers get float values with NaN for missing data whatever the profile. The uint16
+Landsat_cloud_mask is never packed, only chunked and compressed.
+
+Example:
+    xarray_encoding(ds, 'int16')
+    ds.to_netcdf(fname, format='NETCDF4', engine='h5netcdf')
+"""
+
+ENCODING_PROFILES = ['float64', 'float32', 'int16']
+
+# gzip level of the profiles that compress, 0-9
+DEFAULT_COMPLEVEL = {'float64': 0, 'float32': 4, 'int16': 4}
+
+# Fill value of packed variables, so the other 65535 values are left for data
+PACKED_FILL = np.int16(-32768)
+
+# Landsat Collection 2 integers are stored as uint16 DN with value = DN*scale + offset.
+# Packed to int16 as DN - 32768, which keeps the same step and covers every DN above 0 (the Landsat fill)
+LANDSAT_REFLECTANCE_PACKING = (2.75e-5, -0.2 + 32768*2.75e-5)
+LANDSAT_LST_PACKING = (0.00341802, 149 + 32768*0.00341802)
+
+# (scale_factor, add_offset) of the int16 packing of each variable, value = packed*scale_factor + add_offset
+PACKING = {
+    'Landsat_blue_sfc_reflectance': LANDSAT_REFLECTANCE_PACKING,
+    'Landsat_green_sfc_reflectance': LANDSAT_REFLECTANCE_PACKING,
+    'Landsat_red_sfc_reflectance': LANDSAT_REFLECTANCE_PACKING,
+    'Landsat_NIR_sfc_reflectance': LANDSAT_REFLECTANCE_PACKING,
+    'Landsat_SWIR1_sfc_reflectance': LANDSAT_REFLECTANCE_PACKING,
+    'Landsat_SWIR2_sfc_reflectance': LANDSAT_REFLECTANCE_PACKING,
+    'Landsat_LST': LANDSAT_LST_PACKING,
+    # Backscatter in dB from -80.5 to 50.5 in steps of 0.002 dB
+    'Sentinel1_VV': (0.002, -15.0),
+    'Sentinel1_VH': (0.002, -15.0),
+    'Sentinel1_HH': (0.002, -15.0),
+    'Sentinel1_HV': (0.002, -15.0),
+    # Degrees from -20.5 to 110.5 in steps of 0.002
+    'Sentinel1_incidence_angle': (0.002, 45.0),
+    # Brightness temperatures from 86.2 to 413.8 K in steps of 0.005 K
+    'GOES_C13_LWIR': (0.005, 250.0),
+    'GOES_C14_LWIR': (0.005, 250.0),
+    'GOES_C15_LWIR': (0.005, 250.0),
+    'GOES_C16_LWIR': (0.005, 250.0),
+    # Microwave LST files store K*50
+    'microwave_LST': (0.02, 0.0),
+}
+
+# (y,x) chunk shape of the processed Landsat files. 250 divides the 3000x3000 export grid, so there are
+# no partial edge chunks and blocks of whole chunk rows line up whether rows are counted from the top or
+# the bottom. A 32x32 training tile of the autoencoder then decompresses one chunk most of the time
+LANDSAT_CHUNKS = (250, 250)
+
+
+def variable_encoding(var, dtype, profile='float64', complevel=None, chunks=None, tiled=False):
+    """
+    Args:
+    var (str): Variable name
+    dtype (str or np.dtype): Data type of the values before encoding
+    profile (str): Encoding profile from ENCODING_PROFILES
+    complevel (int, optional): gzip level 0-9, the profile's DEFAULT_COMPLEVEL by default
+    chunks (tuple, optional): Chunk shape, needed when the variable is compressed or tiled
+    tiled (boolean): Chunk the variable even if it is not compressed
+
+    Returns:
+    (dict): xarray encoding of the variable, empty for a plain float64 variable
+    """
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Please set profile to one of {', '.join(ENCODING_PROFILES)}, not {profile}.")
+    complevel = DEFAULT_COMPLEVEL[profile] if complevel is None else complevel
+    encoding = {}
+    if np.dtype(dtype).kind == 'f':
+        if profile == 'float32':
+            encoding = {'dtype': 'float32', '_FillValue': np.float32(np.nan)}
+        elif profile == 'int16' and var in PACKING:
+            encoding = {'dtype': 'int16', 'scale_factor': PACKING[var][0], 'add_offset': PACKING[var][1],
+                        '_FillValue': PACKED_FILL}
+    if complevel:
+        encoding.update({'zlib': True, 'complevel': complevel, 'shuffle': True})
+    if complevel or tiled:
+        encoding['chunksizes'] = chunks
+    return encoding
+
+
+def xarray_encoding(ds, profile='float64', complevel=None, chunks=None):
+    """
+    Sets the encodings of the (y,x) data variables of a processed dataset, which xarray.Dataset.to_netcdf
+    then writes with. They are added to the encodings the variables already have (e.g. the grid_mapping
+    set by rioxarray), and the 'missing_value' attribute of packed variables is dropped, since _FillValue
+    marks missing data.
+
+    Args:
+    ds (xr.Dataset): Processed dataset, changed in place
+    profile (str): Encoding profile from ENCODING_PROFILES
+    complevel (int, optional): gzip level 0-9, the profile's DEFAULT_COMPLEVEL by default
+    chunks (tuple, optional): (y,x) chunk shape, the whole grid by default
+
+    Returns:
+    (dict): {variable: encoding} of the encodings that were set
+    """
+    encodings = {}
+    for var in ds.data_vars:
+        if ds[var].dims != ('y', 'x'):
+            continue
+        encoding = variable_encoding(var, ds[var].dtype, profile, complevel, chunks if chunks else ds[var].shape)
+        if 'scale_factor' in encoding:
+            ds[var].attrs.pop('missing_value', None)
+        ds[var].encoding.update(encoding)
+        encodings[var] = encoding
+    return encodings
+
+
+def h5netcdf_variable_args(encoding, dtype):
+    """
+    Converts an encoding from variable_encoding to the arguments of h5netcdf's create_variable.
+
+    Args:
+    encoding (dict): Encoding of the variable
+    dtype (str or np.dtype): Data type of the values before encoding
+
+    Returns:
+    kwargs (dict): dtype, fillvalue, chunks and compression arguments of create_variable
+    attrs (dict): scale_factor and add_offset attributes of packed variables
+    """
+    kwargs = {'dtype': np.dtype(encoding.get('dtype', dtype))}
+    if '_FillValue' in encoding:
+        kwargs['fillvalue'] = encoding['_FillValue']
+    elif kwargs['dtype'].kind == 'f':
+        kwargs['fillvalue'] = np.nan
+    if encoding.get('chunksizes'):
+        kwargs['chunks'] = encoding['chunksizes']
+    if encoding.get('zlib'):
+        kwargs.update({'compression': 'gzip', 'compression_opts': encoding['complevel'], 'shuffle': encoding['shuffle']})
+    attrs = {k: encoding[k] for k in ['scale_factor', 'add_offset'] if k in encoding}
+    return kwargs, attrs
+
+
+def pack_values(values, encoding):
+    """
+    Packs values as xarray does when writing a variable with a scale_factor and add_offset.
+    Values of variables that are not packed are returned as they are.
+
+    Args:
+    values (float array): Values to write
+    encoding (dict): Encoding of the variable, from variable_encoding
+
+    Returns:
+    (array): Values to store
+    """
+    if 'scale_factor' not in encoding:
+        return values
+    packed = np.round((values - encoding['add_offset'])/encoding['scale_factor'])
+    # Values beyond the packed range are clipped so they cannot wrap around
+    packed = np.clip(packed, np.iinfo(np.int16).min + 1, np.iinfo(np.int16).max, out=packed)
+    return np.where(np.isnan(values), encoding['_FillValue'], packed).astype(np.int16)
+
+
+def unpack_values(values, attrs):
+    """
+    Unpacks values read without xarray's decoding, e.g. with h5netcdf or h5py.
+    Values of variables that are not packed are returned as they are.
+
+    Args:
+    values (array): Stored values
+    attrs (dict): Attributes of the variable
+
+    Returns:
+    (array): Values as xarray decodes them, NaN where there is no data
+    """
+    if 'scale_factor' not in attrs:
+        return values
+    return np.where(values == attrs.get('_FillValue', PACKED_FILL), np.nan, values*attrs['scale_factor'] + attrs['add_offset'])
@@ -0,0 +1,86 @@
+import os
+import json
+import numpy as np
+
+
+"""
+Calibration of GOES images downloaded as their native packed integers. The
+CMI_C13..C16 bands are stored as 12-bit integers with a scale and offset per
+band, so downloading the integers and calibrating them locally moves 2 bytes per
+pixel instead of the 8 of brightness temperatures calibrated on Earth Engine.
+
+The scale and offset of each band are saved in a small JSON sidecar per day next
+to the GeoTIFFs, GOES_scale_offset_{YYYYmmdd}.json, and read back once per day
+when the frames are processed.
+"""
+
+# Packed value of pixels without data
+GOES_FILL_VALUE = -1
+
+# Sidecars already read by this process
+scale_offset_cache = {}
+
+
+def scale_offset_path(tif_dir, date_str):
+    """
+    Args:
+    tif_dir (str): Directory of the GeoTIFFs
+    date_str (str): Date in format of 'YYYYmmdd'
+
+    Returns:
+    (str): Location of the scale/offset sidecar of the day
+    """
+    return f'{tif_dir}/GOES_scale_offset_{date_str}.json'
+
+
+def save_scale_offset(path, scales, offsets, source=None):
+    """
+    Writes a scale/offset sidecar, under a temporary name first so that a partial file is never read.
+
+    Args:
+    path (str): Location of the sidecar
+    scales (list): Scale of each band, in band order
+    offsets (list): Offset of each band, in band order
+    source (str, optional): Image the values were read from, kept for reference
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'scale': [float(s) for s in scales], 'offset': [float(o) for o in offsets], 'source': source}, f)
+    os.replace(tmp_path, path)
+
+
+def load_scale_offset(path):
+    """
+    Reads a scale/offset sidecar, keeping it in memory for the following frames of the day.
+
+    Args:
+    path (str): Location of the sidecar
+
+    Returns:
+    scales (float array): Scale of each band
+    offsets (float array): Offset of each band
+    """
+    if path not in scale_offset_cache:
+        if not os.path.exists(path):
+            raise Exception(f"No scale/offset sidecar at {path}. Please download the day's frames again with --native.")
+        with open(path) as f:
+            sidecar = json.load(f)
+        scale_offset_cache[path] = (np.array(sidecar['scale']), np.array(sidecar['offset']))
+    return scale_offset_cache[path]
+
+
+def calibrate_GOES_bands(bands, scales, offsets):
+    """
+    Converts packed GOES bands to brightness temperatures.
+
+    Args:
+    bands (int array): (b,y,x) Array of packed values
+    scales (float array): (b,) Scale of each band
+    offsets (float array): (b,) Offset of each band
+
+    Returns:
+    (float array): (b,y,x) Array of brightness temperatures in K, NaN where there is no data
+    """
+    calibrated = bands*np.asarray(scales, dtype=np.float64)[:, None, None] + np.asarray(offsets, dtype=np.float64)[:, None, None]
+    calibrated[bands == GOES_FILL_VALUE] = np.nan
+    return calibrated
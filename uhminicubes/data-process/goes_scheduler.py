@@ -0,0 +1,167 @@
+import time
+import csv
+import multiprocessing
+
+
+"""
+Worker pool scheduling for the processing scripts. Read-only state that is the
+same for every task (latitude/longitude grid, nearest-neighbour maps, microwave
+LST store) is set up once per worker by an initializer, so each task only sends
+its own small arguments. Tasks are streamed with imap_unordered, a failure of one
+file is recorded instead of stopping the pool, and throughput is printed as the
+pool runs.
+"""
+
+# Task function of this worker, set by _init_worker
+_worker_func = None
+
+
+def default_chunksize(n_tasks, n_workers):
+    """
+    Chooses how many tasks are sent to a worker at a time. Large enough to keep the
+    pool overhead low, small enough that the workers finish at about the same time.
+
+    Args:
+    n_tasks (int): Number of tasks
+    n_workers (int): Number of worker processes
+
+    Returns:
+    (int): Chunksize for Pool.imap_unordered
+    """
+    return max(1, min(64, n_tasks // (n_workers*8)))
+
+
+def _init_worker(func, initializer, initargs):
+    """
+    Sets the task function of a worker and runs the user initializer.
+
+    Args:
+    func (function): Function called with the arguments of each task
+    initializer (function or None): Function that sets up the shared worker state
+    initargs (tuple): Arguments of the initializer
+    """
+    global _worker_func
+    _worker_func = func
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _run_task(task):
+    """
+    Runs one task, catching any error so that one bad file does not stop the pool.
+
+    Args:
+    task (tuple): (key, args) where key identifies the task and args are the function arguments
+
+    Returns:
+    key: Key of the task
+    result: Return value of the task function, None if it failed
+    error (str or None): Error message if the task failed
+    seconds (float): Time taken by the task
+    """
+    key, args = task
+    start = time.perf_counter()
+    try:
+        return key, _worker_func(*args), None, time.perf_counter() - start
+    except Exception as e:
+        return key, None, f'{type(e).__name__}: {e}', time.perf_counter() - start
+
+
+class ThroughputReporter:
+    """
+    Counts finished tasks and prints the progress and frames/s at a fixed interval.
+    """
+    def __init__(self, n_tasks, report_every=60):
+        """
+        Args:
+        n_tasks (int): Total number of tasks
+        report_every (float): Seconds between progress messages
+        """
+        self.n_tasks = n_tasks
+        self.report_every = report_every
+        self.n_done = 0
+        self.n_failed = 0
+        self.start = time.perf_counter()
+        self._last_report = self.start
+
+    def update(self, failed=False):
+        """
+        Records a finished task, printing the progress if the interval has passed.
+
+        Args:
+        failed (boolean): Whether the task failed
+        """
+        self.n_done += 1
+        self.n_failed += failed
+        now = time.perf_counter()
+        if now - self._last_report >= self.report_every:
+            self._last_report = now
+            self.report()
+
+    def rate(self):
+        """
+        Returns:
+        (float): Finished tasks per second since the start
+        """
+        elapsed = time.perf_counter() - self.start
+        return self.n_done/elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        """
+        Prints the number of finished and failed tasks and the throughput.
+        """
+        rate = self.rate()
+        remaining = (self.n_tasks - self.n_done)/rate if rate > 0 else float('nan')
+        print(f'{self.n_done}/{self.n_tasks} frames done, {self.n_failed} failed, '
+              f'{rate:.2f} frames/s, ~{remaining/60:.1f} minutes remaining', flush=True)
+
+
+def run_pool(func, tasks, n_workers, initializer=None, initargs=(), chunksize=None, report_every=60, on_result=None):
+    """
+    Runs func over every task in a worker pool.
+
+    Args:
+    func (function): Module-level function called as func(*args) for each task
+    tasks (list): List of (key, args) tuples. The key identifies the task in the results and failures
+    n_workers (int): Number of worker processes
+    initializer (function, optional): Module-level function run once in each worker to set up shared state
+    initargs (tuple, optional): Arguments of the initializer
+    chunksize (int, optional): Tasks sent to a worker at a time. Chosen from the number of tasks if not given
+    report_every (float, optional): Seconds between progress messages
+    on_result (function, optional): Called as on_result(key, result, seconds) in this process for every successful
+                                    task, in the order the tasks finish. seconds is the time the task took in the worker
+
+    Returns:
+    (list): (key, error message) of every task that failed
+    """
+    if chunksize is None:
+        chunksize = default_chunksize(len(tasks), n_workers)
+    reporter = ThroughputReporter(len(tasks), report_every)
+    failures = []
+
+    with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(func, initializer, initargs)) as pool:
+        for key, result, error, seconds in pool.imap_unordered(_run_task, tasks, chunksize=chunksize):
+            if error is not None:
+                failures.append((key, error))
+                print(f'Failed {key}: {error}', flush=True)
+            elif on_result is not None:
+                on_result(key, result, seconds)
+            reporter.update(failed=error is not None)
+    reporter.report()
+    return failures
+
+
+def write_retry_list(path, failures):
+    """
+    Writes the failed tasks to a csv file so they can be rerun.
+
+    Args:
+    path (str): Location of the csv file
+    failures (list): (key, error message) of every failed task, where key is a tuple of strings
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['tif', 'time', 'error'])
+        for key, error in failures:
+            writer.writerow([*key, error])
+
@@ -0,0 +1,218 @@
+import os
+import glob
+import numpy as np
+import xarray as xr
+import h5netcdf
+from time_align import to_utc_seconds
+from grid_transform import register_latlon_accessor
+from encoding_profiles import variable_encoding, h5netcdf_variable_args, pack_values, PACKED_FILL
+
+
+"""
+Consolidated output for processed GOES frames. Instead of one netCDF file per
+10-minute frame, frames are appended to one netCDF4/HDF5 file per city (or per
+city and month) with an unlimited 'datetime' dimension.
+
+Appends are crash-safe: frames are buffered and written in batches, each batch
+opens the file only for the duration of the write, and the number of complete
+frames is recorded in the 'frames_committed' attribute after the batch is written.
+Frames beyond that count (from a job killed mid-write) are dropped the next time
+the file is appended to, and are ignored by open_GOES_store.
+"""
+
+DATETIME_UNITS = 'seconds since 1970-01-01 00:00:00'
+
+
+def open_GOES_store(path):
+    """
+    Opens a consolidated GOES file as an xarray dataset, sorted by time and
+    without any frames of an incomplete append.
+
+    Args:
+    path (str): Location of the consolidated file
+
+    Returns:
+    (xr.Dataset): Dataset with a 'datetime' dimension and the 'latlon' accessor of grid_transform.py
+    """
+    register_latlon_accessor()
+    ds = xr.open_dataset(path, engine='h5netcdf')
+    ds = ds.isel(datetime=slice(0, ds.attrs['frames_committed']))
+    return ds.sortby('datetime')
+
+
+class GOESStoreWriter:
+    """
+    Appends processed GOES frames to consolidated, time-chunked netCDF4/HDF5 files.
+    A single process should own the writer, so pool workers send their frames to it.
+    """
+    def __init__(self, out_dir, ICAO_code, period='city', time_chunk=144, complevel=4, batch_size=144, encoding='float64'):
+        """
+        Args:
+        out_dir (str): Directory where the consolidated files are stored
+        ICAO_code (str): ICAO code of the city, used in the file names
+        period (str): 'city' for one file per city, 'month' for one file per city and month
+        time_chunk (int): Number of frames per HDF5 chunk (144 frames is one day)
+        complevel (int): gzip compression level 0-9
+        batch_size (int): Number of buffered frames that triggers a write
+        encoding (str): Encoding profile of the data variables of new files, see encoding_profiles.py.
+                        Frames appended to an existing file are stored with the file's own encoding
+        """
+        if period != 'city' and period != 'month':
+            raise Exception("Please set period to ``city`` or ``month``.")
+        self.out_dir = out_dir
+        self.ICAO_code = ICAO_code
+        self.period = period
+        self.time_chunk = time_chunk
+        self.complevel = complevel
+        self.batch_size = batch_size
+        self.encoding = encoding
+        self._buffers = {}
+        self._times = {}
+
+    def store_path(self, time):
+        """
+        Args:
+        time (str): Frame datetime in format YYYY-MM-DDThh:mm:ssZ
+
+        Returns:
+        (str): Location of the consolidated file that the frame belongs to
+        """
+        if self.period == 'month':
+            return f'{self.out_dir}/lresgrid_{self.ICAO_code}_{time[:4]}{time[5:7]}.nc'
+        return f'{self.out_dir}/lresgrid_{self.ICAO_code}.nc'
+
+    def existing_times(self):
+        """
+        Returns:
+        (set): UTC seconds of every frame already committed to this city's consolidated files
+        """
+        # Per-frame files (lresgrid_{ICAO}_{YYYYmmddHHMM}.nc) in the same directory are not matched
+        paths = glob.glob(f'{self.out_dir}/lresgrid_{self.ICAO_code}.nc') + glob.glob(f'{self.out_dir}/lresgrid_{self.ICAO_code}_??????.nc')
+        times = set()
+        for path in paths:
+            times |= self._committed_times(path)
+        return times
+
+    def _committed_times(self, path):
+        """
+        Args:
+        path (str): Location of a consolidated file
+
+        Returns:
+        (set): UTC seconds of the committed frames of the file
+        """
+        if path not in self._times:
+            self._times[path] = set()
+            if os.path.exists(path):
+                with h5netcdf.File(path, 'r') as f:
+                    n = f.attrs['frames_committed']
+                    self._times[path] = set(f.variables['datetime'][:n].tolist())
+        return self._times[path]
+
+    def append(self, ds):
+        """
+        Buffers a processed frame and writes the buffer once it is full.
+        Frames that are already in the consolidated file or the buffer are skipped.
+
+        Args:
+        ds (xr.Dataset): Processed frame with a scalar 'datetime' coordinate, as produced by build_GOES_dataset
+        """
+        time = str(ds['datetime'].values)
+        path = self.store_path(time)
+        if to_utc_seconds(time)[0] in self._committed_times(path):
+            return
+        buffer = self._buffers.setdefault(path, [])
+        if any(str(frame['datetime'].values) == time for frame in buffer):
+            return
+
+        buffer.append(ds)
+        if len(buffer) >= self.batch_size:
+            self._write(path)
+
+    def flush(self):
+        """
+        Writes every buffered frame.
+        """
+        for path in list(self._buffers):
+            self._write(path)
+
+    def close(self):
+        """
+        Writes every buffered frame. The writer holds no open files, so nothing else needs closing.
+        """
+        self.flush()
+
+    def _create(self, f, ds):
+        """
+        Creates the dimensions, coordinates and variables of a new consolidated file from a frame.
+
+        Args:
+        f (h5netcdf.File): Newly created file
+        ds (xr.Dataset): Processed frame used as the template
+        """
+        f.dimensions = {'datetime': None, 'y': ds.sizes['y'], 'x': ds.sizes['x']}
+        f.attrs.update(ds.attrs)
+
+        for coord in ['y', 'x']:
+            v = f.create_variable(coord, (coord,), dtype=ds[coord].dtype)
+            v[:] = ds[coord].values
+            v.attrs.update(ds[coord].attrs)
+
+        v = f.create_variable('datetime', ('datetime',), dtype=np.int64, chunks=(self.time_chunk,))
+        v.attrs.update({'long_name': 'datetime', 'units': DATETIME_UNITS, 'calendar': 'standard'})
+
+        v = f.create_variable('spatial_ref', (), dtype=np.int64)
+        v[()] = 0
+        v.attrs.update(ds['spatial_ref'].attrs)
+
+        for var in ds.data_vars:
+            if var == 'spatial_ref':
+                continue
+            encoding = variable_encoding(var, ds[var].dtype, self.encoding, self.complevel,
+                                         (self.time_chunk, ds.sizes['y'], ds.sizes['x']))
+            kwargs, packing_attrs = h5netcdf_variable_args(encoding, ds[var].dtype)
+            # The datetime dimension is unlimited, so the variable is chunked even without compression
+            kwargs.setdefault('chunks', (self.time_chunk, ds.sizes['y'], ds.sizes['x']))
+            v = f.create_variable(var, ('datetime', 'y', 'x'), **kwargs)
+            # Missing values of packed variables are marked by _FillValue
+            v.attrs.update({k: val for k, val in ds[var].attrs.items()
+                            if k != '_FillValue' and not (packing_attrs and k == 'missing_value')})
+            v.attrs.update(packing_attrs)
+            v.attrs['grid_mapping'] = 'spatial_ref'
+        f.attrs['frames_committed'] = 0
+
+    def _write(self, path):
+        """
+        Appends the buffered frames of a consolidated file in time order.
+
+        Args:
+        path (str): Location of the consolidated file
+        """
+        frames = self._buffers.pop(path, [])
+        if not frames:
+            return
+        times = to_utc_seconds([str(ds['datetime'].values) for ds in frames])
+        order = np.argsort(times)
+
+        with h5netcdf.File(path, 'a') as f:
+            if 'datetime' not in f.variables:
+                self._create(f, frames[0])
+
+            # Drop frames of an append that did not finish
+            n = int(f.attrs['frames_committed'])
+            f.resize_dimension('datetime', n + len(frames))
+
+            for var in f.variables:
+                v = f.variables[var]
+                if v.dimensions == ('datetime', 'y', 'x'):
+                    packing = {k: v.attrs[k] for k in ['scale_factor', 'add_offset'] if k in v.attrs}
+                    if packing:
+                        packing['_FillValue'] = v.attrs.get('_FillValue', PACKED_FILL)
+                    v[n:] = pack_values(np.stack([frames[i][var].values for i in order]), packing)
+            f.variables['datetime'][n:] = times[order]
+
+            # Only mark the frames as complete once all of their data is written
+            f.flush()
+            f.attrs['frames_committed'] = n + len(frames)
+
+        self._committed_times(path).update(times.tolist())
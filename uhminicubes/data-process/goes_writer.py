@@ -0,0 +1,96 @@
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from encoding_profiles import pack_values
+
+
+"""
+Fast writer for the per-frame processed GOES netCDF files. Every frame of a city
+has the same dimensions, coordinates, attributes and encodings, and only the data
+arrays and the datetime change. The first frame is written once with xarray to make
+a template file, which is copied without the data arrays. Each following frame is
+written by copying the template bytes and filling in the data arrays and datetime
+through h5py, which gives the same netCDF file as xarray.Dataset.to_netcdf without
+building a dataset for every frame. The data arrays of the template have no stored
+chunks, so compressed chunks are written once into fresh space rather than
+overwriting (and leaking the space of) the chunks of the template.
+"""
+
+
+def copy_without_data(src, dst, data_vars):
+    """
+    Copies a netCDF file, keeping every dimension, attribute, encoding and the values
+    of all variables but the data variables, which are left unallocated.
+
+    Args:
+    src (str): Location of the file written by xarray
+    dst (str): Location of the copy
+    data_vars (list): Variables whose values are not copied
+    """
+    import h5netcdf
+    with h5netcdf.File(src, 'r') as f_src, h5netcdf.File(dst, 'w') as f_dst:
+        f_dst.dimensions = {dim: f_src.dimensions[dim].size for dim in f_src.dimensions}
+        f_dst.attrs.update(f_src.attrs)
+        for var, v_src in f_src.variables.items():
+            kwargs = {'dtype': v_src.dtype, 'chunks': v_src.chunks, 'compression': v_src.compression,
+                      'compression_opts': v_src.compression_opts, 'shuffle': v_src.shuffle}
+            if '_FillValue' in v_src.attrs:
+                kwargs['fillvalue'] = np.ravel(v_src.attrs['_FillValue'])[0]
+            v = f_dst.create_variable(var, v_src.dimensions, **kwargs)
+            if var not in data_vars:
+                v[...] = v_src[...]
+            v.attrs.update({k: val for k, val in v_src.attrs.items() if k != '_FillValue'})
+
+
+class GOESFrameWriter:
+    """
+    Writes processed GOES frames by filling in a per-city template file.
+    """
+    def __init__(self, template_ds, encoding=None):
+        """
+        Args:
+        template_ds (xr.Dataset): A processed frame, as produced by build_GOES_dataset. Its
+                                  structure, metadata and encodings are used for every frame that is written
+        encoding (dict, optional): {variable: encoding} set on template_ds by encoding_profiles.xarray_encoding.
+                                   Packed variables are packed by the writer before they are written
+        """
+        self.encoding = encoding if encoding else {}
+        self.data_vars = [var for var in template_ds.data_vars if template_ds[var].dims == ('y', 'x')]
+
+        # Write the template once with xarray, copy it without the data arrays and keep its bytes in memory
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            template_ds.to_netcdf(f'{tmp_dir}/frame.nc', format='NETCDF4', engine='h5netcdf')
+            copy_without_data(f'{tmp_dir}/frame.nc', f'{tmp_dir}/template.nc', self.data_vars)
+            with open(f'{tmp_dir}/template.nc', 'rb') as f:
+                self.template = f.read()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def write(self, fname, time_str, data):
+        """
+        Writes a frame. The file is written to a temporary name first so that a partial
+        file is never left at fname.
+
+        Args:
+        fname (str): Full path of where to store the file, including a filename ending in '.nc'
+        time_str (str): Date and time of the frame in format YYYY-MM-DDThh:mm:ssZ
+        data (dict): (y,x) array of each data variable, with y increasing with index
+
+        Returns:
+        (float): Seconds taken to write the file
+        """
+        import h5py
+        start = time.perf_counter()
+        tmp_fname = f'{fname}.{os.getpid()}.tmp'
+        with open(tmp_fname, 'wb') as f:
+            f.write(self.template)
+        with h5py.File(tmp_fname, 'r+') as f:
+            for var in self.data_vars:
+                f[var][...] = pack_values(data[var], self.encoding.get(var, {}))
+            f['datetime'][()] = time_str
+        os.replace(tmp_fname, fname)
+
+        return time.perf_counter() - start
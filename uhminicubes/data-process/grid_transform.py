@@ -0,0 +1,302 @@
+import os
+import numpy as np
+from collections import OrderedDict
+
+
+"""
+Conversion of the UTM export grids to latitude and longitude coordinates.
+Whole grids are reprojected with a single batched pyproj call, and the
+result can be cached per city and modality so that processing jobs and
+notebooks load the grid instead of recomputing it.
+
+LatLonProvider computes the coordinates of any window or set of points of a
+grid from its definition (affine transform and EPSG code) when they are needed,
+instead of storing a (3000,3000,2) array per city. Loaders register it as the
+'latlon' accessor of their datasets:
+
+Example:
+    ds = open_Landsat(path)
+    latlon_pts = ds.latlon.window(row=12, col=12, height=32, width=32)
+"""
+
+# Transformers are expensive to create, so keep one per CRS
+_transformers = {}
+
+
+def utm_crs(city_zone):
+    """
+    Returns the EPSG code of a city's UTM zone.
+
+    Args:
+    city_zone (list): [utm zone, T/F Northern Hemisphere]
+
+    Returns:
+    (str): EPSG code in the format 'EPSG:326XX' or 'EPSG:327XX'
+    """
+    if city_zone[1]:
+        crs_prefix = '326' # Northern hemisphere
+    else:
+        crs_prefix = '327' # Southern hemisphere
+    return f'EPSG:{crs_prefix}{city_zone[0]}'
+
+
+def get_transformer(crs):
+    """
+    Returns a (cached) transformer from a UTM CRS to longitude/latitude.
+
+    Args:
+    crs (str): EPSG code of the UTM zone, e.g. 'EPSG:32618'
+
+    Returns:
+    (pyproj.Transformer): Transformer with (x, y) -> (longitude, latitude) axis order
+    """
+    if crs not in _transformers:
+        # Imported on first use, most jobs load cached grids and never transform
+        from pyproj import Transformer
+        _transformers[crs] = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True)
+    return _transformers[crs]
+
+
+def grid_to_latlon(x, y, crs):
+    """
+    Reprojects every point of a UTM grid to longitude and latitude
+    in one batched transform.
+
+    Args:
+    x (float array): UTM eastings of the grid columns
+    y (float array): UTM northings of the grid rows
+    crs (str): EPSG code of the UTM zone, e.g. 'EPSG:32618'
+
+    Returns:
+    (float array): (len(y), len(x), 2) array of (longitude, latitude) points. The layout
+                   matches reshaping the output of the per-point stacked_to_latlon function.
+    """
+    xx, yy = np.meshgrid(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    lon, lat = get_transformer(crs).transform(xx, yy)
+    return np.stack((lon, lat), axis=-1)
+
+
+def latlon_cache_path(cache_dir, city, modality, crs, x, y):
+    """
+    Returns the cache file location for a grid. The name is keyed by the CRS,
+    grid origin and grid shape, so a grid with a flipped axis or a different
+    export window never reuses a stale cache file.
+
+    Args:
+    cache_dir (str): Directory where cached grids are stored
+    city (str): City name from the list of valid cities
+    modality (str): 'GOES' or 'Landsat'
+    crs (str): EPSG code of the UTM zone
+    x (float array): UTM eastings of the grid columns
+    y (float array): UTM northings of the grid rows
+
+    Returns:
+    (str): Full path of the cache file
+    """
+    epsg = crs.split(':')[-1]
+    return f'{cache_dir}/{city}_{modality}_latlons_{epsg}_{int(round(x[0]))}_{int(round(y[0]))}_{len(y)}x{len(x)}.npy'
+
+
+def load_city_latlons(city, modality, x, y, crs, cache_dir):
+    """
+    Loads the (longitude, latitude) grid for a city and modality from the cache,
+    computing and caching it as float32 if it does not exist yet.
+
+    Args:
+    city (str): City name from the list of valid cities
+    modality (str): 'GOES' or 'Landsat'
+    x (float array): UTM eastings of the grid columns
+    y (float array): UTM northings of the grid rows
+    crs (str): EPSG code of the UTM zone
+    cache_dir (str): Directory where cached grids are stored
+
+    Returns:
+    (float array): (len(y), len(x), 2) array of (longitude, latitude) points
+    """
+    fname = latlon_cache_path(cache_dir, city, modality, crs, x, y)
+    if os.path.exists(fname):
+        return np.load(fname).astype(np.float64)
+
+    latlon_pts = grid_to_latlon(x, y, crs).astype(np.float32)
+
+    # Write to a temporary file first so that parallel jobs never read a partial cache file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        np.save(f, latlon_pts)
+    os.replace(tmp_fname, fname)
+
+    return latlon_pts.astype(np.float64)
+
+
+def crs_from_attrs(attrs):
+    """
+    Args:
+    attrs (dict): Attributes of a 'spatial_ref' grid mapping, as set by rioxarray
+
+    Returns:
+    (str): EPSG code of the grid mapping, e.g. 'EPSG:32618'
+    """
+    from pyproj import CRS
+    return f"EPSG:{CRS.from_wkt(attrs['crs_wkt']).to_epsg()}"
+
+
+class LatLonProvider:
+    """
+    Longitude and latitude of the points of a UTM grid, computed from the grid
+    definition when they are needed. Only the 1D UTM coordinates of the grid are kept,
+    so a 3000x3000 Landsat grid takes 48 kB instead of 144 MB. Windows are reprojected
+    with one batched transform and the last few are kept in memory, since notebooks and
+    training loops tend to ask for the same windows again.
+
+    The points are transformed as grid_to_latlon transforms them, so the values are
+    bit-identical to its output and to the float64 {city}_{modality}_latlons.nc files of
+    the same grid. The load_city_latlons caches are float32, and match only once the
+    values are rounded to float32.
+    """
+    def __init__(self, x, y, crs, max_entries=4):
+        """
+        Args:
+        x (float array): UTM eastings of the grid columns
+        y (float array): UTM northings of the grid rows, in the order the rows are stored
+        crs (str): EPSG code of the UTM zone, e.g. 'EPSG:32618'
+        max_entries (int): Largest number of windows to keep in memory
+        """
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.crs = crs
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+
+    @classmethod
+    def from_transform(cls, geo_transform, width, height, crs, flip_y=False, max_entries=4):
+        """
+        Makes the provider of a grid from its affine transform. The pixel centers are
+        computed in the same way as rioxarray computes the 'x' and 'y' coordinates of
+        a GeoTIFF, so they are identical to the coordinates of the exported files.
+
+        Args:
+        geo_transform (str or list): GDAL GeoTransform of the grid, e.g. the 'GeoTransform' attribute of 'spatial_ref'
+        width (int): Number of columns of the grid
+        height (int): Number of rows of the grid
+        crs (str): EPSG code of the UTM zone, e.g. 'EPSG:32618'
+        flip_y (boolean): Whether rows are stored bottom-up, as in the processed files (latitude increasing with index)
+        max_entries (int): Largest number of windows to keep in memory
+
+        Returns:
+        (LatLonProvider): Provider of the grid
+        """
+        if isinstance(geo_transform, str):
+            geo_transform = [float(value) for value in geo_transform.split()]
+        c, a, b, f, d, e = geo_transform
+        # Same operations as affine * Affine.translation(0.5, 0.5) applied to the pixel indices
+        x = np.arange(width)*a + np.zeros(width)*b + (a*0.5 + b*0.5 + c)
+        y = np.zeros(height)*d + np.arange(height)*e + (d*0.5 + e*0.5 + f)
+        return cls(x, y[::-1] if flip_y else y, crs, max_entries)
+
+    @classmethod
+    def from_dataset(cls, ds, crs=None, max_entries=4):
+        """
+        Makes the provider of the grid of a dataset, e.g. a processed Landsat/Sentinel-1 or GOES
+        file or a window of one.
+
+        Args:
+        ds (xr.Dataset): Dataset with 'x' and 'y' coordinates
+        crs (str, optional): EPSG code of the UTM zone, read from the 'spatial_ref' grid mapping by default
+        max_entries (int): Largest number of windows to keep in memory
+
+        Returns:
+        (LatLonProvider): Provider of the grid, with rows in the order of the dataset
+        """
+        if crs is None:
+            crs = crs_from_attrs(ds['spatial_ref'].attrs)
+        return cls(ds['x'].values, ds['y'].values, crs, max_entries)
+
+    @property
+    def shape(self):
+        """
+        (tuple): (rows, columns) of the grid
+        """
+        return (len(self.y), len(self.x))
+
+    def window(self, row=0, col=0, height=None, width=None):
+        """
+        Args:
+        row (int): First row of the window
+        col (int): First column of the window
+        height (int, optional): Number of rows, up to the last row by default
+        width (int, optional): Number of columns, up to the last column by default
+
+        Returns:
+        (float array): Read-only (height, width, 2) array of (longitude, latitude) points
+        """
+        height = self.shape[0] - row if height is None else height
+        width = self.shape[1] - col if width is None else width
+        key = (row, col, height, width)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        latlon_pts = grid_to_latlon(self.x[col:col + width], self.y[row:row + height], self.crs)
+        latlon_pts.flags.writeable = False
+
+        self._cache[key] = latlon_pts
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return latlon_pts
+
+    def grid(self):
+        """
+        Returns:
+        (float array): Read-only (rows, columns, 2) array of (longitude, latitude) points of the whole grid
+        """
+        return self.window()
+
+    def points(self, rows, cols):
+        """
+        Args:
+        rows (int array): Row index of each point
+        cols (int array): Column index of each point
+
+        Returns:
+        (float array): (..., 2) array of (longitude, latitude) points, in the shape of rows and cols
+        """
+        lon, lat = get_transformer(self.crs).transform(self.x[np.asarray(cols)], self.y[np.asarray(rows)])
+        return np.stack((lon, lat), axis=-1)
+
+    def dataarray(self, row=0, col=0, height=None, width=None):
+        """
+        Args:
+        row (int): First row of the window
+        col (int): First column of the window
+        height (int, optional): Number of rows, up to the last row by default
+        width (int, optional): Number of columns, up to the last column by default
+
+        Returns:
+        (xr.DataArray): Points of the window in the layout of the {city}_{modality}_latlons.nc files
+        """
+        import xarray as xr
+        return xr.DataArray(self.window(row, col, height, width), dims=['longitude', 'latitude', 'latlon_pts'])
+
+
+class LatLonAccessor(LatLonProvider):
+    """
+    'latlon' accessor of xarray datasets, e.g. ds.latlon.grid(). The grid is that of
+    the dataset, so the points of a window follow the window that was read.
+    """
+    def __init__(self, ds):
+        """
+        Args:
+        ds (xr.Dataset): Dataset with 'x' and 'y' coordinates and a 'spatial_ref' grid mapping
+        """
+        super().__init__(ds['x'].values, ds['y'].values, crs_from_attrs(ds['spatial_ref'].attrs))
+
+
+def register_latlon_accessor():
+    """
+    Registers LatLonAccessor as the 'latlon' accessor of xarray datasets. Loaders call it
+    when they open a file, so xarray is only imported by the jobs that use it.
+    """
+    import xarray as xr
+    if not hasattr(xr.Dataset, 'latlon'):
+        xr.register_dataset_accessor('latlon')(LatLonAccessor)
@@ -0,0 +1,240 @@
+# Imported on first use: xarray and h5netcdf
+import numpy as np
+from grid_transform import register_latlon_accessor
+
+
+"""
+Window and overview reads of processed Landsat/Sentinel-1 files. Files written
+with process_Landsat.py --layout=tiled store every band in 250x250 chunks with
+reduced-resolution overviews in the groups 'overview_{factor}', so a window
+only decompresses the chunks it touches and a thumbnail is read from a small
+overview instead of the 3000x3000 bands.
+
+The same functions read the older contiguous files. Overviews missing from a
+file are made on the fly from the full-resolution window, in the same way
+process_Landsat.py makes the stored ones, so callers do not need to know which
+layout a file has. Datasets read here have the 'latlon' accessor of
+grid_transform.py, which gives the coordinates of the window or overview read.
+
+Example:
+    with LandsatReader(path) as reader:
+        ds = reader.read(['Landsat_LST'], window=(12, 12, 64, 64))
+        thumbnail = reader.read(['Landsat_LST'], overview=8)
+        latlon_pts = thumbnail.latlon.grid()
+"""
+
+
+def coarsen_Landsat(var, values, factor):
+    """
+    Reduces the resolution of a band by an integer factor. Bands are averaged over each
+    factor x factor block, ignoring missing values, and the cloud mask takes the pixel
+    nearest the center of each block since its bits cannot be averaged.
+
+    Args:
+    var (str): Variable name of the band
+    values (array): (y,x) Values of the band, with y and x multiples of factor
+    factor (int): Reduction factor
+
+    Returns:
+    (array): (y/factor,x/factor) Values at the reduced resolution
+    """
+    if var == 'Landsat_cloud_mask':
+        return values[factor//2::factor, factor//2::factor]
+    blocks = values.reshape(values.shape[0]//factor, factor, values.shape[1]//factor, factor)
+    counts = np.sum(~np.isnan(blocks), axis=(1, 3))
+    sums = np.nansum(blocks, axis=(1, 3))
+    # Blocks without any data stay missing
+    return np.divide(sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0)
+
+
+def coarsen_spatial_ref(attrs, factor):
+    """
+    Args:
+    attrs (dict): Attributes of the full-resolution 'spatial_ref' grid mapping, as set by rioxarray
+    factor (int): Reduction factor
+
+    Returns:
+    (dict): Attributes of the grid mapping of the overview, whose pixels are factor times larger
+    """
+    geo_transform = np.array(attrs['GeoTransform'].split(), dtype=np.float64)*[1, factor, factor, 1, factor, factor]
+    return dict(attrs, GeoTransform=' '.join(str(value) for value in geo_transform))
+
+
+def get_overview_factors(path):
+    """
+    Args:
+    path (str): Location of a processed Landsat/Sentinel-1 file
+
+    Returns:
+    (list): Reduction factors of the overviews stored in the file, empty for contiguous files
+    """
+    import h5netcdf
+    with h5netcdf.File(path, 'r') as f:
+        return sorted(int(name.split('_')[-1]) for name in f.groups if name.startswith('overview_'))
+
+
+def open_Landsat(path, overview=None):
+    """
+    Opens a processed Landsat/Sentinel-1 file, or one of its stored overviews, without reading any band.
+
+    Args:
+    path (str): Location of the file
+    overview (int, optional): Reduction factor of a stored overview, the full resolution by default
+
+    Returns:
+    (xr.Dataset): Lazily loaded dataset. Overviews also get the 'datetime' and file attributes of the scene
+    """
+    import xarray as xr
+    register_latlon_accessor()
+    if not overview:
+        return xr.open_dataset(path, engine='h5netcdf')
+    if overview not in get_overview_factors(path):
+        raise ValueError(f'{path} has no overview at factor {overview}')
+    with xr.open_dataset(path, engine='h5netcdf') as root:
+        datetime = root['datetime'].load()
+        attrs = root.attrs
+    ds = xr.open_dataset(path, engine='h5netcdf', group=f'overview_{overview}').assign_coords(datetime=datetime)
+    return ds.assign_attrs(attrs)
+
+
+class LandsatReader:
+    """
+    Reads windows, overviews and tiles of a processed Landsat/Sentinel-1 file. Opening a
+    file with xarray takes far longer than reading a small window of a tiled file, so the
+    levels of the file are opened once and kept open for every read.
+    """
+    def __init__(self, path):
+        """
+        Args:
+        path (str): Location of the file
+        """
+        self.path = path
+        self.overview_factors = get_overview_factors(path)
+        self._levels = {}
+
+    def level(self, overview=None):
+        """
+        Args:
+        overview (int, optional): Reduction factor of a stored overview, the full resolution by default
+
+        Returns:
+        (xr.Dataset): Lazily loaded dataset of the level, opened the first time it is used
+        """
+        if overview not in self._levels:
+            self._levels[overview] = open_Landsat(self.path, overview)
+        return self._levels[overview]
+
+    def read(self, variables=None, window=None, overview=None):
+        """
+        Reads a window of some bands, at full resolution or from an overview. Only the
+        chunks of tiled files that the window touches are read.
+
+        Args:
+        variables (list, optional): Bands to read, every band by default. The 'spatial_ref' grid mapping is always read
+        window (tuple, optional): (row, col, height, width) of the window in pixels of the level read, with rows in
+                                  the order they are stored (latitude increasing with index). The whole level by default
+        overview (int, optional): Reduction factor to read at. A stored overview is used if the file has one,
+                                  otherwise the full-resolution window is read and coarsened with coarsen_Landsat
+
+        Returns:
+        (xr.Dataset): Loaded dataset of the window
+        """
+        import xarray as xr
+        stored = overview in self.overview_factors if overview else True
+        factor = 1 if stored else overview
+
+        ds = self.level(overview if stored else None)
+        if variables is not None:
+            # The grid mapping is kept with the bands so the window has its coordinates
+            ds = ds[list(variables) + [var for var in ['spatial_ref'] if var in ds and var not in variables]]
+        if window:
+            row, col, height, width = window
+            ds = ds.isel(y=slice(row*factor, (row + height)*factor), x=slice(col*factor, (col + width)*factor))
+        ds = ds.load()
+        if stored:
+            return ds
+
+        #########################################################################################################
+        # Overview made on the fly from the full-resolution window
+        coarse = xr.Dataset(coords={'y': ds['y'].values.reshape(-1, factor).mean(axis=1),
+                                    'x': ds['x'].values.reshape(-1, factor).mean(axis=1),
+                                    'datetime': ds['datetime']}, attrs=ds.attrs)
+        for var in ds.data_vars:
+            if var == 'spatial_ref':
+                coarse[var] = ((), ds[var].values, coarsen_spatial_ref(ds[var].attrs, factor))
+            elif ds[var].dims == ('y', 'x'):
+                coarse[var] = (('y', 'x'), coarsen_Landsat(var, ds[var].values, factor), ds[var].attrs)
+        for coord in ['y', 'x']:
+            coarse[coord].attrs = ds[coord].attrs
+        return coarse
+
+    def tiles(self, var, tile_size, offset=0, n_tiles=None):
+        """
+        Reads a band as a grid of square tiles, reading only the window the tiles cover.
+
+        Args:
+        var (str): Band to read
+        tile_size (int): Width and height of the tiles in pixels
+        offset (int): Row and column of the first tile
+        n_tiles (int, optional): Number of tiles along each dimension, as many as fit by default
+
+        Returns:
+        (array): (n_tiles,n_tiles,tile_size,tile_size) Tiles, [i,j] starting at row offset + i*tile_size
+                 and column offset + j*tile_size
+        """
+        band = self.level()[var]
+        if n_tiles is None:
+            n_tiles = (min(band.shape) - offset)//tile_size
+        end = offset + n_tiles*tile_size
+        values = band[offset:end, offset:end].values
+        return values.reshape(n_tiles, tile_size, n_tiles, tile_size).swapaxes(1, 2)
+
+    def close(self):
+        """
+        Closes every opened level of the file.
+        """
+        for ds in self._levels.values():
+            ds.close()
+        self._levels = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_Landsat_window(path, variables=None, window=None, overview=None):
+    """
+    Reads a single window of a processed Landsat/Sentinel-1 file, see LandsatReader.read.
+    Use a LandsatReader to read several windows of the same file.
+
+    Args:
+    path (str): Location of the file
+    variables (list, optional): Bands to read, every band by default
+    window (tuple, optional): (row, col, height, width) of the window in pixels of the level read
+    overview (int, optional): Reduction factor to read at
+
+    Returns:
+    (xr.Dataset): Loaded dataset of the window
+    """
+    with LandsatReader(path) as reader:
+        return reader.read(variables, window, overview)
+
+
+def read_Landsat_tiles(path, var, tile_size, offset=0, n_tiles=None):
+    """
+    Reads a band of a processed Landsat/Sentinel-1 file as a grid of square tiles, see LandsatReader.tiles.
+
+    Args:
+    path (str): Location of the file
+    var (str): Band to read
+    tile_size (int): Width and height of the tiles in pixels
+    offset (int): Row and column of the first tile
+    n_tiles (int, optional): Number of tiles along each dimension, as many as fit by default
+
+    Returns:
+    (array): (n_tiles,n_tiles,tile_size,tile_size) Tiles
+    """
+    with LandsatReader(path) as reader:
+        return reader.tiles(var, tile_size, offset, n_tiles)
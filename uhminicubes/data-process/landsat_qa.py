@@ -0,0 +1,156 @@
+import numpy as np
+
+
+"""
+Decoding of the Landsat Collection 2 QA_PIXEL band (Landsat_cloud_mask in the
+processed files). Each pixel is a 16-bit integer of single-bit flags and 2-bit
+confidence fields, so the whole band is decoded with a few NumPy shifts and
+masks instead of turning every pixel into a binary string.
+
+The mask is stored as uint16, 2 bytes per pixel, with the bit definitions in its
+'bitmask_key' attribute. Boolean planes of single flags (e.g. cloud, water) can
+also be stored bit-packed, 1 bit per pixel, with pack_qa_planes.
+"""
+
+# Bit of each single-bit flag
+QA_FLAGS = {'fill': 0, 'dilated_cloud': 1, 'cirrus': 2, 'cloud': 3, 'cloud_shadow': 4,
+            'snow': 5, 'clear': 6, 'water': 7}
+
+# Lowest bit of each 2-bit confidence field. Values are 0: None, 1: Low, 2: Medium, 3: High
+QA_CONFIDENCES = {'cloud_confidence': 8, 'cloud_shadow_confidence': 10, 'snow_ice_confidence': 12,
+                  'cirrus_confidence': 14}
+
+# Stored in the 'bitmask_key' attribute of the mask
+QA_BITMASK_KEY = \
+"Bit 0: Fill\n\
+Bit 1: Dilated Cloud\n\
+Bit 2: Cirrus (high confidence)\n\
+Bit 3: Cloud\n\
+Bit 4: Cloud Shadow\n\
+Bit 5: Snow\n\
+Bit 6: Clear\n\t0: Cloud or Dilated Cloud bits are set\n\t1: Cloud and Dilated Cloud bits are not set\n\
+Bit 7: Water\n\
+Bits 8-9: Cloud Confidence\n\t0: None\n\t1: Low\n\t2: Medium\n\t3: High\n\
+Bits 10-11: Cloud Shadow Confidence\n\t0: None\n\t1: Low\n\t2: Medium\n\t3: High\n\
+Bits 12-13: Snow/Ice Confidence\n\t0: None\n\t1: Low\n\t2: Medium\n\t3: High\n\
+Bits 14-15: Cirrus Confidence\n\t0: None\n\t1: Low\n\t2: Medium\n\t3: High"
+
+
+def to_qa_mask(qa):
+    """
+    Converts a QA_PIXEL band to a uint16 mask. Pixels without data (NaN) get only the
+    fill bit set, which is what Landsat uses for fill pixels.
+
+    Masks of older processed files, stored as binary strings, are also accepted.
+
+    Args:
+    qa (array): QA_PIXEL values as floats (as read by rioxarray), integers or binary strings
+
+    Returns:
+    (uint16 array): Mask of the same shape
+    """
+    qa = np.asarray(qa)
+    if qa.dtype == np.uint16:
+        return qa
+    if qa.dtype.kind in 'OUS':
+        # Pixels without data were stored as NaN or 'nan'
+        return np.vectorize(lambda s: int(s, 2) if isinstance(s, str) and s.isdigit() else 1 << QA_FLAGS['fill'],
+                            otypes=[np.uint16])(qa)
+    if qa.dtype.kind == 'f':
+        return np.where(np.isnan(qa), 1 << QA_FLAGS['fill'], np.nan_to_num(qa)).astype(np.uint16)
+    return qa.astype(np.uint16)
+
+
+def qa_flag(mask, name):
+    """
+    Args:
+    mask (uint16 array): QA mask from to_qa_mask
+    name (str): Flag from QA_FLAGS, e.g. 'cloud'
+
+    Returns:
+    (boolean array): True where the flag is set
+    """
+    return (mask >> QA_FLAGS[name]) & 1 == 1
+
+
+def qa_confidence(mask, name):
+    """
+    Args:
+    mask (uint16 array): QA mask from to_qa_mask
+    name (str): Field from QA_CONFIDENCES, e.g. 'cloud_confidence'
+
+    Returns:
+    (uint8 array): Confidence from 0 (None) to 3 (High)
+    """
+    return ((mask >> QA_CONFIDENCES[name]) & 3).astype(np.uint8)
+
+
+def decode_qa(mask, flags=QA_FLAGS, confidences=QA_CONFIDENCES):
+    """
+    Decodes several fields of a QA mask at once.
+
+    Args:
+    mask (array): QA mask, converted with to_qa_mask if it is not uint16 yet
+    flags (iterable): Names of the flags to decode
+    confidences (iterable): Names of the confidence fields to decode
+
+    Returns:
+    (dict): {name: array} of a boolean array per flag and a uint8 array per confidence field
+    """
+    mask = to_qa_mask(mask)
+    decoded = {name: qa_flag(mask, name) for name in flags}
+    decoded.update({name: qa_confidence(mask, name) for name in confidences})
+    return decoded
+
+
+def pack_qa_planes(mask, flags=('cloud', 'dilated_cloud', 'cloud_shadow', 'snow', 'water')):
+    """
+    Packs boolean planes of QA flags to 1 bit per pixel.
+
+    Args:
+    mask (array): QA mask, converted with to_qa_mask if it is not uint16 yet
+    flags (iterable): Names of the flags to pack
+
+    Returns:
+    (uint8 array): (flags, ceil(y*x/8)) Packed planes, in the order of flags
+    """
+    mask = to_qa_mask(mask)
+    return np.packbits(np.stack([qa_flag(mask, name) for name in flags]).reshape(len(flags), -1), axis=1)
+
+
+def unpack_qa_planes(packed, shape):
+    """
+    Args:
+    packed (uint8 array): (flags, n) Packed planes from pack_qa_planes
+    shape (tuple): (y,x) Shape of the mask the planes were packed from
+
+    Returns:
+    (boolean array): (flags,y,x) Planes
+    """
+    n_pixels = int(np.prod(shape))
+    return np.unpackbits(packed, axis=1, count=n_pixels).reshape(len(packed), *shape).astype(bool)
+
+
+def set_qa_variables(ds, var='Landsat_cloud_mask', planes=None):
+    """
+    Replaces the QA_PIXEL variable of a dataset with its uint16 mask, and optionally
+    adds bit-packed boolean planes of some of its flags.
+
+    Args:
+    ds (xarray.Dataset): Dataset with the QA_PIXEL band
+    var (str): Name of the QA_PIXEL variable
+    planes (iterable, optional): Names of the flags to also store as packed planes,
+                                 in the variable '{var}_planes'
+
+    Returns:
+    (xarray.Dataset): Dataset with the converted mask
+    """
+    mask = to_qa_mask(ds[var].values)
+    ds[var] = (ds[var].dims, mask, dict(ds[var].attrs, bitmask_key=QA_BITMASK_KEY))
+    if planes:
+        planes = list(planes)
+        ds[f'{var}_planes'] = (('qa_flag', 'packed_pixel'), pack_qa_planes(mask, planes))
+        ds[f'{var}_planes'].attrs = {'flags': ','.join(planes),
+                                     'description': f'Bit-packed boolean planes of {var} flags, one per qa_flag. '
+                                                    'Unpack with numpy.unpackbits and reshape to (y,x)'}
+    return ds
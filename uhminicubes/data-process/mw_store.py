@@ -0,0 +1,139 @@
+import os
+import glob
+from collections import OrderedDict
+import numpy as np
+
+
+"""
+Access layer for the daily microwave LST files (MW_LST_DTC_{date}_x1y.h5).
+Each file holds a global (96, 1440, 600) array of (15-minute time step, longitude,
+latitude) values. Only the window around a city is read from a file, and the
+clipped subcubes are kept in a bounded LRU cache so that the 144 GOES frames
+of a day reuse one read of the daily file.
+"""
+
+# Coordinates of the microwave LST grid. Remember: latitude decreases with index
+MW_LONGITUDES = np.arange(-180, 180, 0.25)
+MW_LATITUDES = np.arange(-60, 90, 0.25)[::-1]
+MW_STEPS_PER_DAY = 96
+
+
+def get_next_latlon_coord(n, above=True):
+    """
+    Returns the value rounded up or down to the nearest 0.25.
+
+    Args:
+    n (float): latitude or longitude coordinate
+    above (boolean): True for round up, False for round down
+
+    Returns:
+    (float): The coordinate rounded to a multiple of 0.25
+    """
+    if above:
+        return np.ceil(n*4)/4
+    else:
+        return np.floor(n*4)/4
+
+
+def city_bbox(latlon_pts):
+    """
+    Calculates the indices of the microwave LST grid cells completely
+    surrounding a grid of (longitude, latitude) points.
+
+    Args:
+    latlon_pts (float array): (n,m,2) Array of (longitude, latitude) points
+
+    Returns:
+    (tuple): (min_lon_index, max_lon_index, max_lat_index, min_lat_index). Slicing the
+             microwave grid with [min_lon_index:max_lon_index+1, max_lat_index:min_lat_index+1]
+             gives the city window
+    """
+    max_lon_index = np.where(MW_LONGITUDES == get_next_latlon_coord(np.max(latlon_pts[:,:,0]), True))[0][0]
+    min_lon_index = np.where(MW_LONGITUDES == get_next_latlon_coord(np.min(latlon_pts[:,:,0]), False))[0][0]
+    max_lat_index = np.where(MW_LATITUDES == get_next_latlon_coord(np.max(latlon_pts[:,:,1]), True))[0][0]
+    min_lat_index = np.where(MW_LATITUDES == get_next_latlon_coord(np.min(latlon_pts[:,:,1]), False))[0][0]
+    return (int(min_lon_index), int(max_lon_index), int(max_lat_index), int(min_lat_index))
+
+
+def bbox_coords(bbox):
+    """
+    Returns the microwave LST grid coordinates inside a city window.
+
+    Args:
+    bbox (tuple): City window from city_bbox
+
+    Returns:
+    longitudes (float array): Longitudes of the window, increasing with index
+    latitudes (float array): Latitudes of the window, decreasing with index
+    """
+    return MW_LONGITUDES[bbox[0]:bbox[1]+1], MW_LATITUDES[bbox[2]:bbox[3]+1]
+
+
+class MicrowaveStore:
+    """
+    Bounded LRU cache of microwave LST city-window subcubes keyed by (date, city bbox).
+    A store is created once per process. Pool workers are long-lived, so every frame a
+    worker processes after the first one of a day is served from memory.
+    """
+    def __init__(self, mw_dir, max_entries=8):
+        """
+        Args:
+        mw_dir (str): Directory where the MW_LST_DTC_{date}_x1y.h5 files are located
+        max_entries (int): Largest number of (date, bbox) subcubes to keep in memory
+        """
+        self.mw_dir = mw_dir
+        self.max_entries = max_entries
+        self._dates = None
+        self._cache = OrderedDict()
+
+    @property
+    def dates(self):
+        """
+        Set of dates (YYYYmmdd strings) that have a microwave LST file.
+        The directory is only listed the first time the dates are needed.
+        """
+        if self._dates is None:
+            self._dates = {os.path.basename(f).split('_')[3] for f in glob.glob(f'{self.mw_dir}/MW_LST_DTC_*_x1y.h5')}
+        return self._dates
+
+    def has_date(self, date_str):
+        """
+        Args:
+        date_str (str): Date in format of 'YYYYmmdd'
+
+        Returns:
+        (boolean): Whether there is a microwave LST file for the date
+        """
+        return date_str in self.dates
+
+    def get_subcube(self, date_str, bbox):
+        """
+        Returns the raw (unscaled) microwave LST values of a day inside a city window.
+
+        Args:
+        date_str (str): Date in format of 'YYYYmmdd'
+        bbox (tuple): City window from city_bbox
+
+        Returns:
+        (array): Read-only (96, n_lon, n_lat) array of values. Divide by 50 to get Kelvin. If the variable
+                 has a _FillValue or missing_value attribute, those values are NaN (in a float array)
+        """
+        key = (date_str, bbox)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        import h5py
+        with h5py.File(f'{self.mw_dir}/MW_LST_DTC_{date_str}_x1y.h5', 'r') as f:
+            dataset = f['TB37V_LST_DTC']
+            subcube = dataset[:, bbox[0]:bbox[1]+1, bbox[2]:bbox[3]+1]
+            fill_values = [np.ravel(dataset.attrs[k]) for k in ['_FillValue', 'missing_value'] if k in dataset.attrs]
+        # Missing values are masked as xarray's CF decoding masks them, so they are never regridded as temperatures
+        if fill_values:
+            subcube = np.where(np.isin(subcube, np.concatenate(fill_values)), np.nan, subcube)
+        subcube.flags.writeable = False
+
+        self._cache[key] = subcube
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return subcube
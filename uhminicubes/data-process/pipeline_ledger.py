@@ -0,0 +1,155 @@
+import os
+import time
+import sqlite3
+
+
+"""
+SQLite ledger of the state of every GOES frame in the pipeline, keyed by
+(city, frame time, stage). GOES_download.py and process_GOES.py record each
+frame they finish, so finding the missing work on a restart is an indexed query
+instead of a glob of the output directory and a scan of a list of file names.
+
+Stages:
+'download'  GeoTIFF downloaded from Earth Engine
+'process'   Per-frame processed netCDF file written
+'store'     Frame committed to a consolidated GOES file
+'validate'  Output checked by a verifier
+
+Only the main process of a job writes to the ledger (pool workers return their
+results to it), and writes are batched into transactions.
+"""
+
+STAGES = ('download', 'process', 'store', 'validate')
+
+
+class PipelineLedger:
+    """
+    Record of which frames are done or failed at each stage of the pipeline.
+    """
+    def __init__(self, path, batch_size=500):
+        """
+        Args:
+        path (str): Location of the SQLite database, created if it does not exist
+        batch_size (int): Number of buffered records that triggers a write
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = []
+        # Array jobs share the database, so wait for other writers instead of failing
+        self.conn = sqlite3.connect(path, timeout=300)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS frames (
+                                 city TEXT NOT NULL,
+                                 time INTEGER NOT NULL,
+                                 stage TEXT NOT NULL,
+                                 state TEXT NOT NULL,
+                                 size INTEGER,
+                                 seconds REAL,
+                                 error TEXT,
+                                 updated REAL NOT NULL,
+                                 write_seconds REAL,
+                                 PRIMARY KEY (city, stage, time))''')
+        self.conn.commit()
+
+    def record(self, city, stage, frame_time, state='done', size=None, seconds=None, error=None, write_seconds=None):
+        """
+        Buffers the state of a frame, writing the buffer once it is full.
+
+        Args:
+        city (str): City name from the list of valid cities
+        stage (str): Pipeline stage from STAGES
+        frame_time (int): Frame time in UTC seconds
+        state (str): 'done' or 'failed'
+        size (int, optional): Size of the output file in bytes
+        seconds (float, optional): Time taken to produce the output
+        error (str, optional): Error message of a failed frame
+        write_seconds (float, optional): Part of seconds spent writing the output file
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Please set stage to one of {', '.join(f'``{s}``' for s in STAGES)}.")
+        self._pending.append((city, int(frame_time), stage, state, size, seconds, error, time.time(), write_seconds))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every buffered record in a single transaction.
+        """
+        if not self._pending:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO frames (city, time, stage, state, size, seconds, error, updated, write_seconds) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', self._pending)
+        self._pending = []
+
+    def close(self):
+        """
+        Writes every buffered record and closes the database.
+        """
+        self.flush()
+        self.conn.close()
+
+    def times(self, city, stage, state='done'):
+        """
+        Args:
+        city (str): City name from the list of valid cities
+        stage (str): Pipeline stage from STAGES
+        state (str): 'done' or 'failed'
+
+        Returns:
+        (set): UTC seconds of the frames in the state
+        """
+        rows = self.conn.execute('SELECT time FROM frames WHERE city = ? AND stage = ? AND state = ?', (city, stage, state))
+        return {row[0] for row in rows}
+
+    def has_stage(self, city, stage):
+        """
+        Args:
+        city (str): City name from the list of valid cities
+        stage (str): Pipeline stage from STAGES
+
+        Returns:
+        (boolean): Whether any frame of the city has been recorded at the stage
+        """
+        return self.conn.execute('SELECT 1 FROM frames WHERE city = ? AND stage = ? LIMIT 1', (city, stage)).fetchone() is not None
+
+    def bootstrap(self, city, stage, paths, check=None):
+        """
+        Records the outputs that already exist on disk as done, for data made before the
+        ledger was used. Each directory is listed once instead of checking every file.
+
+        Args:
+        city (str): City name from the list of valid cities
+        stage (str): Pipeline stage from STAGES
+        paths (dict): Expected output file of each frame time in UTC seconds
+        check (function, optional): Called with the path of each existing file, files it returns False for are left to be redone
+
+        Returns:
+        (int): Number of frames recorded
+        """
+        listings = {}
+        n = 0
+        for frame_time, path in paths.items():
+            directory, fname = os.path.split(path)
+            if directory not in listings:
+                listings[directory] = {}
+                if os.path.isdir(directory):
+                    with os.scandir(directory) as entries:
+                        listings[directory] = {entry.name: entry for entry in entries}
+            if fname in listings[directory] and (check is None or check(path)):
+                self.record(city, stage, frame_time, size=listings[directory][fname].stat().st_size)
+                n += 1
+        self.flush()
+        return n
+
+    def summary(self, city):
+        """
+        Args:
+        city (str): City name from the list of valid cities
+
+        Returns:
+        (dict): {(stage, state): (number of frames, total bytes, mean seconds)}
+        """
+        rows = self.conn.execute('SELECT stage, state, COUNT(*), SUM(size), AVG(seconds) FROM frames WHERE city = ? GROUP BY stage, state', (city,))
+        return {(row[0], row[1]): row[2:] for row in rows}
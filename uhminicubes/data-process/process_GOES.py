@@ -1,15 +1,20 @@
+# Imported on first use: pandas, rioxarray, rasterio and the consolidated store (xarray)
 import numpy as np
-import pandas as pd
-import xarray as xr
-import rioxarray as rxr
-import glob
 import datetime
-from pyproj import Proj, Transformer
 import os
-from scipy import interpolate
-import multiprocessing
 import argparse
 import subprocess
+from contextlib import contextmanager
+from grid_transform import utm_crs, load_city_latlons
+from mw_store import MicrowaveStore, city_bbox, bbox_coords
+from regrid import RegridMap
+from time_align import TimeAligner, to_utc_seconds, day_to_date_str
+from goes_writer import GOESFrameWriter
+from encoding_profiles import ENCODING_PROFILES, xarray_encoding
+from goes_scheduler import run_pool, write_retry_list
+from shard_planner import period_suffix, plan_shards, save_plan, load_plan
+from pipeline_ledger import PipelineLedger
+from goes_calibration import scale_offset_path, load_scale_offset, calibrate_GOES_bands
 
 
 
@@ -133,164 +138,255 @@ city_ICAO_codes = {
     'DMV': 'KBWI'
 }
 
+# Scratch directory of the GOES files and processed GOES directories
+SCRATCH_DIR = '/scratch/zt1/project/mjmolina-prj/user/jonstar'
 
-def process_GOES_tif(tif, time, latlon_pts, fname, coord_bounds=None):
+# Directory of the daily microwave LST files
+MW_DIR = f'{SCRATCH_DIR}/mw_data'
+
+# GOES bands of the .tif files, in band order
+GOES_BANDS = ['GOES_C13_LWIR', 'GOES_C14_LWIR', 'GOES_C15_LWIR', 'GOES_C16_LWIR']
+
+# Microwave LST files, shared by every frame a process (or pool worker) handles
+mw_store = MicrowaveStore(MW_DIR)
+
+# Microwave LST windows, nearest-neighbour maps and longitude time offsets, built once per GOES grid
+grid_maps = {}
+
+
+def get_grid_maps(latlon_pts):
     """
-    Processing of individual .tif files. Performs a variety of tasks on
-    the data to make it easier to read and understand and saves the
-    data as a netCDF file.
+    Returns the microwave LST window, nearest-neighbour map and time aligner for
+    a GOES grid, building them the first time the grid is seen.
 
     Args:
-    tif (str): Path where tif file is located
-    time (str): Date and time of when the data was collected format YYYY-MM-DDThh:mm:ssZ
     latlon_pts (float array): (45,45,2) Array of (longitude, latitude) points at each point on the utm grid
-    fname (str): Full path of where to store the file, including a filename ending in '.nc'
-    coord_bounds (tuple or list, optional): Coordinate bounds if you wish to filter the data by location. The order should be
-                                    (longitude minimum, longitude maximum, latitude minimum, latitude maximum)
+
+    Returns:
+    bbox (tuple): Microwave LST window surrounding the GOES grid
+    regrid_map (RegridMap): Nearest-neighbour map from the window to the GOES grid
+    time_aligner (TimeAligner): Local solar time step calculator for the GOES grid
     """
-    #########################################################################################################
-    # Open file and rename variables
-    dsG = rxr.open_rasterio(tif)
-    geotiff_ds = dsG.to_dataset('band')
-    geotiff_ds = geotiff_ds.rename({1:'GOES_C13_LWIR', 2:'GOES_C14_LWIR',
-                                      3:'GOES_C15_LWIR', 4:'GOES_C16_LWIR'})
-    geotiff_ds = geotiff_ds.assign_coords({'datetime':time})
+    key = latlon_pts.tobytes()
+    if key not in grid_maps:
+        bbox = city_bbox(latlon_pts)
+        mw_longitudes, mw_latitudes = bbox_coords(bbox)
+        grid_maps[key] = (bbox, RegridMap(mw_longitudes, mw_latitudes, latlon_pts), TimeAligner(latlon_pts[:,:,0]))
+    return grid_maps[key]
 
-    #########################################################################################################
-    # Process microwave data
-    def get_next_latlon_coord(n, above=True):
-        """
-        Returns the value rounded up or down to the nearest 0.25.
 
-        Args:
-        n (float): latitude or longitude coordinate
-        above (boolean): True for round up, False for round down
+def interpolate_mw_LST(times, latlon_pts):
+    """
+    Interpolates the microwave LST to the GOES grid for a batch of GOES frames.
+    The microwave LST is provided every 15 minutes in local solar time, so each
+    GOES point takes the value of the time step closest to its local solar time.
 
-        Returns:
-        (float): The coordinate rounded to a multiple of 0.25
-        """
-        if above:
-            return np.ceil(n*4)/4
-        else:
-            return np.floor(n*4)/4
+    Args:
+    times (int array): (t,) Array of UTC times in seconds since 1970-01-01
+    latlon_pts (float array): (45,45,2) Array of (longitude, latitude) points at each point on the utm grid
 
+    Returns:
+    (float array): (t,45,45) Array of microwave LST values in K. NaN for frames without a microwave LST file
+    """
+    bbox, regrid_map, time_aligner = get_grid_maps(latlon_pts)
+    base_days, slots = time_aligner.align(times)
 
-    def stringify(num):
-        """
-        Returns a day integer as a str, adding a zero in front
-        if it is a single digit.
+    mw_interpolated = np.empty(slots.shape)
+    mw_interpolated[:] = np.nan
+    for day in np.unique(base_days):
+        frames = base_days == day
+        # Frames whose points round up to or cross local midnight also need the next day's file.
+        # A city grid spans far less than a day, so no point is more than one day past the base day
+        date_strs = [day_to_date_str(day)]
+        if np.any(time_aligner.rollover_mask(slots[frames])):
+            date_strs.append(day_to_date_str(day + 1))
 
-        Args:
-        num (int): Integer to turn into a string
+        # Accounting for dates without a microwave LST file
+        if not all(mw_store.has_date(date_str) for date_str in date_strs):
+            print(f'No microwave LST file for {" or ".join(date_strs)}')
+            continue
 
-        Returns:
-        (str): Two-digit day as a string
-        """
-        if num >= 0 and num < 10:
-            return f'0{num}'
-        else:
-            return str(num)
+        # Microwave values of the window around the city, read once per day and cached.
+        # Days are concatenated so time steps 96 and above select from the next day
+        mw_window = np.concatenate([mw_store.get_subcube(date_str, bbox) for date_str in date_strs])
+
+        # Select the time index of each GOES point and take the nearest microwave value
+        # in a single gather, dividing by 50 to get physical MW LST values
+        mw_interpolated[frames] = regrid_map.apply_time_indices(mw_window, slots[frames])/50
 
+    return mw_interpolated
 
-    # Calculate adjusted datetimes for the left and right edges of the image.
-    # If the datetimes are across two days, values from two mw LST files need to be used.
-    min_longitude = np.min(latlon_pts[:,:,0])
-    max_longitude = np.max(latlon_pts[:,:,0])
 
-    date_format = "%Y-%m-%dT%H:%M:%SZ"
-    utc_dt = datetime.datetime.strptime(time, date_format)
-    local_dt1 = utc_dt + datetime.timedelta(hours=(min_longitude/360)*24)
-    date_str1 = f'{local_dt1.year}{stringify(local_dt1.month)}{stringify(local_dt1.day)}'
-    local_dt2 = utc_dt + datetime.timedelta(hours=(max_longitude/360)*24)
-    date_str2 = f'{local_dt2.year}{stringify(local_dt2.month)}{stringify(local_dt2.day)}'
+def get_processed_dir(city, t):
+    """
+    Returns the processed GOES directory of a frame, one per city and half-year.
 
+    Args:
+    city (str): City name from the list of valid cities
+    t (int): Frame time in UTC seconds
 
-    def time_adjust(longitude, dt=utc_dt):
-        """
-        Adjusts a datetime in UTC to local time based on how far it is from
-        the Prime Meridian and calculates an index 0-96 of which 15-minute
-        timestamp it is closest to in the day.
+    Returns:
+    (str): Full directory location
+    """
+    return f'{SCRATCH_DIR}/processed_GOES_{city}_{period_suffix(t)}'
 
-        Args:
-        longitude (float): Longitude value
-        dt (datetime): Datetime with a time in UTC
 
-        Returns:
-        time_index (int): Integer 0-96 denoting which 15-minute timestamp the
-                          adjusted time is closest to
-        """
-        local_dt = dt + datetime.timedelta(hours=(longitude/360)*24) # Adjusting for global local time
-        time_index = local_dt.hour*4 + round(local_dt.minute/15+local_dt.second/900) # Used in selection of datetime index from mw file (every 15 minutes)
-        return time_index
-
-    # Vectorize the time_adjust function and
-    # get the longitude values of each coordinate point
-    func = np.vectorize(time_adjust)
-    time_indices = func(latlon_pts[:, :, 0])
-
-    # Accounting for rounding of values to timestep of following day
-    if np.sum(time_indices<96) < 2025 and date_str1 == date_str2: 
-        local_dt2 = local_dt2 + datetime.timedelta(days=1)
-        date_str2 = f'{local_dt2.year}{stringify(local_dt2.month)}{stringify(local_dt2.day)}'
-
-    # Accounting for files we do not have currently
-    if date_str1 == '20211231' or date_str2 == '20211231' or date_str1 == '20220322' or date_str2 == '20220322':
-        print('date string identifited')
-        mw_interpolated = np.empty((45, 45))
-        mw_interpolated[:] = np.nan
+def get_processed_fname(city, t, time_str):
+    """
+    Args:
+    city (str): City name from the list of valid cities
+    t (int): Frame time in UTC seconds
+    time_str (str): Frame time in format of 'YYYYmmddHHMM', as in the name of the .tif file
+
+    Returns:
+    (str): Full location of the processed per-frame file
+    """
+    return f'{get_processed_dir(city, t)}/lresgrid_{city_ICAO_codes[city]}_{time_str}.nc'
+
+
+def get_frame_time(t):
+    """
+    Args:
+    t (int): Frame time in UTC seconds
+
+    Returns:
+    (str): Frame time in format YYYY-MM-DDThh:mm:ssZ
+    """
+    return datetime.datetime.fromtimestamp(int(t), datetime.UTC).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+@contextmanager
+def open_GOES_tif(tif):
+    """
+    Opens a .tif file, or the bytes of one held in memory.
+
+    Args:
+    tif (str or bytes): Path where tif file is located, or the contents of the file
+
+    Yields:
+    (rasterio.io.DatasetReader): The open file
+    """
+    import rasterio
+    from rasterio.io import MemoryFile
+    if isinstance(tif, bytes):
+        with MemoryFile(tif) as memfile, memfile.open() as src:
+            yield src
     else:
-        if date_str1 != date_str2: # When data spans two days (two different files)
-            dsMW = xr.open_dataset(f'/scratch/zt1/project/mjmolina-prj/user/jonstar/mw_data/MW_LST_DTC_{date_str1}_x1y.h5', engine='h5netcdf')
-            dsMW = dsMW.assign_coords(
-                datetime=("phony_dim_0", pd.date_range(start=date_str1, periods=96, freq="15min")),
-                longitude=("phony_dim_1", np.arange(-180,180,0.25)),
-                latitude=("phony_dim_2", np.arange(-60,90,0.25)[::-1]))
-     
-            dsMW2 = xr.open_dataset(f'/scratch/zt1/project/mjmolina-prj/user/jonstar/mw_data/MW_LST_DTC_{date_str2}_x1y.h5', engine='h5netcdf')
-            dsMW2 = dsMW.assign_coords(
-                datetime=("phony_dim_0", pd.date_range(start=date_str2, periods=96, freq="15min")),
-                longitude=("phony_dim_1", np.arange(-180,180,0.25)),
-                latitude=("phony_dim_2", np.arange(-60,90,0.25)[::-1]))    
-
-            dsMW = xr.concat([dsMW.to_dataarray()[0], dsMW2.to_dataarray()[0]], dim='phony_dim_0') # Concatenate arrays to be continuous
-            # When data is split over two days, the time indices will end on 95 from day 1 and start on 0 from day 2. Now that the two days
-            # are concatenated, 0 for day 2 is index 96. The indices are adjusted to reflect this change.
-            time_indices = np.where(time_indices>90, time_indices, time_indices+96) # Adjust time indices to be in continuous order
-        else:
-            dsMW = xr.open_dataset(f'/scratch/zt1/project/mjmolina-prj/user/jonstar/mw_data/MW_LST_DTC_{date_str1}_x1y.h5', engine='h5netcdf')
-            dsMW = dsMW.assign_coords(
-                datetime=("phony_dim_0", pd.date_range(start=date_str1, periods=96, freq="15min")),
-                longitude=("phony_dim_1", np.arange(-180,180,0.25)),
-                latitude=("phony_dim_2", np.arange(-60,90,0.25)[::-1]))
-
-        max_lon_index = np.where(dsMW['longitude'] == get_next_latlon_coord(np.max(latlon_pts[:,:,0]), True))[0][0]
-        min_lon_index = np.where(dsMW['longitude'] == get_next_latlon_coord(np.min(latlon_pts[:,:,0]), False))[0][0]
-        max_lat_index = np.where(dsMW['latitude'] == get_next_latlon_coord(np.max(latlon_pts[:,:,1]), True))[0][0]
-        min_lat_index = np.where(dsMW['latitude'] == get_next_latlon_coord(np.min(latlon_pts[:,:,1]), False))[0][0]
-
-        # Create microwave array for specific area
-        # Remember: latitude decreases with index
-        if date_str1 != date_str2: # Concatenation removes TB37V_LST_DTC variable
-            mw_clipped = dsMW[np.min(time_indices):np.max(time_indices)+1,min_lon_index:max_lon_index+1,max_lat_index:min_lat_index+1]
-            dsMW.close()
-            dsMW2.close()
-        else:
-            mw_clipped = dsMW['TB37V_LST_DTC'][np.min(time_indices):np.max(time_indices)+1,min_lon_index:max_lon_index+1,max_lat_index:min_lat_index+1]
-            dsMW.close()
+        with rasterio.open(tif) as src:
+            yield src
+
+
+def get_GOES_scale_offset(tif, time, scale_offset=None):
+    """
+    Finds the scale and offset of the bands of a GOES file downloaded as native integers.
+
+    Args:
+    tif (str or bytes): Path where tif file is located, or the contents of the file
+    time (str): Date and time of when the data was collected format YYYY-MM-DDThh:mm:ssZ
+    scale_offset (tuple, optional): (scales, offsets) of the bands. Read from the day's sidecar next to the file if not given
+
+    Returns:
+    (tuple): (scales, offsets) of the bands
+    """
+    if scale_offset is not None:
+        return scale_offset
+    if isinstance(tif, bytes):
+        raise Exception("Please pass the scale and offset of GOES files downloaded as native integers and held in memory.")
+    return load_scale_offset(scale_offset_path(os.path.dirname(tif), time[:10].replace('-', '')))
+
+
+def calibrate_GOES_tif(dsG, tif, time, scale_offset=None):
+    """
+    Converts the bands of a GOES file downloaded as native integers to brightness temperatures,
+    so the file matches one downloaded as brightness temperatures.
+
+    Args:
+    dsG (xr.DataArray): (band,y,x) GOES file opened with rioxarray
+    tif (str or bytes): Path where tif file is located, or the contents of the file
+    time (str): Date and time of when the data was collected format YYYY-MM-DDThh:mm:ssZ
+    scale_offset (tuple, optional): (scales, offsets) of the bands, see get_GOES_scale_offset
 
-        y, x = np.meshgrid(mw_clipped['latitude'], mw_clipped['longitude'])
-        mw_latlons = np.stack((x,y)).T.reshape(-1,2)
+    Returns:
+    (xr.DataArray): (band,y,x) Brightness temperatures in K, NaN where there is no data
+    """
+    calibrated = dsG.copy(data=calibrate_GOES_bands(dsG.values, *get_GOES_scale_offset(tif, time, scale_offset)))
+    calibrated.attrs['_FillValue'] = np.nan
+    calibrated.encoding['rasterio_dtype'] = 'float64'
+    return calibrated
+
+
+def load_GOES_latlons(city, tif, cache_dir):
+    """
+    Loads the latitude/longitude grid of a city's GOES files, computing it from the
+    coordinates of one of the files if it is not cached yet.
+
+    Args:
+    city (str): City name from the list of valid cities
+    tif (str or bytes): Path where one of the city's tif files is located, or the contents of the file
+    cache_dir (str): Directory of cached latitude/longitude grids
+
+    Returns:
+    (float array): (45,45,2) Array of (longitude, latitude) points at each point on the utm grid
+    """
+    import rioxarray as rxr
+    with open_GOES_tif(tif) as src:
+        dsG = rxr.open_rasterio(src)
+        x, y = dsG['x'].values, dsG['y'].values
+    return load_city_latlons(city, 'GOES', x, y, utm_crs(proj_zone[city]), cache_dir)
 
-        # For each time index in the mw_clipped array, interpolate the MW data to the GOES grid
-        interpolated_arrays = []
-        for arr in mw_clipped:
-            mw_interpolated = interpolate.griddata(mw_latlons, arr.T.values.reshape(-1)/50, latlon_pts, method='nearest')
-            interpolated_arrays.append(mw_interpolated)
-        interpolated_array = np.stack(interpolated_arrays) # Interpolated microwave values from each time index n of shape (n,45,45)
-        interpolated_indices = time_indices-np.min(time_indices) # Array of shape (45,45) that select time indices from the value array
 
-        # Index the first dimension of the value array
-        mw_interpolated = interpolated_array[interpolated_indices, np.arange(45)[:, None], np.arange(45)]
+def build_GOES_dataset(tif, time, latlon_pts, coord_bounds=None, scale_offset=None, data=None):
+    """
+    Processing of individual .tif files. Performs a variety of tasks on
+    the data to make it easier to read and understand.
+
+    Args:
+    tif (str or bytes): Path where tif file is located, or the contents of the file
+    time (str): Date and time of when the data was collected format YYYY-MM-DDThh:mm:ssZ
+    latlon_pts (float array): (45,45,2) Array of (longitude, latitude) points at each point on the utm grid
+    coord_bounds (tuple or list, optional): Coordinate bounds if you wish to filter the data by location. The order should be
+                                    (longitude minimum, longitude maximum, latitude minimum, latitude maximum)
+    scale_offset (tuple, optional): (scales, offsets) of the bands of a file downloaded as native integers,
+                                    read from the day's sidecar if not given
+    data (dict, optional): Arrays of the frame already read by read_GOES_arrays, in which case the file is
+                           only opened for its grid and metadata
+
+    Returns:
+    geotiff_ds (xr.Dataset): Fully processed file as an xarray dataset
+    """
+    import rioxarray as rxr
+
+    #########################################################################################################
+    # Open file and rename variables. Files held in memory are read straight away, since they are
+    # closed before the dataset is used
+    if data is not None:
+        with open_GOES_tif(tif) as src:
+            dsG = rxr.open_rasterio(src)
+            packed = np.issubdtype(dsG.dtype, np.integer)
+            # Flip the arrays back to the order of the file
+            dsG = dsG.copy(data=np.stack([data[band][::-1] for band in GOES_BANDS]))
+        if packed:
+            # Same metadata as calibrate_GOES_tif gives
+            dsG.attrs['_FillValue'] = np.nan
+            dsG.encoding['rasterio_dtype'] = 'float64'
+    elif isinstance(tif, bytes):
+        with open_GOES_tif(tif) as src:
+            dsG = rxr.open_rasterio(src).load()
+    else:
+        dsG = rxr.open_rasterio(tif)
+    # Files downloaded as native integers are calibrated here instead of on Earth Engine
+    if data is None and np.issubdtype(dsG.dtype, np.integer):
+        dsG = calibrate_GOES_tif(dsG, tif, time, scale_offset)
+    geotiff_ds = dsG.to_dataset('band')
+    geotiff_ds = geotiff_ds.rename({i+1:band for i, band in enumerate(GOES_BANDS)})
+    geotiff_ds = geotiff_ds.assign_coords({'datetime':time})
+
+    #########################################################################################################
+    # Process microwave data
+    if data is None:
+        mw_interpolated = interpolate_mw_LST(to_utc_seconds(time), latlon_pts)[0]
+    else:
+        mw_interpolated = data['microwave_LST'][::-1]
 
     # Set a new variable for the interpolated MW LST
     geotiff_ds['microwave_LST'] = (('y','x'), mw_interpolated)
@@ -365,120 +461,339 @@ def process_GOES_tif(tif, time, latlon_pts, fname, coord_bounds=None):
         geotiff_ds = geotiff_ds.sel(longitude=slice(coord_bounds[0], coord_bounds[1])).sel(latitude=slice(coord_bounds[3], coord_bounds[2]))
 
     #########################################################################################################
+    return geotiff_ds
+
+
+def process_GOES_tif(tif, time, latlon_pts, fname, coord_bounds=None, scale_offset=None, encoding='float64', complevel=None):
+    """
+    Processes an individual .tif file and saves the data as a netCDF file.
+
+    Args:
+    tif (str or bytes): Path where tif file is located, or the contents of the file
+    time (str): Date and time of when the data was collected format YYYY-MM-DDThh:mm:ssZ
+    latlon_pts (float array): (45,45,2) Array of (longitude, latitude) points at each point on the utm grid
+    fname (str): Full path of where to store the file, including a filename ending in '.nc'
+    coord_bounds (tuple or list, optional): Coordinate bounds if you wish to filter the data by location. The order should be
+                                    (longitude minimum, longitude maximum, latitude minimum, latitude maximum)
+    scale_offset (tuple, optional): (scales, offsets) of the bands of a file downloaded as native integers,
+                                    read from the day's sidecar if not given
+    encoding (str): Encoding profile of the data variables from ENCODING_PROFILES
+    complevel (int, optional): gzip level 0-9, the profile's default if not given
+    """
+    geotiff_ds = build_GOES_dataset(tif, time, latlon_pts, coord_bounds, scale_offset)
+    xarray_encoding(geotiff_ds, encoding, complevel)
+    geotiff_ds.to_netcdf(fname, format='NETCDF4', engine='h5netcdf')
+
+
+# City state of a pool worker, set once by init_GOES_worker
+worker_latlon_pts = None
+worker_writer = 'template'
+worker_encoding = 'float64'
+worker_complevel = None
+# Template writer of the per-frame files and the GeoTIFF transform it was made from,
+# set up from the first frame a worker processes
+frame_writer = None
+frame_writer_transform = None
+
+
+def init_GOES_worker(city_name, latlon_pts, mw_dir, mw_cache_days, writer='template', encoding='float64', complevel=None):
+    """
+    Sets up the read-only city state of a pool worker, so it is sent to each worker
+    once instead of with every task. The microwave LST window, nearest-neighbour map
+    and time offsets of the grid are built here as well.
+
+    Args:
+    city_name (str): City name from the list of valid cities
+    latlon_pts (float array): (45,45,2) Array of (longitude, latitude) points at each point on the utm grid
+    mw_dir (str): Directory of the daily microwave LST files
+    mw_cache_days (int): Number of daily microwave LST city windows the worker keeps in memory
+    writer (str): 'template' to write per-frame files with GOESFrameWriter or 'xarray' to write them with to_netcdf
+    encoding (str): Encoding profile of the per-frame files from ENCODING_PROFILES
+    complevel (int, optional): gzip level 0-9 of the per-frame files, the profile's default if not given
+    """
+    global city, mw_store, worker_latlon_pts, worker_writer, worker_encoding, worker_complevel
+    city = city_name
+    mw_store = MicrowaveStore(mw_dir, mw_cache_days)
+    worker_latlon_pts = latlon_pts
+    worker_writer = writer
+    worker_encoding = encoding
+    worker_complevel = complevel
+    get_grid_maps(latlon_pts)
+
+
+def read_GOES_arrays(tif, time, latlon_pts, scale_offset=None):
+    """
+    Reads the bands of a .tif file and interpolates the microwave LST without building
+    an xarray dataset. The arrays match the data variables of build_GOES_dataset.
+
+    Args:
+    tif (str or bytes): Path where tif file is located, or the contents of the file
+    time (str): Date and time of when the data was collected format YYYY-MM-DDThh:mm:ssZ
+    latlon_pts (float array): (45,45,2) Array of (longitude, latitude) points at each point on the utm grid
+    scale_offset (tuple, optional): (scales, offsets) of the bands of a file downloaded as native integers,
+                                    read from the day's sidecar if not given
+
+    Returns:
+    data (dict): (45,45) array of each data variable, flipped so latitude increases with index
+    transform (affine.Affine): GeoTransform of the .tif file
+    """
+    with open_GOES_tif(tif) as src:
+        bands = src.read()
+        transform = src.transform
+    if np.issubdtype(bands.dtype, np.integer):
+        bands = calibrate_GOES_bands(bands, *get_GOES_scale_offset(tif, time, scale_offset))
+    data = {band: bands[i, ::-1] for i, band in enumerate(GOES_BANDS)}
+    data['microwave_LST'] = interpolate_mw_LST(to_utc_seconds(time), latlon_pts)[0, ::-1]
+    return data, transform
+
+
+def process_GOES_frame(tif, time, fname, scale_offset=None):
+    """
+    Pool task that processes a .tif file on the worker's city grid and saves it as a netCDF file.
+    The first frame of a worker is processed with xarray and becomes the template that the
+    following frames on the same grid are written into.
+
+    Args:
+    tif (str or bytes): Path where tif file is located, or the contents of the file
+    time (str): Date and time of when the data was collected format YYYY-MM-DDThh:mm:ssZ
+    fname (str): Full path of where to store the file, including a filename ending in '.nc'
+    scale_offset (tuple, optional): (scales, offsets) of the bands of a file downloaded as native integers,
+                                    read from the day's sidecar if not given
+
+    Returns:
+    size (int): Size of the saved file in bytes
+    write_seconds (float or None): Seconds taken to write the file with the template writer
+    """
+    global frame_writer, frame_writer_transform
+    if worker_writer == 'xarray':
+        process_GOES_tif(tif, time, worker_latlon_pts, fname, scale_offset=scale_offset, encoding=worker_encoding,
+                         complevel=worker_complevel)
+        return os.path.getsize(fname), None
+
+    data, transform = read_GOES_arrays(tif, time, worker_latlon_pts, scale_offset)
+    if frame_writer is not None and transform == frame_writer_transform:
+        write_seconds = frame_writer.write(fname, time, data)
+        return os.path.getsize(fname), write_seconds
+
+    # First frame, or a file on a different grid than the template
+    geotiff_ds = build_GOES_dataset(tif, time, worker_latlon_pts, scale_offset=scale_offset, data=data)
+    encoding = xarray_encoding(geotiff_ds, worker_encoding, worker_complevel)
     geotiff_ds.to_netcdf(fname, format='NETCDF4', engine='h5netcdf')
+    if frame_writer is None:
+        frame_writer = GOESFrameWriter(geotiff_ds, encoding)
+        frame_writer_transform = transform
+    return os.path.getsize(fname), None
+
+
+def build_GOES_frame(tif, time, scale_offset=None):
+    """
+    Pool task that processes a .tif file on the worker's city grid.
+
+    Args:
+    tif (str or bytes): Path where tif file is located, or the contents of the file
+    time (str): Date and time of when the data was collected format YYYY-MM-DDThh:mm:ssZ
+    scale_offset (tuple, optional): (scales, offsets) of the bands of a file downloaded as native integers,
+                                    read from the day's sidecar if not given
+
+    Returns:
+    (xr.Dataset): Fully processed file as an xarray dataset
+    """
+    return build_GOES_dataset(tif, time, worker_latlon_pts, scale_offset=scale_offset).load()
 
 
 if __name__ == '__main__':
+    import pandas as pd
+    from goes_store import GOESStoreWriter
+
     parser = argparse.ArgumentParser(
                     prog='GOES_download',
                     description='Fast downloading for GOES images from GEE')
     parser.add_argument('--city', help='String of city from list of valid cities to make data for')
     parser.add_argument('--cpus', nargs='?', const=32, help='Number of CPU cores to run in parallel')
-    parser.add_argument('--section', nargs=1, help='Section of GOES files to process')
+    parser.add_argument('--n_shards', nargs='?', type=int, default=None,
+                        help='Number of shards to split the remaining frames into (one shard if neither --n_shards or --shard_size is set)')
+    parser.add_argument('--shard_size', nargs='?', type=int, default=None,
+                        help='Largest number of frames in a shard, used instead of --n_shards')
+    parser.add_argument('--shard', nargs='?', type=int, default=int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)),
+                        help='Shard to process (defaults to the SLURM array task id)')
+    parser.add_argument('--plan_dir', nargs='?', default='/scratch/zt1/project/mjmolina-prj/user/jonstar/GOES_plans',
+                        help='Directory of the shard plans and checkpoints')
+    parser.add_argument('--plan_only', action='store_true',
+                        help='Replace the saved shard plan with a new one from the frames still missing, then exit')
+    parser.add_argument('--ledger', nargs='?', default='/scratch/zt1/project/mjmolina-prj/user/jonstar/pipeline_ledger.db',
+                        help='SQLite ledger of the state of every frame')
+    parser.add_argument('--ledger_bootstrap', action='store_true',
+                        help='Record the outputs already on disk in the ledger (done automatically the first time a city is processed)')
+    parser.add_argument('--latlon_cache', nargs='?', default='/scratch/zt1/project/mjmolina-prj/user/jonstar/latlon_cache',
+                        help='Directory of cached latitude/longitude grids')
+    parser.add_argument('--mw_dir', nargs='?', default=MW_DIR,
+                        help='Directory of the daily microwave LST files')
+    parser.add_argument('--mw_cache_days', nargs='?', type=int, default=8,
+                        help='Number of daily microwave LST city windows each worker keeps in memory')
+    parser.add_argument('--output', nargs='?', default='files', choices=['files', 'store'],
+                        help='Write one netCDF file per frame (files) or append frames to consolidated time-chunked files (store)')
+    parser.add_argument('--store_period', nargs='?', default='city', choices=['city', 'month'],
+                        help='With --output=store, write one consolidated file per city or per city and month')
+    parser.add_argument('--writer', nargs='?', default='template', choices=['template', 'xarray'],
+                        help='With --output=files, write frames by filling in a per-city template file (template) or with xarray (xarray)')
+    parser.add_argument('--encoding', nargs='?', default='float64', choices=ENCODING_PROFILES,
+                        help='Encoding profile of the data variables, see encoding_profiles.py')
+    parser.add_argument('--complevel', nargs='?', type=int, default=None,
+                        help="gzip level 0-9 of the data variables (the encoding profile's default for per-frame files, 4 for --output=store)")
+    parser.add_argument('--chunksize', nargs='?', type=int, default=None,
+                        help='Number of frames sent to a worker at a time (chosen from the number of frames by default)')
+    parser.add_argument('--report_every', nargs='?', type=float, default=60,
+                        help='Seconds between progress messages')
+    parser.add_argument('--retry_list', nargs='?', default=None,
+                        help='csv file listing the frames that failed (defaults to the shard retry list in --plan_dir)')
     args = parser.parse_args()
+    mw_store = MicrowaveStore(args.mw_dir, args.mw_cache_days)
 
-    # Set projection to process data for a specific city
+    # Set the city to process data for
     # (look above for city options)
     city = args.city
-    city_zone = proj_zone[city]
-    if city_zone[1]:
-        crs_prefix = '326'
-    else:
-        crs_prefix = '327'
-    proj_code = f'EPSG:{crs_prefix}{city_zone[0]}'
-    utm_proj = Proj(projparams=proj_code)
 
     # GOES-West
     if city in ['Seattle', 'San_Francisco', 'Los_Angeles', 'San_Diego', 'Phoenix', 'Las_Vegas', 'Salt_Lake_City']:
-        g_times = pd.read_csv('/home/jonstar/urban_heat_dataset/GOES_West_times.csv').value
-        indices = [25268, 50755, 76786, 103146]
+        g_csv = pd.read_csv('/home/jonstar/urban_heat_dataset/GOES_West_times.csv')
     # GOES-East
     else:
-        g_times = pd.read_csv('/home/jonstar/urban_heat_dataset/GOES_East_times.csv').value
-        indices = [25994, 52337, 78338, 104730]
-
-
-    # Ensure there is a GOES directory made for the city and set it as the prefix to the filename
-    section = int(args.section[0])
-    if section == 1:
-        suffix = '2022_1'
-        start = 0
-        end = indices[0]
-    elif section == 2:
-        suffix = '2022_2'
-        start = indices[0]
-        end = indices[1]
-    elif section == 3:
-        suffix = '2023_1'
-        start = indices[1]
-        end = indices[2]
-    else:
-        suffix = '2023_2'
-        start = indices[2]
-        end = indices[3]
-    processed_dir = f'/scratch/zt1/project/mjmolina-prj/user/jonstar/processed_GOES_{city}_{suffix}'
-    subprocess.call(['mkdir', '-p', processed_dir])
+        g_csv = pd.read_csv('/home/jonstar/urban_heat_dataset/GOES_East_times.csv')
+    g_times = (g_csv.value.values//1000).astype(np.int64) # UTC seconds
+    GOES_dir = f'{SCRATCH_DIR}/{city}_GOES'
+    tif_paths = {t: f'{GOES_dir}/GOES_image_{time_str}.tif' for t, time_str in zip(g_times, g_csv.datetime)}
 
 
-    def sort_func_GOES(s):
+    def get_fname(t):
         """
-        Gets the datetime from a GOES file string.
-        Used to sort the list of files in a directory.
-
         Args:
-        s (str): Full file location string of a GOES file
+        t (int): Frame time in UTC seconds
 
         Returns:
-        (int): File datetime as an integer
+        (str): Full location of the processed per-frame file
         """
-        return int(s.split('image_')[1].split('.tif')[0])
-
-    # Calculate the UTM coordinates from one of the GOES files
-    GOES_tif_list = sorted(glob.glob(f'/scratch/zt1/project/mjmolina-prj/user/jonstar/{city}_GOES/*.tif'), key=sort_func_GOES)
-    dsG = rxr.open_rasterio(GOES_tif_list[0])
-    geotiff_dsG = dsG.to_dataset('band')
-
-    y, x = np.meshgrid(geotiff_dsG['y'], geotiff_dsG['x'])
-    utm_coords = np.stack((x,y)).T.reshape(-1,2) # Get list of y, x coordinates following coordinate structure (x changes first)
+        return get_processed_fname(city, t, tif_paths[t].split('_')[-1].split('.')[0])
 
-    def stacked_to_latlon(pt):
+    # With --output=store there is one writer per processed directory
+    writers = {}
+    def get_writer(t):
         """
-        Reprojects a point in UTM coordinates to
-        latitude and longitude coordinates.
-
         Args:
-        pt (tuple-like): Tuple with format (x coord, y coord) to reproject
+        t (int): Frame time in UTC seconds
 
         Returns:
-        (tuple): Tuple with format (longitude, latitude)
+        (GOESStoreWriter): Writer of the processed directory of the frame
         """
-        return utm_proj(pt[0], pt[1], inverse=True)
-
-    latlon_pts_2km_1d = np.array(list(map(stacked_to_latlon, utm_coords)))
-    latlon_pts_2km = latlon_pts_2km_1d.reshape((45,45,2))
-
-    # Close opened datasets
-    dsG.close()
-    geotiff_dsG.close()
-
-    # Finds indices of files that are not currently processed
-    file_index = np.arange(start, end)
-    full_file_list = [f'{processed_dir}/lresgrid_{city_ICAO_codes[city]}_{GOES_tif_list[i].split('_')[-1].split('.')[0]}.nc' for i in file_index]
-    current_file_list = sorted(glob.glob(f'{processed_dir}/*'))
-    missing_indices = np.where([x not in current_file_list for x in full_file_list])[0]
-    print('Length of missing indices:', len(missing_indices))
-
-    # Sets up inputs for the multiprocessing pool
-    inputs = [[GOES_tif_list[i], datetime.datetime.fromtimestamp(g_times[i]/1000, datetime.UTC).strftime('%Y-%m-%dT%H:%M:%SZ'), latlon_pts_2km, f'{processed_dir}/lresgrid_{city_ICAO_codes[city]}_{GOES_tif_list[i].split('_')[-1].split('.')[0]}.nc'] for i in file_index[missing_indices]]
+        processed_dir = get_processed_dir(city, t)
+        if processed_dir not in writers:
+            writers[processed_dir] = GOESStoreWriter(processed_dir, city_ICAO_codes[city], period=args.store_period,
+                                                     complevel=4 if args.complevel is None else args.complevel,
+                                                     encoding=args.encoding)
+        return writers[processed_dir]
+
+    # Load the shard plan, or plan the shards from the frames that are not processed yet.
+    # Plans of consolidated output depend on how the files are split, so the period is part of the name
+    plan_name = f'{city}_store_{args.store_period}' if args.output == 'store' else f'{city}_files'
+    plan_path = f'{args.plan_dir}/{plan_name}_plan.json'
+    if args.plan_only and os.path.exists(plan_path):
+        os.remove(plan_path)
+
+    # Frames already processed are looked up in the ledger. Outputs made before the ledger
+    # was used are recorded from one listing of each processed directory
+    ledger = PipelineLedger(args.ledger)
+    stage = 'store' if args.output == 'store' else 'process'
+    if args.ledger_bootstrap or not ledger.has_stage(city, stage):
+        processed_dirs = sorted({get_processed_dir(city, t) for t in g_times})
+        if args.output == 'store':
+            for processed_dir in processed_dirs:
+                for t in GOESStoreWriter(processed_dir, city_ICAO_codes[city], period=args.store_period).existing_times():
+                    ledger.record(city, stage, t)
+            ledger.flush()
+        else:
+            ledger.bootstrap(city, stage, {t: get_fname(t) for t in g_times})
+    done_times = ledger.times(city, stage)
+
+    # Settings the plan is made from. A saved plan made with other settings is not used
+    plan_inputs = {'first_time': int(g_times[0]), 'last_time': int(g_times[-1]), 'n_times': len(g_times),
+                   'n_shards': args.n_shards, 'shard_size': args.shard_size, 'output': args.output,
+                   'store_period': args.store_period if args.output == 'store' else None}
+    if os.path.exists(plan_path):
+        shards = load_plan(plan_path, plan_inputs)
+    else:
+        missing_times = [t for t in g_times if t not in done_times]
+        if args.output == 'store':
+            # Only one shard may write to each consolidated file
+            groups = [get_writer(t).store_path(get_frame_time(t)) for t in missing_times]
+        else:
+            # Keep the frames of a day together so workers reuse the day's microwave LST
+            groups = [t//86400 for t in missing_times]
+        print('Length of missing indices:', len(missing_times))
 
-    # Run multiprocessing pool
-    #print('Starting multiprocessing')
+        if args.n_shards is None and args.shard_size is None:
+            shards = plan_shards(missing_times, n_shards=1, groups=groups)
+        else:
+            shards = plan_shards(missing_times, args.n_shards, args.shard_size, groups)
+        shards = save_plan(plan_path, shards, plan_inputs)
+    print(f'{len(shards)} shards of sizes {[len(shard) for shard in shards]}')
+    if args.plan_only:
+        exit()
+    if args.shard >= len(shards):
+        print(f'Shard {args.shard} has no frames to process')
+        exit()
+
+    # Skip the frames of this shard that are already finished
+    shard_times = [t for t in shards[args.shard] if t not in done_times]
+    print(f'Shard {args.shard}: {len(shard_times)} frames to process')
+    for processed_dir in sorted({get_processed_dir(city, t) for t in shard_times}):
+        subprocess.call(['mkdir', '-p', processed_dir])
+
+    # Load the latitude/longitude grid of the GOES files, computing it from one of the files
+    # if no other job has cached it yet
+    GOES_tif = next(tif_paths[t] for t in shards[args.shard] + list(g_times) if os.path.exists(tif_paths[t]))
+    latlon_pts_2km = load_GOES_latlons(city, GOES_tif, args.latlon_cache)
+
+    # Run multiprocessing pool. The lat/lon grid and microwave LST store are set up once per worker,
+    # so each task is only the tif, its time and (for per-frame files) the output file name
     start = datetime.datetime.now()
     nCPUs = int(args.cpus)
-    pool = multiprocessing.Pool(nCPUs)
-    pool.starmap(process_GOES_tif, inputs)
-    pool.close()
-    pool.join()
+    initargs = (city, latlon_pts_2km, args.mw_dir, args.mw_cache_days, args.writer, args.encoding, args.complevel)
+    if args.output == 'store':
+        # Workers process the frames and this process appends them to the consolidated files.
+        # Frames are recorded in the ledger once the writers have committed them
+        tasks = [((tif_paths[t], get_frame_time(t)), (tif_paths[t], get_frame_time(t))) for t in shard_times]
+        finished = []
+        def on_result(key, geotiff_ds, seconds):
+            t = to_utc_seconds(key[1])[0]
+            get_writer(t).append(geotiff_ds)
+            finished.append((t, seconds))
+        failures = run_pool(build_GOES_frame, tasks, nCPUs, init_GOES_worker, initargs, args.chunksize, args.report_every, on_result)
+        for writer in writers.values():
+            writer.close()
+        for t, seconds in finished:
+            ledger.record(city, stage, t, seconds=seconds)
+    else:
+        tasks = [((tif_paths[t], get_frame_time(t)), (tif_paths[t], get_frame_time(t), get_fname(t))) for t in shard_times]
+        write_seconds = []
+        def on_result(key, result, seconds):
+            size, frame_write_seconds = result
+            ledger.record(city, stage, to_utc_seconds(key[1])[0], size=size, seconds=seconds, write_seconds=frame_write_seconds)
+            if frame_write_seconds is not None:
+                write_seconds.append(frame_write_seconds)
+        failures = run_pool(process_GOES_frame, tasks, nCPUs, init_GOES_worker, initargs, args.chunksize, args.report_every, on_result)
+        if write_seconds:
+            print(f'Template writes: {len(write_seconds)} frames, mean {np.mean(write_seconds)*1000:.2f} ms, '
+                  f'95th percentile {np.percentile(write_seconds, 95)*1000:.2f} ms')
+    for key, error in failures:
+        ledger.record(city, stage, to_utc_seconds(key[1])[0], state='failed', error=error)
+    ledger.close()
+
+    # Frames that failed are written out so they can be checked and rerun
+    retry_list = args.retry_list if args.retry_list else f'{args.plan_dir}/{plan_name}_shard{args.shard}_retry_list.csv'
+    if failures:
+        write_retry_list(retry_list, failures)
+        print(f'{len(failures)} frames failed, see {retry_list}')
+    elif os.path.exists(retry_list):
+        os.remove(retry_list)
 
     time_diff = datetime.datetime.now() - start
     print(f'Total time: {time_diff.total_seconds()} seconds')
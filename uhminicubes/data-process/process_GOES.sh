@@ -1,5 +1,11 @@
 #!/bin/bash
 
+# Submit as a job array, one task per shard, e.g. for 4 shards:
+#   sbatch --array=0-3 process_GOES.sh DMV 4
+# The first task to start plans the shards from the frames that are still missing.
+# Rerun the same command to finish any frames left by failed or timed out tasks
+# (run process_GOES.py with --plan_only first to replan the remaining frames).
+
 # Wall time limit
 #SBATCH -t 10:00:00
 
@@ -24,4 +30,4 @@ echo "First argument: $1"
 echo "Second argument: $2"
 
 cd /home/jonstar/ML_UH_datasets/Jon_dataset_code
-/tmp/$USER/heat/bin/python process_GOES.py --city=$1 --cpus=32 --section=$2
+/tmp/$USER/heat/bin/python process_GOES.py --city=$1 --cpus=32 --n_shards=$2 --shard=$SLURM_ARRAY_TASK_ID
@@ -0,0 +1,454 @@
+# Imported on first use: pandas, rasterio, rioxarray and h5netcdf
+import os
+import glob
+import math
+import argparse
+import datetime
+import resource
+import numpy as np
+from goes_scheduler import run_pool, write_retry_list
+from landsat_qa import to_qa_mask, QA_BITMASK_KEY
+from encoding_profiles import (ENCODING_PROFILES, LANDSAT_CHUNKS, variable_encoding, h5netcdf_variable_args, pack_values,
+                               unpack_values)
+from landsat_loader import coarsen_Landsat, coarsen_spatial_ref
+from process_GOES import city_str_dict, SCRATCH_DIR
+
+
+"""
+Processing of the Landsat 8/9 and Sentinel-1 GeoTIFFs of one or more cities into
+netCDF files, giving the same files as the Landsat cells of geotiff_processing.ipynb.
+Scenes of every city are processed in a worker pool, as in process_GOES.py.
+
+Instead of loading the whole GeoTIFF into an xarray dataset, each scene is read with
+rasterio windowed reads of only the 3000x3000 export grid, a block of rows at a time.
+Each block is masked in place and written straight into the output file, so the peak
+memory of a worker is set by --max_memory and not by the size of the scene. Loading the
+13 float64 bands with rioxarray, plus the copies made by masking them, takes about
+1.4 GB per scene.
+
+Bands are stored as float64 by default. --encoding=int16 packs them to int16 with a
+scale and offset and --encoding=float32 stores them as float32, both chunked in
+LANDSAT_CHUNKS tiles and compressed (see encoding_profiles.py).
+
+With --layout=tiled every band is chunked in LANDSAT_CHUNKS tiles whatever its encoding,
+and reduced-resolution overviews of every band are added in the groups 'overview_{factor}',
+so reads of small windows and thumbnails only touch the chunks they need. Such files are
+read with landsat_loader.py, and can also be opened with xarray as before.
+
+Example:
+    python process_Landsat.py --city=DMV,NYC --cpus=8 --max_memory=256 --encoding=int16 --layout=tiled
+"""
+
+# Width and height of the export grid in pixels. Exports can be a pixel larger and are cropped to it
+LANDSAT_SIZE = 3000
+
+# Variable name of each band of the Landsat/Sentinel-1 files, in band order
+LANDSAT_BANDS = ['Landsat_blue_sfc_reflectance', 'Landsat_green_sfc_reflectance', 'Landsat_red_sfc_reflectance',
+                 'Landsat_NIR_sfc_reflectance', 'Landsat_SWIR1_sfc_reflectance', 'Landsat_SWIR2_sfc_reflectance',
+                 'Landsat_LST', 'Landsat_cloud_mask', 'Sentinel1_VV', 'Sentinel1_VH', 'Sentinel1_HH',
+                 'Sentinel1_HV', 'Sentinel1_incidence_angle']
+
+# Sentinel-1 bands filled with values above 1 where there is no Sentinel-1 image
+SENTINEL1_BACKSCATTER = ['Sentinel1_VV', 'Sentinel1_VH', 'Sentinel1_HH', 'Sentinel1_HV']
+
+# Variable metadata
+reflectance_attrs = {'standard_name': 'surface_bidirectional_reflectance', 'units': '1', 'valid_min': 0, 'valid_max': 1,
+                     'missing_value': np.nan}
+backscatter_attrs = {'standard_name': 'surface_backwards_scattering_coefficient_of_radar_wave', 'units': 'dB',
+                     'valid_max': 1, 'missing_value': np.nan, 'wavelength': '5.55 cm'}
+LANDSAT_ATTRS = {
+    'Landsat_blue_sfc_reflectance': dict(reflectance_attrs, wavelength='0.452-0.512 μm'),
+    'Landsat_green_sfc_reflectance': dict(reflectance_attrs, wavelength='0.533-0.590 μm'),
+    'Landsat_red_sfc_reflectance': dict(reflectance_attrs, wavelength='0.636-0.673 μm'),
+    'Landsat_NIR_sfc_reflectance': dict(reflectance_attrs, wavelength='0.851-0.879 μm'),
+    'Landsat_SWIR1_sfc_reflectance': dict(reflectance_attrs, wavelength='1.566-1.651 μm'),
+    'Landsat_SWIR2_sfc_reflectance': dict(reflectance_attrs, wavelength='2.107-2.294 μm'),
+    'Landsat_LST': {'standard_name': 'surface_temperature', 'units': 'K', 'valid_min': 0, 'valid_max': 373,
+                    'missing_value': np.nan, 'wavelength': '10.60-11.19 μm'},
+    # Pixels without data have the fill bit set
+    'Landsat_cloud_mask': {'bitmask_key': QA_BITMASK_KEY, 'standard_name': 'quality_flag', 'long_name': 'pixel quality mask'},
+    'Sentinel1_VV': backscatter_attrs,
+    'Sentinel1_VH': backscatter_attrs,
+    'Sentinel1_HH': backscatter_attrs,
+    'Sentinel1_HV': backscatter_attrs,
+    'Sentinel1_incidence_angle': {'standard_name': 'angle_of_incidence', 'units': 'degree', 'valid_min': 0, 'valid_max': 90,
+                                  'missing_value': np.nan},
+}
+
+# Rows of the export grid read and written at a time, the GDAL block cache in MB, the encoding
+# profile and gzip level of the bands, and whether they are tiled and their overview factors,
+# set by init_Landsat_worker
+worker_block_rows = LANDSAT_SIZE
+worker_cache_mb = 64
+worker_encoding = 'float64'
+worker_complevel = None
+worker_tiled = False
+worker_overviews = []
+
+
+def get_scene_time_str(tif):
+    """
+    Args:
+    tif (str): Path of a Landsat/Sentinel-1 file, named as in Landsat_download.ipynb, e.g.
+               Landsat9_Sentinel_image_DMV_202201081546.tif
+
+    Returns:
+    (str): Scene time in format of 'YYYYmmddHHMM'
+    """
+    return os.path.basename(tif).split('_')[-1].split('.tif')[0]
+
+
+def load_Landsat_times(times_dir, city):
+    """
+    Loads the exact scene times of a city, exported next to the files by Landsat_download.ipynb,
+    since the file names leave out the seconds.
+
+    Args:
+    times_dir (str): Directory of the Landsat*_times_{city}.csv files
+    city (str): City name from the list of valid cities
+
+    Returns:
+    (dict): {time string 'YYYYmmddHHMM': scene time in UTC milliseconds}
+    """
+    import pandas as pd
+    times = {}
+    for path in sorted(glob.glob(f'{times_dir}/Landsat*_times_{city}.csv')):
+        for t in pd.read_csv(path).value.values:
+            times[datetime.datetime.fromtimestamp(t/1000, datetime.UTC).strftime('%Y%m%d%H%M')] = int(t)
+    return times
+
+
+def plan_blocks(max_memory, n_bands, itemsize, tile_height=None, chunk_height=None):
+    """
+    Chooses how many rows of the export grid are read at a time to stay within a memory budget.
+    An eighth of the budget goes to the GDAL block cache and the rest to the block of rows, which
+    is held twice (as read, and flipped for writing).
+
+    Args:
+    max_memory (float): Memory budget of a worker in MB, on top of the interpreter and libraries
+    n_bands (int): Number of bands read at a time
+    itemsize (int): Bytes per pixel of each band
+    tile_height (int, optional): Height of the GeoTIFF tiles. Blocks are whole tiles when they can be,
+                                 so no tile is decoded twice
+    chunk_height (int, optional): Height of the chunks of chunked output. Blocks are always whole
+                                  chunk rows, so no chunk is compressed twice, and this takes
+                                  precedence over tile_height
+
+    Returns:
+    block_rows (int): Rows read at a time
+    cache_mb (int): Size of the GDAL block cache in MB
+    """
+    cache_mb = max(1, int(max_memory/8))
+    row_bytes = 2*n_bands*LANDSAT_SIZE*itemsize
+    block_rows = int(min(LANDSAT_SIZE, max(1, (max_memory - cache_mb)*2**20//row_bytes)))
+    if chunk_height:
+        block_rows = max(chunk_height, block_rows - block_rows % chunk_height)
+    elif tile_height and block_rows > tile_height:
+        block_rows -= block_rows % tile_height
+    return block_rows, cache_mb
+
+
+def init_Landsat_worker(block_rows, cache_mb, encoding='float64', complevel=None, tiled=False, overviews=None):
+    """
+    Sets the block size, GDAL cache and output encoding and layout of a pool worker.
+
+    Args:
+    block_rows (int): Rows of the export grid read and written at a time
+    cache_mb (int): Size of the GDAL block cache in MB
+    encoding (str): Encoding profile of the bands from ENCODING_PROFILES
+    complevel (int, optional): gzip level 0-9, the profile's default if not given
+    tiled (boolean): Chunk the bands in LANDSAT_CHUNKS tiles even if they are not compressed
+    overviews (list, optional): Reduction factors of the overviews to add, each dividing LANDSAT_SIZE
+    """
+    global worker_block_rows, worker_cache_mb, worker_encoding, worker_complevel, worker_tiled, worker_overviews
+    worker_block_rows = block_rows
+    worker_cache_mb = cache_mb
+    worker_encoding = encoding
+    worker_complevel = complevel
+    worker_tiled = tiled
+    worker_overviews = sorted(overviews) if overviews else []
+
+
+def mask_Landsat_block(var, block):
+    """
+    Sets the anomalous values of a block of a band to NaN, in place, and converts the cloud mask to uint16.
+
+    Args:
+    var (str): Variable name of the band
+    block (float array): (rows,x) Values of the band
+
+    Returns:
+    (array): (rows,x) Masked values
+    """
+    if var in SENTINEL1_BACKSCATTER:
+        block[block > 1] = np.nan
+    elif var == 'Sentinel1_incidence_angle':
+        block[block < 0] = np.nan
+    elif var == 'Landsat_cloud_mask':
+        return to_qa_mask(block)
+    return block
+
+
+def create_Landsat_file(f, x, y, time, spatial_ref_attrs, attrs, encodings):
+    """
+    Creates the dimensions, coordinates and variables of a processed Landsat/Sentinel-1 file,
+    with the same layout and metadata as xarray.Dataset.to_netcdf gives in geotiff_processing.ipynb.
+
+    Args:
+    f (h5netcdf.File): Newly created file
+    x (float array): UTM eastings of the grid columns
+    y (float array): UTM northings of the grid rows, increasing with index
+    time (str): Date and time of the scene in format YYYY-MM-DDThh:mm:ssZ
+    spatial_ref_attrs (dict): Attributes of the 'spatial_ref' grid mapping, as set by rioxarray
+    attrs (dict): File attributes
+    encodings (dict): {variable: (kwargs, attrs)} create_variable arguments and packing attributes of each band,
+                      from h5netcdf_variable_args
+    """
+    import h5py
+    f.dimensions = {'y': len(y), 'x': len(x)}
+    f.attrs.update(attrs)
+
+    for coord, values, attr_values in [('x', x, ('projection_x_coordinate', 'UTM Easting')),
+                                       ('y', y, ('projection_y_coordinate', 'UTM Northing'))]:
+        v = f.create_variable(coord, (coord,), dtype=values.dtype, fillvalue=np.nan)
+        v[:] = values
+        v.attrs.update({'standard_name': attr_values[0], 'long_name': attr_values[1], 'units': 'm'})
+
+    v = f.create_variable('datetime', (), dtype=h5py.string_dtype())
+    v[()] = time
+    v.attrs.update({'long_name': 'datetime', 'units': 'YYYY-mm-DDTHH:MM:SSZ', 'calendar': 'utc'})
+
+    for var in LANDSAT_BANDS:
+        kwargs, packing_attrs = encodings[var]
+        v = f.create_variable(var, ('y', 'x'), **kwargs)
+        if var != 'Landsat_cloud_mask':
+            v.attrs['grid_mapping'] = 'spatial_ref'
+        # Missing values of packed bands are marked by _FillValue
+        v.attrs.update({k: val for k, val in LANDSAT_ATTRS[var].items() if not (packing_attrs and k == 'missing_value')})
+        v.attrs.update(packing_attrs)
+        v.attrs['coordinates'] = 'datetime'
+
+    v = f.create_variable('spatial_ref', (), dtype=np.int64)
+    v[()] = 0
+    v.attrs.update(spatial_ref_attrs)
+
+
+def overview_chunks(factor):
+    """
+    Args:
+    factor (int): Reduction factor of an overview
+
+    Returns:
+    (tuple): (y,x) Chunk shape of the overview, the largest square no larger than LANDSAT_CHUNKS
+             whose side divides the overview, so there are no partial edge chunks
+    """
+    size = LANDSAT_SIZE//factor
+    side = max(d for d in range(1, min(LANDSAT_CHUNKS[0], size) + 1) if size % d == 0)
+    return (side, side)
+
+
+def write_Landsat_overviews(f, factors, dtypes, spatial_ref_attrs):
+    """
+    Adds reduced-resolution overviews of every band to a processed file, each in a group
+    'overview_{factor}' with its own coordinates and grid mapping. Every overview is made
+    from the full-resolution bands with coarsen_Landsat, which are read back in square
+    windows that hold whole chunks of every overview, so each chunk is read and written once.
+
+    Args:
+    f (h5netcdf.File): File with the full-resolution bands written
+    factors (list): Reduction factors, each dividing LANDSAT_SIZE
+    dtypes (dict): Data type of each band before encoding
+    spatial_ref_attrs (dict): Attributes of the full-resolution 'spatial_ref' grid mapping
+    """
+    #########################################################################################################
+    # Coordinates, grid mapping and empty bands of each overview
+    encodings = {}
+    for factor in factors:
+        size = LANDSAT_SIZE//factor
+        g = f.create_group(f'overview_{factor}')
+        g.dimensions = {'y': size, 'x': size}
+        for coord in ['x', 'y']:
+            v = g.create_variable(coord, (coord,), dtype=f.variables[coord].dtype, fillvalue=np.nan)
+            # Centers of the blocks of pixels averaged together
+            v[:] = f.variables[coord][:].reshape(size, factor).mean(axis=1)
+            v.attrs.update({k: val for k, val in f.variables[coord].attrs.items() if k != '_FillValue'})
+
+        for var in LANDSAT_BANDS:
+            encodings[factor, var] = variable_encoding(var, dtypes[var], worker_encoding, worker_complevel,
+                                                       overview_chunks(factor), tiled=True)
+            kwargs, packing_attrs = h5netcdf_variable_args(encodings[factor, var], dtypes[var])
+            v = g.create_variable(var, ('y', 'x'), **kwargs)
+            v.attrs.update({k: val for k, val in f.variables[var].attrs.items() if k not in ['_FillValue', 'coordinates']})
+
+        v = g.create_variable('spatial_ref', (), dtype=np.int64)
+        v[()] = 0
+        v.attrs.update(coarsen_spatial_ref(spatial_ref_attrs, factor))
+
+    #########################################################################################################
+    # Read the bands a window at a time and write the window of every overview
+    window = math.lcm(*[overview_chunks(factor)[0]*factor for factor in factors])
+    for row in range(0, LANDSAT_SIZE, window):
+        for col in range(0, LANDSAT_SIZE, window):
+            for var in LANDSAT_BANDS:
+                v = f.variables[var]
+                values = unpack_values(v[row:row+window, col:col+window], v.attrs)
+                for factor in factors:
+                    f.groups[f'overview_{factor}'].variables[var][row//factor:(row+window)//factor, col//factor:(col+window)//factor] = \
+                        pack_values(coarsen_Landsat(var, values, factor), encodings[factor, var])
+
+
+def process_Landsat_scene(tif, time, fname, city):
+    """
+    Pool task that processes a Landsat/Sentinel-1 .tif file and saves it as a netCDF file.
+    The file is written to a temporary name first so that a partial file is never left at fname.
+
+    Args:
+    tif (str): Path where tif file is located
+    time (str): Date and time of the scene in format YYYY-MM-DDThh:mm:ssZ
+    fname (str): Full path of where to store the file, including a filename ending in '.nc'
+    city (str): City name from the list of valid cities
+
+    Returns:
+    size (int): Size of the saved file in bytes
+    peak_memory (float): Peak resident memory of the worker so far in MB
+    """
+    import rasterio
+    from rasterio.windows import Window
+    import rioxarray as rxr
+    import h5netcdf
+
+    #########################################################################################################
+    # Coordinates and georeferencing of the export grid, from the file header without reading any band.
+    # Rows are flipped so that y increases with index
+    with rxr.open_rasterio(tif) as dsLS:
+        dsLS = dsLS[:, :LANDSAT_SIZE, :LANDSAT_SIZE]
+        x = dsLS['x'].values
+        y = dsLS['y'].values[::-1]
+        spatial_ref_attrs = dict(dsLS['spatial_ref'].attrs)
+        attrs = {k: v for k, v in dsLS.attrs.items() if k != 'long_name'}
+    attrs['title'] = f'Landsat 8/9 and Sentinel-1 data for {city_str_dict[city]}'
+    attrs['institution'] = 'University of Maryland, College Park'
+    attrs['source'] = 'Satellite observation'
+
+    #########################################################################################################
+    # Read, mask and write the export grid a block of rows at a time
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    try:
+        with rasterio.Env(GDAL_CACHEMAX=worker_cache_mb), rasterio.open(tif) as src, h5netcdf.File(tmp_fname, 'w') as f:
+            if src.count != len(LANDSAT_BANDS):
+                raise ValueError(f'{src.count} bands instead of {len(LANDSAT_BANDS)}')
+            if src.width < LANDSAT_SIZE or src.height < LANDSAT_SIZE:
+                raise ValueError(f'{src.width}x{src.height} pixels, smaller than the {LANDSAT_SIZE}x{LANDSAT_SIZE} export grid')
+            dtypes = {var: np.uint16 if var == 'Landsat_cloud_mask' else src.dtypes[0] for var in LANDSAT_BANDS}
+            encodings = {var: variable_encoding(var, dtypes[var], worker_encoding, worker_complevel, LANDSAT_CHUNKS, worker_tiled)
+                         for var in LANDSAT_BANDS}
+            create_Landsat_file(f, x, y, time, spatial_ref_attrs, attrs,
+                                {var: h5netcdf_variable_args(encodings[var], dtypes[var]) for var in LANDSAT_BANDS})
+
+            for row in range(0, LANDSAT_SIZE, worker_block_rows):
+                rows = min(worker_block_rows, LANDSAT_SIZE - row)
+                block = src.read(window=Window(0, row, LANDSAT_SIZE, rows))
+                out_rows = slice(LANDSAT_SIZE - row - rows, LANDSAT_SIZE - row)
+                for b, var in enumerate(LANDSAT_BANDS):
+                    f.variables[var][out_rows] = pack_values(mask_Landsat_block(var, block[b])[::-1], encodings[var])
+                del block
+
+            if worker_overviews:
+                write_Landsat_overviews(f, worker_overviews, dtypes, spatial_ref_attrs)
+        os.replace(tmp_fname, fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+
+    return os.path.getsize(fname), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    prog='process_Landsat',
+                    description='Processes the Landsat 8/9 and Sentinel-1 GeoTIFFs of one or more cities into netCDF files')
+    parser.add_argument('--city', help='Comma-separated cities from the list of valid cities, or "all"')
+    parser.add_argument('--cpus', nargs='?', const=32, default=32, help='Number of CPU cores to run in parallel')
+    parser.add_argument('--max_memory', nargs='?', type=float, default=256,
+                        help='Memory budget of each worker in MB for the rows of a scene it holds at a time')
+    parser.add_argument('--dir', nargs='?', default=SCRATCH_DIR,
+                        help='Directory with a {city}/Landsat directory of GeoTIFFs for each city. '
+                             'Processed files are written to {city}/processed_Landsat')
+    parser.add_argument('--times_dir', nargs='?', default=None,
+                        help='Directory of the Landsat*_times_{city}.csv files ({dir}/Landsat_times by default)')
+    parser.add_argument('--encoding', nargs='?', default='float64', choices=ENCODING_PROFILES,
+                        help='Encoding profile of the bands, see encoding_profiles.py')
+    parser.add_argument('--complevel', nargs='?', type=int, default=None,
+                        help="gzip level 0-9 of the bands (the encoding profile's default if not given)")
+    parser.add_argument('--layout', nargs='?', default='contiguous', choices=['contiguous', 'tiled'],
+                        help='Store the bands as they are (contiguous), or chunked in tiles with overviews (tiled)')
+    parser.add_argument('--overviews', nargs='?', default='2,4,8',
+                        help='With --layout=tiled, comma-separated reduction factors of the overviews, each dividing 3000')
+    parser.add_argument('--overwrite', action='store_true', help='Process scenes that already have a processed file')
+    parser.add_argument('--report_every', nargs='?', type=float, default=60, help='Seconds between progress messages')
+    parser.add_argument('--retry_list', nargs='?', default=None,
+                        help='csv file listing the scenes that failed ({dir}/Landsat_retry_list.csv by default)')
+    args = parser.parse_args()
+
+    cities = sorted(city_str_dict) if args.city == 'all' else args.city.split(',')
+    tiled = args.layout == 'tiled'
+    overviews = [int(factor) for factor in args.overviews.split(',') if factor] if tiled else []
+    if any(factor < 2 or LANDSAT_SIZE % factor for factor in overviews):
+        raise ValueError(f'Overview factors must divide {LANDSAT_SIZE}, not {args.overviews}')
+    times_dir = args.times_dir if args.times_dir else f'{args.dir}/Landsat_times'
+
+    # Scenes of every city that are not processed yet
+    tasks = []
+    n_estimated = 0
+    for city in cities:
+        out_dir = f'{args.dir}/{city}/processed_Landsat'
+        os.makedirs(out_dir, exist_ok=True)
+        scene_times = load_Landsat_times(times_dir, city)
+        for tif in sorted(glob.glob(f'{args.dir}/{city}/Landsat/Landsat*_{city}_*.tif'), key=get_scene_time_str):
+            fname = f'{out_dir}/{os.path.basename(tif)[:-len(".tif")]}.nc'
+            if os.path.exists(fname) and not args.overwrite:
+                continue
+            time_str = get_scene_time_str(tif)
+            if time_str in scene_times:
+                t = datetime.datetime.fromtimestamp(scene_times[time_str]/1000, datetime.UTC)
+            else:
+                # Scenes missing from the times files are given the time of their file name
+                t = datetime.datetime.strptime(time_str, '%Y%m%d%H%M')
+                n_estimated += 1
+            tasks.append(((tif, time_str), (tif, t.strftime('%Y-%m-%dT%H:%M:%SZ'), fname, city)))
+    print(f'{len(tasks)} scenes to process in {len(cities)} cities')
+    if n_estimated:
+        print(f'{n_estimated} scenes are not in the times files in {times_dir}, their times are from the file names')
+    if not tasks:
+        exit()
+
+    # Size the blocks of rows from the first file, all files of the export have the same layout.
+    # Chunked output is written a whole row of chunks at a time
+    import rasterio
+    chunked = 'chunksizes' in variable_encoding(LANDSAT_BANDS[0], 'float64', args.encoding, args.complevel, tiled=tiled)
+    with rasterio.open(tasks[0][1][0]) as src:
+        block_rows, cache_mb = plan_blocks(args.max_memory, src.count, np.dtype(src.dtypes[0]).itemsize,
+                                           src.block_shapes[0][0] if src.block_shapes[0][0] < src.height else None,
+                                           LANDSAT_CHUNKS[0] if chunked else None)
+    print(f'Reading {block_rows} rows at a time with a {cache_mb} MB GDAL cache')
+
+    start = datetime.datetime.now()
+    peak_memory = []
+    def on_result(key, result, seconds):
+        peak_memory.append(result[1])
+    failures = run_pool(process_Landsat_scene, tasks, int(args.cpus), init_Landsat_worker,
+                        (block_rows, cache_mb, args.encoding, args.complevel, tiled, overviews),
+                        chunksize=1, report_every=args.report_every, on_result=on_result)
+    if peak_memory:
+        print(f'Peak worker memory: {max(peak_memory):.0f} MB')
+
+    # Scenes that failed are written out so they can be checked and rerun
+    retry_list = args.retry_list if args.retry_list else f'{args.dir}/Landsat_retry_list.csv'
+    if failures:
+        write_retry_list(retry_list, failures)
+        print(f'{len(failures)} scenes failed, see {retry_list}')
+    elif os.path.exists(retry_list):
+        os.remove(retry_list)
+
+    time_diff = datetime.datetime.now() - start
+    print(f'Total time: {time_diff.total_seconds()} seconds')
@@ -0,0 +1,33 @@
+#!/bin/bash
+
+# Processes the Landsat/Sentinel-1 scenes of one or more cities, e.g.
+#   sbatch process_Landsat.sh DMV,NYC
+# Scenes that are already processed are skipped, so rerun the same command
+# to finish any scenes left by a failed or timed out job.
+# Each worker holds --max_memory MB of a scene on top of about 150 MB for
+# Python and its libraries, which stays inside the memory per CPU core below.
+
+# Wall time limit
+#SBATCH -t 4:00:00
+
+# Number of CPU nodes
+#SBATCH -n 1
+
+# Number of CPU cores
+#SBATCH -c 32
+
+# Memory per CPU core
+#SBATCH --mem-per-cpu=512
+
+#export PATH=/home/jonstar/scratch/condaroot/miniforge3-24.11.3/bin:$PATH
+#source activate heat
+~/scratch/conda-pack-unpacker.sh -f ~/scratch/heat.tar.gz
+if [ $? -ne 0 ]; then
+    echo "[ERROR] Error unpackaging ~/scratch/foo.tar.gz"
+    exit 1
+fi
+
+echo "First argument: $1"
+
+cd /home/jonstar/ML_UH_datasets/Jon_dataset_code
+/tmp/$USER/heat/bin/python process_Landsat.py --city=$1 --cpus=32 --max_memory=256
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+"""
+Regridding of the 0.25 degree microwave LST grid to the GOES export grid.
+The source and target geometry of a city never change, so the nearest-neighbour
+indices are computed once per city and then applied to whole (time, longitude,
+latitude) blocks as a single gather.
+"""
+
+
+def build_nearest_map(mw_longitudes, mw_latitudes, latlon_pts):
+    """
+    Finds the nearest microwave LST grid cell of every target point. Gives the
+    same result as scipy.interpolate.griddata(..., method='nearest').
+
+    Args:
+    mw_longitudes (float array): Longitudes of the microwave LST window
+    mw_latitudes (float array): Latitudes of the microwave LST window
+    latlon_pts (float array): (n,m,2) Array of (longitude, latitude) target points
+
+    Returns:
+    (int array): (n,m) Array of flat indices into a (longitude, latitude) window
+    """
+    # Imported on first use, since scipy takes longer to import than the map takes to build
+    from scipy.spatial import cKDTree
+    lon, lat = np.meshgrid(mw_longitudes, mw_latitudes, indexing='ij')
+    tree = cKDTree(np.stack((lon.ravel(), lat.ravel()), axis=-1))
+    _, indices = tree.query(latlon_pts.reshape(-1, 2))
+    return indices.reshape(latlon_pts.shape[:-1])
+
+
+class RegridMap:
+    """
+    Precomputed regridding from a microwave LST city window to a target grid.
+    """
+    def __init__(self, mw_longitudes, mw_latitudes, latlon_pts):
+        """
+        Args:
+        mw_longitudes (float array): Longitudes of the microwave LST window
+        mw_latitudes (float array): Latitudes of the microwave LST window
+        latlon_pts (float array): (n,m,2) Array of (longitude, latitude) target points
+        """
+        self.indices = build_nearest_map(mw_longitudes, mw_latitudes, latlon_pts)
+        self.shape = latlon_pts.shape[:-1]
+
+    def apply(self, block):
+        """
+        Regrids every time step of a block.
+
+        Args:
+        block (array): (t, n_lon, n_lat) Array of microwave LST values
+
+        Returns:
+        (float array): (t,n,m) Array of values on the target grid
+        """
+        flat = block.reshape(block.shape[0], -1)
+        return flat[:, self.indices]
+
+    def apply_time_indices(self, block, time_indices):
+        """
+        Regrids a block while selecting a different time step for every target point.
+        Only the values that are needed are gathered.
+
+        Args:
+        block (array): (t, n_lon, n_lat) Array of microwave LST values
+        time_indices (int array): (...,n,m) Array of time steps of the block to select for every target point.
+                                  Leading dimensions are kept, so a batch of frames is regridded in one call.
+
+        Returns:
+        (float array): (...,n,m) Array of values on the target grid
+        """
+        flat = block.reshape(block.shape[0], -1)
+        return flat[time_indices, self.indices]
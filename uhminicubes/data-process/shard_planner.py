@@ -0,0 +1,115 @@
+import os
+import json
+import numpy as np
+
+
+"""
+Splits the GOES frames that still need processing into balanced shards, for
+SLURM array jobs or for several local processes. The plan is saved once per
+city, with the settings it was made from, so every shard of a job array works
+from the same split and a run with other settings does not reuse it. Finished frames
+are recorded in the pipeline ledger, so rerunning a shard only processes the
+frames that are still missing.
+"""
+
+
+def period_suffix(utc_seconds):
+    """
+    Returns the half-year a frame belongs to, as used in the processed GOES directory names.
+
+    Args:
+    utc_seconds (int): Frame time in seconds since 1970-01-01
+
+    Returns:
+    (str): 'YYYY_1' for January-June or 'YYYY_2' for July-December
+    """
+    date = str(np.datetime64(int(utc_seconds), 's'))
+    return f'{date[:4]}_{1 if int(date[5:7]) <= 6 else 2}'
+
+
+def plan_shards(items, n_shards=None, shard_size=None, groups=None):
+    """
+    Splits a time-ordered list of work items into contiguous shards of about the same size.
+    Keeping shards contiguous in time lets each worker reuse its daily microwave LST reads.
+
+    Args:
+    items (list): Work items in time order
+    n_shards (int, optional): Number of shards to make
+    shard_size (int, optional): Largest number of items in a shard, used instead of n_shards
+    groups (list, optional): Group key of each item. Items of the same group are never split
+                             between shards (for example all frames of one output file)
+
+    Returns:
+    (list): List of shards, each a list of items
+    """
+    if (n_shards is None) == (shard_size is None):
+        raise Exception("Please set one of ``n_shards`` or ``shard_size``.")
+    if len(items) == 0:
+        return []
+    if n_shards is None:
+        n_shards = int(np.ceil(len(items)/shard_size))
+    if groups is None:
+        groups = range(len(items))
+
+    # Start index of each run of items with the same group
+    groups = list(groups)
+    starts = [i for i in range(len(items)) if i == 0 or groups[i] != groups[i-1]]
+
+    # Cut at the group start closest to each multiple of len(items)/n_shards
+    cuts = [0]
+    for k in range(1, n_shards):
+        target = k*len(items)/n_shards
+        cut = min(starts, key=lambda s: abs(s - target))
+        if cut > cuts[-1]:
+            cuts.append(cut)
+    cuts.append(len(items))
+    return [items[cuts[k]:cuts[k+1]] for k in range(len(cuts) - 1)]
+
+
+def save_plan(path, shards, inputs=None):
+    """
+    Saves a plan unless another process has already saved one, in which case that plan is kept.
+    The plan is written to a temporary file first, so a partially written plan is never read.
+
+    Args:
+    path (str): Location of the plan file
+    shards (list): List of shards, each a list of frame times in UTC seconds
+    inputs (dict, optional): JSON-serializable settings the plan was made from (frame range, shard
+                             count or size, output), checked by load_plan
+
+    Returns:
+    (list): The shards of the plan that is saved at path
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'inputs': inputs, 'shards': [[int(t) for t in shard] for shard in shards]}, f)
+    try:
+        # Linking fails if the plan already exists, so only the first process's plan is used
+        os.link(tmp_path, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    return load_plan(path, inputs)
+
+
+def load_plan(path, inputs=None):
+    """
+    Loads a plan, checking that it was made from the same settings as the current run. A plan
+    made for another frame range or shard split would process the wrong frames, so it is an error.
+
+    Args:
+    path (str): Location of the plan file
+    inputs (dict, optional): Settings of the current run, as given to save_plan
+
+    Returns:
+    (list): List of shards, each a list of frame times in UTC seconds
+    """
+    with open(path) as f:
+        plan = json.load(f)
+    if plan.get('inputs') != inputs:
+        raise ValueError(f"The plan at {path} was made with {plan.get('inputs')}, not {inputs}. "
+                         "Rerun with --plan_only to replan the remaining frames.")
+    return plan['shards']
+
@@ -0,0 +1,182 @@
+import os
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+import h5py
+from grid_transform import utm_crs, grid_to_latlon
+from mw_store import city_bbox, MW_LONGITUDES, MW_LATITUDES, MW_STEPS_PER_DAY
+from goes_calibration import GOES_FILL_VALUE, scale_offset_path, save_scale_offset
+
+
+"""
+Synthetic GOES GeoTIFFs, Landsat/Sentinel-1 GeoTIFFs and microwave LST files with
+the same layout as the real data, for benchmarks and for testing the pipeline
+without Earth Engine or the scratch filesystem.
+"""
+
+GOES_SIZE = 45
+GOES_RESOLUTION = 2000
+GOES_BAND_COUNT = 4
+
+# Scale and offset of the 12-bit packed C13..C16 bands, from their valid ranges in process_GOES.py
+GOES_SCALES = [(341.27 - 89.62)/4095, (341.28 - 96.19)/4095, (341.28 - 97.38)/4095, (318.26 - 92.7)/4095]
+GOES_OFFSETS = [89.62, 96.19, 97.38, 92.7]
+
+# Earth Engine exports of the 90km Landsat/Sentinel-1 region are one pixel wider than the 3000x3000 grid
+LANDSAT_SIZE = 3001
+LANDSAT_RESOLUTION = 30
+LANDSAT_BAND_COUNT = 13
+
+# Band names of the Landsat/Sentinel-1 exports, in band order
+LANDSAT_EXPORT_BANDS = ['SR_B2', 'SR_B3', 'SR_B4', 'SR_B5', 'SR_B6', 'SR_B7', 'ST_B10', 'QA_PIXEL', 'VV', 'VH', 'HH', 'HV', 'angle']
+
+# QA_PIXEL values of clear land, water, cloud, cloud shadow and snow pixels
+LANDSAT_QA_VALUES = [21824, 21952, 22280, 23888, 30048]
+
+
+def GOES_transform(city_export):
+    """
+    Returns the GeoTransform of a city's GOES export, the 45x45 2km grid around the
+    center of the 3000x3000 30m Landsat export.
+
+    Args:
+    city_export (list): [UTM zone, Boolean T/F for Northern Hemisphere/Southern Hemisphere, UTM x for export, UTM y for export]
+
+    Returns:
+    (affine.Affine): GeoTransform of the GOES grid
+    """
+    center_x = city_export[2] + 30*2999/2
+    center_y = city_export[3] - 30*2999/2
+    half_width = GOES_SIZE*GOES_RESOLUTION/2
+    return from_origin(center_x - half_width, center_y + half_width, GOES_RESOLUTION, GOES_RESOLUTION)
+
+
+def GOES_grid_latlons(city_export):
+    """
+    Args:
+    city_export (list): City export coordinates, see GOES_transform
+
+    Returns:
+    (float array): (45,45,2) Array of (longitude, latitude) points of the GOES grid, with y decreasing with index
+    """
+    transform = GOES_transform(city_export)
+    x = transform.c + GOES_RESOLUTION*(np.arange(GOES_SIZE) + 0.5)
+    y = transform.f - GOES_RESOLUTION*(np.arange(GOES_SIZE) + 0.5)
+    return grid_to_latlon(x, y, utm_crs(city_export))
+
+
+def GOES_tif_bytes(city_export, seed=0, dtype='float64', native=False):
+    """
+    Makes a synthetic 4-band GOES GeoTIFF of brightness temperatures in memory.
+
+    Args:
+    city_export (list): City export coordinates, see GOES_transform
+    seed (int): Random seed of the band values
+    dtype (str): Data type of the bands
+    native (boolean): Pack the same brightness temperatures into int16 with GOES_SCALES and GOES_OFFSETS,
+                      as downloaded with GOES_download.py --native
+
+    Returns:
+    (bytes): Contents of the GeoTIFF file
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.uniform(200, 320, (GOES_BAND_COUNT, GOES_SIZE, GOES_SIZE)).astype(dtype)
+    nodata = np.nan
+    if native:
+        dtype, nodata = 'int16', GOES_FILL_VALUE
+        values = np.round((values - np.array(GOES_OFFSETS)[:, None, None])/np.array(GOES_SCALES)[:, None, None]).astype(dtype)
+    with MemoryFile() as memfile:
+        with memfile.open(driver='GTiff', width=GOES_SIZE, height=GOES_SIZE, count=GOES_BAND_COUNT, dtype=dtype,
+                          crs=utm_crs(city_export), transform=GOES_transform(city_export), nodata=nodata) as dst:
+            dst.write(values)
+            dst.update_tags(TIFFTAG_XRESOLUTION='1', TIFFTAG_YRESOLUTION='1', TIFFTAG_RESOLUTIONUNIT='1 (unitless)')
+        return memfile.read()
+
+
+def write_GOES_tifs(tif_dir, city_export, time_strs, native=False):
+    """
+    Writes a synthetic GOES GeoTIFF for each timestamp.
+
+    Args:
+    tif_dir (str): Directory to write the files to
+    city_export (list): City export coordinates, see GOES_transform
+    time_strs (list): Dates in format of 'YYYYmmddHHMM'
+    native (boolean): Write native integer files and the scale/offset sidecar of each day, see GOES_tif_bytes
+
+    Returns:
+    (list): Paths of the written files, named GOES_image_{time_str}.tif
+    """
+    os.makedirs(tif_dir, exist_ok=True)
+    paths = []
+    for i, time_str in enumerate(time_strs):
+        path = f'{tif_dir}/GOES_image_{time_str}.tif'
+        with open(path, 'wb') as f:
+            f.write(GOES_tif_bytes(city_export, seed=i, native=native))
+        paths.append(path)
+    if native:
+        for date_str in sorted({time_str[:8] for time_str in time_strs}):
+            save_scale_offset(scale_offset_path(tif_dir, date_str), GOES_SCALES, GOES_OFFSETS, source='synthetic')
+    return paths
+
+
+def write_Landsat_tif(path, city_export, seed=0):
+    """
+    Writes a synthetic 13-band Landsat/Sentinel-1 GeoTIFF, with the bands of Landsat_download.ipynb:
+    6 surface reflectances, LST, QA_PIXEL, the VV, VH, HH and HV backscatter and the incidence angle.
+    As in the real files, the HH and HV bands and part of the VV and VH bands are missing and
+    filled with 2 plus noise, and the angle with -999 plus noise. Bands are written one at a time
+    to keep memory low.
+
+    Args:
+    path (str): Location of the file
+    city_export (list): City export coordinates, see GOES_transform
+    seed (int): Random seed of the band values
+    """
+    rng = np.random.default_rng(seed)
+    shape = (LANDSAT_SIZE, LANDSAT_SIZE)
+    missing = np.zeros(shape, dtype=bool)
+    missing[:, rng.integers(0, LANDSAT_SIZE):] = True
+    transform = from_origin(city_export[2], city_export[3], LANDSAT_RESOLUTION, LANDSAT_RESOLUTION)
+    with rasterio.open(path, 'w', driver='GTiff', width=LANDSAT_SIZE, height=LANDSAT_SIZE, count=LANDSAT_BAND_COUNT,
+                       dtype='float64', crs=utm_crs(city_export), transform=transform, tiled=True) as dst:
+        for b in range(1, 7):
+            dst.write(rng.uniform(0, 0.5, shape), b)
+        dst.write(rng.uniform(270, 320, shape), 7)
+        dst.write(rng.choice(np.array(LANDSAT_QA_VALUES, dtype=np.float64), shape), 8)
+        for b in (9, 10):
+            dst.write(np.where(missing, 2 + rng.random(shape), rng.uniform(0, 0.5, shape)), b)
+        for b in (11, 12):
+            dst.write(2 + rng.random(shape), b)
+        dst.write(np.where(missing, -999 + rng.random(shape), rng.uniform(30, 45, shape)), 13)
+        for b, name in enumerate(LANDSAT_EXPORT_BANDS):
+            dst.set_band_description(b + 1, name)
+
+
+def write_MW_files(mw_dir, date_strs, latlon_pts, seed=0):
+    """
+    Writes a synthetic daily microwave LST file for each date. Only the window around
+    the GOES grid has values, which keeps the files quick to write and small.
+
+    Args:
+    mw_dir (str): Directory to write the files to
+    date_strs (list): Dates in format of 'YYYYmmdd'
+    latlon_pts (float array): (n,m,2) Array of (longitude, latitude) points of the GOES grid
+    seed (int): Random seed of the microwave LST values
+
+    Returns:
+    (list): Paths of the written files, named MW_LST_DTC_{date_str}_x1y.h5
+    """
+    os.makedirs(mw_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    bbox = city_bbox(latlon_pts)
+    paths = []
+    for date_str in date_strs:
+        values = np.zeros((MW_STEPS_PER_DAY, len(MW_LONGITUDES), len(MW_LATITUDES)), dtype=np.int16)
+        # Values are stored as K*50
+        values[:, bbox[0]-1:bbox[1]+2, bbox[2]-1:bbox[3]+2] = rng.integers(12000, 16000, (MW_STEPS_PER_DAY, bbox[1]-bbox[0]+3, bbox[3]-bbox[2]+3))
+        path = f'{mw_dir}/MW_LST_DTC_{date_str}_x1y.h5'
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('TB37V_LST_DTC', data=values, chunks=True, compression='gzip')
+        paths.append(path)
+    return paths
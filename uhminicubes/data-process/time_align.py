@@ -0,0 +1,113 @@
+import datetime
+import numpy as np
+
+
+"""
+Alignment of GOES timestamps (UTC) with the 15-minute local solar time steps of the
+microwave LST files. Local solar time is calculated as
+
+    Local Solar Time = UTC time + (Longitude/360)*24
+
+The per-pixel longitude offsets are calculated once per city, after which the time
+step of every pixel for a whole batch of GOES timestamps is found with integer arithmetic.
+"""
+
+US_PER_SECOND = 10**6
+US_PER_DAY = 86400 * US_PER_SECOND
+MW_STEPS_PER_DAY = 96
+
+
+def longitude_offsets(longitudes):
+    """
+    Calculates the local solar time offset of each longitude, rounded to the
+    microsecond the same way datetime.timedelta rounds it.
+
+    Args:
+    longitudes (float array): Longitude values
+
+    Returns:
+    (int array): Offsets from UTC in microseconds, with the same shape as longitudes
+    """
+    offsets = [datetime.timedelta(hours=(lon/360)*24) // datetime.timedelta(microseconds=1) for lon in np.ravel(longitudes)]
+    return np.array(offsets, dtype=np.int64).reshape(np.shape(longitudes))
+
+
+def to_utc_seconds(times):
+    """
+    Converts GOES time strings to integer UTC seconds.
+
+    Args:
+    times (str or list of str): Datetimes in format YYYY-MM-DDThh:mm:ssZ
+
+    Returns:
+    (int array): Seconds since 1970-01-01
+    """
+    times = np.atleast_1d(times)
+    return np.array([t.rstrip('Z') for t in times], dtype='datetime64[s]').astype(np.int64)
+
+
+def day_to_date_str(day):
+    """
+    Args:
+    day (int): Days since 1970-01-01
+
+    Returns:
+    (str): Date in format of 'YYYYmmdd', as used in the microwave LST file names
+    """
+    return str(np.datetime64(int(day), 'D')).replace('-', '')
+
+
+class TimeAligner:
+    """
+    Finds the microwave LST time step of every pixel of a grid for batches of GOES timestamps.
+    """
+    def __init__(self, longitudes):
+        """
+        Args:
+        longitudes (float array): (n,m) Array of the longitude of each grid point
+        """
+        self.offsets = longitude_offsets(longitudes)
+
+    def align(self, utc_seconds):
+        """
+        Adjusts UTC times to the local solar time of each pixel and calculates which
+        15-minute microwave LST time step each pixel is closest to.
+
+        Time steps are counted from the start of the local day of the westernmost pixel
+        (the base day). Steps 0-95 belong to the base day, and steps of 96 and above
+        belong to the following day, either because the grid spans local midnight or
+        because the time rounds up to midnight.
+
+        Args:
+        utc_seconds (int array): (t,) Array of UTC times in seconds since 1970-01-01
+
+        Returns:
+        base_days (int array): (t,) Array of base days as days since 1970-01-01
+        slots (int array): (t,n,m) Array of time steps counted from the start of the base day
+        """
+        utc_us = np.asarray(utc_seconds, dtype=np.int64).reshape(-1, 1, 1) * US_PER_SECOND
+        local_us = utc_us + self.offsets
+        days = local_us // US_PER_DAY
+        day_us = local_us - days*US_PER_DAY
+
+        # Time index 0-96 of the 15-minute timestamp the adjusted time is closest to.
+        # Seconds are truncated and ties rounded to even, the same as round(minute/15 + second/900)
+        hour = day_us // (3600*US_PER_SECOND)
+        minute = day_us // (60*US_PER_SECOND) % 60
+        second = day_us // US_PER_SECOND % 60
+        time_indices = hour*4 + np.rint(minute/15 + second/900).astype(np.int64)
+
+        base_days = days.min(axis=(1, 2))
+        slots = (days - base_days[:, None, None])*MW_STEPS_PER_DAY + time_indices
+        return base_days, slots
+
+    @staticmethod
+    def rollover_mask(slots):
+        """
+        Args:
+        slots (int array): Time steps from align
+
+        Returns:
+        (boolean array): True where a time step falls on the day after the base day
+        """
+        return slots >= MW_STEPS_PER_DAY
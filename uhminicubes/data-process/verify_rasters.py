@@ -0,0 +1,221 @@
+import os
+import sys
+import argparse
+import datetime
+from collections import Counter
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.windows import Window
+from grid_transform import utm_crs
+from goes_calibration import GOES_FILL_VALUE
+from goes_scheduler import run_pool, write_retry_list
+from pipeline_ledger import PipelineLedger
+from process_GOES import proj_zone, SCRATCH_DIR
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data-download'))
+from tif_check import check_tif
+
+
+"""
+Bulk integrity check of a city's downloaded GeoTIFFs. Each file is checked in a
+worker pool with as little reading as possible:
+- the TIFF header is parsed (a few kB) to find truncated files,
+- the band count, size and CRS are compared with the expected layout,
+- a few small windows are read to find files that are empty or almost all nodata.
+
+Files that fail are written to a csv in the same format as the retry lists of
+process_GOES.py. GOES files are also recorded in the pipeline ledger under the
+'validate' stage, and with --requeue their download is marked as failed so the
+next GOES_download.py run downloads them again.
+
+Example:
+    python verify_rasters.py --city=DMV --modality=GOES --cpus=32
+"""
+
+# Expected layout of the files of each modality. Sizes are a range since Earth Engine
+# may round the export region to one more or one less pixel
+RASTER_SPECS = {
+    'GOES': {'bands': 4, 'min_size': 44, 'max_size': 46, 'fill_values': (GOES_FILL_VALUE,),
+             'dir': SCRATCH_DIR + '/{city}_GOES', 'prefix': 'GOES_image_'},
+    'Landsat': {'bands': 13, 'min_size': 3000, 'max_size': 3002, 'fill_values': (),
+                'dir': SCRATCH_DIR + '/{city}/Landsat', 'prefix': 'Landsat'},
+}
+
+# Expected layout of this worker's files, set by init_verify_worker
+worker_spec = None
+
+
+def init_verify_worker(spec, crs, max_nodata, window_size):
+    """
+    Sets up the expected layout of the files checked by a pool worker.
+
+    Args:
+    spec (dict): Expected layout from RASTER_SPECS
+    crs (str): EPSG code of the city's UTM zone
+    max_nodata (float): Largest share of nodata pixels in the sampled windows
+    window_size (int): Width of the sampled windows in pixels
+    """
+    global worker_spec
+    worker_spec = dict(spec, crs=CRS.from_string(crs), max_nodata=max_nodata, window_size=window_size)
+
+
+def sample_windows(width, height, window_size):
+    """
+    Places small windows at the center of the image and of each quarter of it.
+
+    Args:
+    width (int): Width of the image in pixels
+    height (int): Height of the image in pixels
+    window_size (int): Width of the windows in pixels
+
+    Returns:
+    (list): rasterio Windows inside the image
+    """
+    size = min(window_size, width, height)
+    centers = [(0.5, 0.5), (0.25, 0.25), (0.25, 0.75), (0.75, 0.25), (0.75, 0.75)]
+    return [Window(int(cx*width - size/2), int(cy*height - size/2), size, size) for cx, cy in centers]
+
+
+def verify_raster(path):
+    """
+    Pool task that checks one GeoTIFF against the worker's expected layout, raising
+    a ValueError that names the problem if it does not match.
+
+    Args:
+    path (str): Location of the file
+
+    Returns:
+    size (int): Size of the file in bytes
+    nodata_fraction (float): Share of nodata pixels in the sampled windows
+    """
+    spec = worker_spec
+    try:
+        layout = check_tif(path)
+    except ValueError as e:
+        raise ValueError(f'header: {e}')
+    if layout['bands'] != spec['bands']:
+        raise ValueError(f"bands: {layout['bands']} bands instead of {spec['bands']}")
+    for dim in ('width', 'height'):
+        if not spec['min_size'] <= layout[dim] <= spec['max_size']:
+            raise ValueError(f"size: {dim} of {layout[dim]} pixels outside {spec['min_size']}-{spec['max_size']}")
+
+    with rasterio.open(path) as src:
+        if src.crs != spec['crs']:
+            raise ValueError(f"crs: {src.crs} instead of {spec['crs']}")
+        fill_values = list(spec['fill_values']) if np.issubdtype(np.dtype(src.dtypes[0]), np.integer) else []
+        if src.nodata is not None and not np.isnan(src.nodata):
+            fill_values.append(src.nodata)
+        n_nodata = n_pixels = 0
+        for window in sample_windows(src.width, src.height, spec['window_size']):
+            values = src.read(window=window)
+            nodata = np.isin(values, fill_values)
+            if np.issubdtype(values.dtype, np.floating):
+                nodata |= np.isnan(values)
+            n_nodata += int(nodata.sum())
+            n_pixels += values.size
+
+    nodata_fraction = n_nodata/n_pixels
+    if nodata_fraction > spec['max_nodata']:
+        raise ValueError(f'nodata: {nodata_fraction:.1%} of the sampled pixels are nodata')
+    return layout['size'], nodata_fraction
+
+
+def problem_kind(error):
+    """
+    Args:
+    error (str): Error message of a failed file from run_pool, e.g. 'ValueError: crs: ...'
+
+    Returns:
+    (str): Kind of problem: header, bands, size, crs or nodata, or the class of an unexpected error
+    """
+    if error.startswith('ValueError: '):
+        return error.split(': ')[1]
+    return error.split(':')[0]
+
+
+def list_rasters(tif_dir, prefix):
+    """
+    Lists the GeoTIFFs of a directory with one scan of it.
+
+    Args:
+    tif_dir (str): Directory of the files
+    prefix (str): Start of the file names
+
+    Returns:
+    (dict): {time string 'YYYYmmddHHMM': path} of every file, from the end of the file name
+    """
+    with os.scandir(tif_dir) as entries:
+        paths = {entry.name.split('_')[-1][:-len('.tif')]: entry.path for entry in entries
+                 if entry.name.startswith(prefix) and entry.name.endswith('.tif')}
+    return dict(sorted(paths.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    prog='verify_rasters',
+                    description='Checks that the downloaded GOES or Landsat GeoTIFFs of a city are complete and readable')
+    parser.add_argument('--city', help='String of city from list of valid cities to check data for')
+    parser.add_argument('--modality', nargs='?', default='GOES', choices=list(RASTER_SPECS), help='Files to check')
+    parser.add_argument('--dir', nargs='?', default=None, help='Directory of the files (the usual scratch directory by default)')
+    parser.add_argument('--cpus', nargs='?', const=32, default=32, help='Number of CPU cores to run in parallel')
+    parser.add_argument('--max_nodata', nargs='?', type=float, default=0.999,
+                        help='Largest share of nodata pixels in the sampled windows before a file counts as empty')
+    parser.add_argument('--window_size', nargs='?', type=int, default=16, help='Width in pixels of the windows read from each file')
+    parser.add_argument('--report', nargs='?', default=None,
+                        help='csv file listing the files that failed (verify_{city}_{modality}.csv in the file directory by default)')
+    parser.add_argument('--ledger', nargs='?', default=f'{SCRATCH_DIR}/pipeline_ledger.db',
+                        help='SQLite ledger of the state of every frame, GOES files only')
+    parser.add_argument('--requeue', action='store_true',
+                        help='Mark the downloads of the GOES files that failed as failed in the ledger, so GOES_download.py redoes them')
+    parser.add_argument('--report_every', nargs='?', type=float, default=60, help='Seconds between progress messages')
+    args = parser.parse_args()
+
+    city = args.city
+    spec = RASTER_SPECS[args.modality]
+    tif_dir = args.dir if args.dir else spec['dir'].format(city=city)
+    report_path = args.report if args.report else f'{tif_dir}/verify_{city}_{args.modality}.csv'
+    paths = list_rasters(tif_dir, spec['prefix'])
+    print(f'Checking {len(paths)} files in {tif_dir}')
+
+    # GOES files are keyed in the ledger by their frame time in UTC seconds, found from the
+    # recorded downloads since file names leave out the seconds
+    ledger = None
+    frame_times = {}
+    if args.modality == 'GOES':
+        ledger = PipelineLedger(args.ledger)
+        for t in ledger.times(city, 'download') | ledger.times(city, 'download', state='failed'):
+            frame_times[datetime.datetime.fromtimestamp(t, datetime.UTC).strftime('%Y%m%d%H%M')] = t
+        for time_str in paths:
+            if time_str not in frame_times:
+                frame_times[time_str] = int(datetime.datetime.strptime(time_str, '%Y%m%d%H%M').replace(tzinfo=datetime.UTC).timestamp())
+
+    nodata_fractions = []
+    def on_result(key, result, seconds):
+        size, nodata_fraction = result
+        nodata_fractions.append(nodata_fraction)
+        if ledger is not None:
+            ledger.record(city, 'validate', frame_times[key[1]], size=size, seconds=seconds)
+
+    start = datetime.datetime.now()
+    tasks = [((path, time_str), (path,)) for time_str, path in paths.items()]
+    try:
+        failures = run_pool(verify_raster, tasks, int(args.cpus), initializer=init_verify_worker,
+                            initargs=(spec, utm_crs(proj_zone[city]), args.max_nodata, args.window_size),
+                            report_every=args.report_every, on_result=on_result)
+        if ledger is not None:
+            for (path, time_str), error in failures:
+                ledger.record(city, 'validate', frame_times[time_str], state='failed', error=error)
+                if args.requeue:
+                    ledger.record(city, 'download', frame_times[time_str], state='failed', error=f'Verification: {error}')
+    finally:
+        if ledger is not None:
+            ledger.close()
+
+    write_retry_list(report_path, failures)
+    problems = Counter(problem_kind(error) for _, error in failures)
+    print(f'{len(paths) - len(failures)}/{len(paths)} files passed, {len(failures)} failed: {dict(problems)}')
+    if nodata_fractions:
+        print(f'Sampled nodata share of the passed files: mean {np.mean(nodata_fractions):.1%}, max {np.max(nodata_fractions):.1%}')
+    print(f'Report of the failed files: {report_path}')
+    time_diff = datetime.datetime.now() - start
+    print(f'Total time: {time_diff.total_seconds()} seconds')
@@ -0,0 +1,66 @@
+import os
+import sys
+import numpy as np
+
+UHMINICUBES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(UHMINICUBES_DIR, 'data-process'))
+
+from landsat_qa import (QA_FLAGS, QA_CONFIDENCES, to_qa_mask, qa_flag, qa_confidence, decode_qa, pack_qa_planes,
+                        unpack_qa_planes)
+
+
+"""
+Checks the decoding of the Landsat QA_PIXEL band against known values of clear
+land, water, cloud, cloud shadow and snow pixels.
+
+Example:
+    python -m pytest uhminicubes/tests/test_landsat_qa.py
+"""
+
+# (flags set, cloud, cloud shadow, snow/ice and cirrus confidence) of each QA_PIXEL value
+QA_EXPECTED = {21824: ({'clear'}, 1, 1, 1, 1),
+               21952: ({'clear', 'water'}, 1, 1, 1, 1),
+               22280: ({'cloud'}, 3, 1, 1, 1),
+               23888: ({'clear', 'cloud_shadow'}, 1, 3, 1, 1),
+               30048: ({'clear', 'snow'}, 1, 1, 3, 1)}
+
+
+def test_known_values():
+    qa = np.array(list(QA_EXPECTED), dtype=np.float64)
+    mask = to_qa_mask(qa)
+    assert mask.dtype == np.uint16
+    for i, (flags, *confidences) in enumerate(QA_EXPECTED.values()):
+        for name in QA_FLAGS:
+            assert qa_flag(mask, name)[i] == (name in flags)
+        assert [qa_confidence(mask, name)[i] for name in QA_CONFIDENCES] == confidences
+
+
+def test_to_qa_mask_inputs():
+    # NaN pixels without data become fill pixels
+    assert to_qa_mask(np.array([21824, np.nan])).tolist() == [21824, 1]
+    assert to_qa_mask(np.array([21824, 22280], dtype=np.int64)).tolist() == [21824, 22280]
+    # Binary strings of older processed files, as written by geotiff_processing.ipynb
+    strings = np.array([format(21952, '016b'), 'nan'], dtype=object)
+    assert to_qa_mask(strings).tolist() == [21952, 1]
+
+
+def test_decode_matches_binary_strings():
+    mask = to_qa_mask(np.array(list(QA_EXPECTED)))
+    decoded = decode_qa(mask)
+    for i, value in enumerate(QA_EXPECTED):
+        # Bit b of the mask is character 15 - b of its binary string
+        bits = format(value, '016b')
+        for name, bit in QA_FLAGS.items():
+            assert decoded[name][i] == (bits[15 - bit] == '1')
+        for name, bit in QA_CONFIDENCES.items():
+            assert decoded[name][i] == int(bits[14 - bit:16 - bit], 2)
+
+
+def test_pack_qa_planes():
+    rng = np.random.default_rng(0)
+    mask = to_qa_mask(rng.choice(np.array(list(QA_EXPECTED)), (7, 9)))
+    flags = ('cloud', 'cloud_shadow', 'snow', 'water')
+    planes = unpack_qa_planes(pack_qa_planes(mask, flags), mask.shape)
+    assert planes.shape == (4, 7, 9)
+    for plane, name in zip(planes, flags):
+        np.testing.assert_array_equal(plane, qa_flag(mask, name))
@@ -0,0 +1,71 @@
+import os
+import sys
+import importlib
+import numpy as np
+import pytest
+import xarray as xr
+
+UHMINICUBES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(UHMINICUBES_DIR, 'data-download'))
+sys.path.append(os.path.join(UHMINICUBES_DIR, 'data-process'))
+
+from synthetic_fixtures import GOES_grid_latlons, write_GOES_tifs, write_MW_files
+
+
+"""
+Checks that the download and processing scripts can be imported and run offline,
+without Earth Engine installed or any credentials, on the synthetic fixtures.
+
+Example:
+    python -m pytest uhminicubes/tests
+"""
+
+DMV_EXPORT = [18, True, 292000, 4372200]
+
+
+def import_without_ee(monkeypatch, name):
+    """
+    Imports a module afresh while any import of ee fails, as on a machine without Earth Engine.
+
+    Args:
+    monkeypatch (pytest.MonkeyPatch): Fixture that restores sys.modules after the test
+    name (str): Module name
+
+    Returns:
+    (module): The imported module
+    """
+    monkeypatch.setitem(sys.modules, 'ee', None)
+    monkeypatch.delitem(sys.modules, name, raising=False)
+    return importlib.import_module(name)
+
+
+def test_import_without_ee(monkeypatch):
+    GOES_download = import_without_ee(monkeypatch, 'GOES_download')
+    import_without_ee(monkeypatch, 'process_GOES')
+    assert GOES_download.ee is None
+
+
+@pytest.mark.parametrize('native', [False, True])
+@pytest.mark.parametrize('encoding', ['float64', 'float32', 'int16'])
+def test_process_GOES_frame(monkeypatch, tmp_path, encoding, native):
+    process_GOES = import_without_ee(monkeypatch, 'process_GOES')
+    latlon_pts = GOES_grid_latlons(DMV_EXPORT)
+    write_MW_files(f'{tmp_path}/mw', ['20220614', '20220615', '20220616'], latlon_pts)
+    tifs = write_GOES_tifs(f'{tmp_path}/tifs', DMV_EXPORT, ['202206151200', '202206151210'], native=native)
+    times = ['2022-06-15T12:00:00Z', '2022-06-15T12:10:00Z']
+    process_GOES.init_GOES_worker('DMV', latlon_pts, f'{tmp_path}/mw', 8, encoding=encoding)
+
+    # The first frame is written with xarray and the second through the template writer
+    for i in range(2):
+        size, _ = process_GOES.process_GOES_frame(tifs[i], times[i], f'{tmp_path}/frame_{i}.nc')
+        assert size == os.path.getsize(f'{tmp_path}/frame_{i}.nc')
+        process_GOES.process_GOES_tif(tifs[i], times[i], latlon_pts, f'{tmp_path}/xarray_{i}.nc', encoding=encoding)
+    # Compressed chunks are written once, so the template copy is no larger than the xarray file
+    assert os.path.getsize(f'{tmp_path}/frame_1.nc') <= 1.01*os.path.getsize(f'{tmp_path}/xarray_1.nc')
+
+    for i in range(2):
+        with xr.open_dataset(f'{tmp_path}/frame_{i}.nc') as ds, xr.open_dataset(f'{tmp_path}/xarray_{i}.nc') as expected:
+            assert ds.sizes['x'] == ds.sizes['y'] == 45
+            assert np.all(np.diff(ds['y'].values) > 0)
+            assert not np.all(np.isnan(ds['microwave_LST'].values))
+            xr.testing.assert_identical(ds, expected)
@@ -0,0 +1,59 @@
+import os
+import sys
+import pytest
+
+UHMINICUBES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(UHMINICUBES_DIR, 'data-process'))
+
+from pipeline_ledger import PipelineLedger
+
+
+"""
+Checks that the pipeline ledger keeps the state of every frame across flushes and reopens.
+
+Example:
+    python -m pytest uhminicubes/tests/test_pipeline_ledger.py
+"""
+
+
+def test_record_flush_times(tmp_path):
+    path = f'{tmp_path}/ledger/DMV.sqlite'
+    ledger = PipelineLedger(path, batch_size=2)
+    ledger.record('DMV', 'download', 1655294400, size=100, seconds=1.5)
+    # Records are buffered until the batch is full
+    assert ledger.times('DMV', 'download') == set()
+    ledger.record('DMV', 'download', 1655295000, state='failed', error='Timeout')
+    assert ledger.times('DMV', 'download') == {1655294400}
+    assert ledger.times('DMV', 'download', state='failed') == {1655295000}
+
+    # A frame that is redone replaces its failed record
+    ledger.record('DMV', 'download', 1655295000, size=120, seconds=2.5)
+    ledger.record('NYC', 'process', 1655294400, size=50)
+    ledger.close()
+
+    ledger = PipelineLedger(path)
+    assert ledger.times('DMV', 'download') == {1655294400, 1655295000}
+    assert ledger.times('DMV', 'download', state='failed') == set()
+    assert ledger.times('DMV', 'process') == set()
+    assert ledger.times('NYC', 'process') == {1655294400}
+    assert ledger.has_stage('DMV', 'download') and not ledger.has_stage('DMV', 'process')
+    assert ledger.summary('DMV') == {('download', 'done'): (2, 220, 2.0)}
+    with pytest.raises(ValueError):
+        ledger.record('DMV', 'upload', 1655294400)
+    ledger.close()
+
+
+def test_bootstrap(tmp_path):
+    os.makedirs(f'{tmp_path}/tifs')
+    for name in ['GOES_image_202206151200.tif', 'GOES_image_202206151210.tif']:
+        with open(f'{tmp_path}/tifs/{name}', 'wb') as f:
+            f.write(b'tif')
+    paths = {1655294400: f'{tmp_path}/tifs/GOES_image_202206151200.tif',
+             1655295000: f'{tmp_path}/tifs/GOES_image_202206151210.tif',
+             1655295600: f'{tmp_path}/tifs/GOES_image_202206151220.tif'}
+
+    ledger = PipelineLedger(f'{tmp_path}/ledger.sqlite')
+    # Files that fail the check are left to be redone
+    assert ledger.bootstrap('DMV', 'download', paths, check=lambda path: '1210' not in path) == 1
+    assert ledger.times('DMV', 'download') == {1655294400}
+    ledger.close()
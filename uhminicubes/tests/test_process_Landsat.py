@@ -0,0 +1,86 @@
+import os
+import sys
+import numpy as np
+import pytest
+import xarray as xr
+
+UHMINICUBES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(UHMINICUBES_DIR, 'data-process'))
+
+import synthetic_fixtures
+import process_Landsat
+from landsat_loader import LandsatReader, coarsen_Landsat
+
+
+"""
+Checks that a Landsat/Sentinel-1 scene processed a block of rows at a time, in either
+layout, has the values of the masking in geotiff_processing.ipynb, and that windows and
+overviews read back with landsat_loader.py match them.
+
+The synthetic scene is 600x600 pixels instead of 3000x3000 to keep the test fast.
+
+Example:
+    python -m pytest uhminicubes/tests/test_process_Landsat.py
+"""
+
+DMV_EXPORT = [18, True, 292000, 4372200]
+TEST_SIZE = 600
+
+
+def notebook_Landsat(tif):
+    """
+    Masks a scene as the Landsat cells of geotiff_processing.ipynb do, with the cloud mask
+    as integers instead of binary strings.
+
+    Args:
+    tif (str): Path where tif file is located
+
+    Returns:
+    x (float array): UTM eastings of the export grid
+    y (float array): UTM northings of the export grid, increasing with index
+    values (dict): (y,x) Masked values of each band
+    """
+    import rioxarray as rxr
+    with rxr.open_rasterio(tif) as dsLS:
+        dsLS = dsLS[:, :TEST_SIZE, :TEST_SIZE].load()
+    dsLS = dsLS.reindex(y=dsLS.y[::-1])
+    values = {var: dsLS.values[b] for b, var in enumerate(process_Landsat.LANDSAT_BANDS)}
+    for var in ['Sentinel1_VV', 'Sentinel1_VH', 'Sentinel1_HH', 'Sentinel1_HV']:
+        values[var] = np.where(values[var] > 1, np.nan, values[var])
+    values['Sentinel1_incidence_angle'] = np.where(values['Sentinel1_incidence_angle'] < 0, np.nan,
+                                                   values['Sentinel1_incidence_angle'])
+    values['Landsat_cloud_mask'] = values['Landsat_cloud_mask'].astype(np.uint16)
+    return dsLS['x'].values, dsLS['y'].values, values
+
+
+@pytest.mark.parametrize('tiled', [False, True])
+def test_process_Landsat_scene(monkeypatch, tmp_path, tiled):
+    # Exports are a pixel larger than the grid they are cropped to
+    monkeypatch.setattr(synthetic_fixtures, 'LANDSAT_SIZE', TEST_SIZE + 1)
+    monkeypatch.setattr(process_Landsat, 'LANDSAT_SIZE', TEST_SIZE)
+    tif = f'{tmp_path}/Landsat8_DMV_202206151546.tif'
+    synthetic_fixtures.write_Landsat_tif(tif, DMV_EXPORT)
+    x, y, expected = notebook_Landsat(tif)
+
+    # Blocks of rows that do not divide the grid, so the last block is partial
+    process_Landsat.init_Landsat_worker(128, 16, tiled=tiled, overviews=[2, 4] if tiled else None)
+    fname = f'{tmp_path}/Landsat8_DMV_202206151546.nc'
+    size, _ = process_Landsat.process_Landsat_scene(tif, '2022-06-15T15:46:00Z', fname, 'DMV')
+    assert size == os.path.getsize(fname)
+
+    with xr.open_dataset(fname, engine='h5netcdf') as ds:
+        np.testing.assert_array_equal(ds['x'].values, x)
+        np.testing.assert_array_equal(ds['y'].values, y)
+        assert str(ds['datetime'].values) == '2022-06-15T15:46:00Z'
+        for var in process_Landsat.LANDSAT_BANDS:
+            np.testing.assert_array_equal(ds[var].values, expected[var], err_msg=var)
+
+    with LandsatReader(fname) as reader:
+        assert reader.overview_factors == ([2, 4] if tiled else [])
+        window = reader.read(['Landsat_LST', 'Sentinel1_VV'], window=(250, 100, 64, 32))
+        np.testing.assert_array_equal(window['Sentinel1_VV'].values, expected['Sentinel1_VV'][250:314, 100:132])
+        assert 'spatial_ref' in window
+        # Stored overviews of tiled files, and overviews made on the fly from contiguous files
+        overview = reader.read(overview=4)
+        for var in ['Landsat_LST', 'Sentinel1_VH', 'Landsat_cloud_mask']:
+            np.testing.assert_allclose(overview[var].values, coarsen_Landsat(var, expected[var], 4), err_msg=var)
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import pytest
+import requests
+
+UHMINICUBES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(UHMINICUBES_DIR, 'data-download'))
+
+from request_controller import RequestController, RetryPolicy, is_throttle_error
+
+
+"""
+Checks the additive increase / multiplicative decrease of the request controller's
+concurrency limit, its token bucket and the retry policy.
+
+Example:
+    python -m pytest uhminicubes/tests/test_request_controller.py
+"""
+
+
+def http_error(status):
+    """
+    Args:
+    status (int): HTTP status code
+
+    Returns:
+    (requests.HTTPError): Error raised for a response with the status
+    """
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f'{status} error', response=response)
+
+
+def test_is_throttle_error():
+    assert is_throttle_error(http_error(429)) and is_throttle_error(http_error(503))
+    assert not is_throttle_error(http_error(404))
+    assert is_throttle_error(requests.ConnectionError('Connection reset'))
+    assert is_throttle_error(Exception('Too many concurrent aggregations'))
+    assert not is_throttle_error(ValueError('Invalid region'))
+
+
+def test_aimd():
+    controller = RequestController(max_in_flight=8, initial_in_flight=2, cooldown=0)
+    # Each success adds 1/limit, so a round of limit successes adds about one
+    for _ in range(2):
+        controller.release(controller.acquire())
+    assert controller.limit == pytest.approx(2 + 1/2 + 1/2.5)
+
+    # Throttling halves the limit, other errors leave it as it is
+    limit = controller.limit
+    controller.release(controller.acquire(), http_error(429))
+    assert controller.limit == pytest.approx(limit/2)
+    controller.release(controller.acquire(), ValueError('Invalid region'))
+    assert controller.limit == pytest.approx(limit/2)
+    assert (controller.errors, controller.throttled) == (2, 1)
+
+    # The limit stays between min_in_flight and max_in_flight
+    for _ in range(5):
+        controller.release(controller.acquire(), http_error(503))
+    assert controller.limit == 1
+    for _ in range(200):
+        controller.release(controller.acquire())
+    assert controller.limit == 8
+
+
+def test_cooldown():
+    controller = RequestController(max_in_flight=8, initial_in_flight=8, cooldown=60)
+    # A burst of failures from the same overload is only one cut
+    for _ in range(3):
+        controller.release(controller.acquire(), http_error(429))
+    assert controller.limit == 4
+
+
+def test_token_bucket():
+    controller = RequestController(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        controller.call(lambda: None)
+    # The first request uses the burst and the other five wait 1/50 s each
+    assert time.monotonic() - start >= 5/50 - 0.01
+    assert controller.requests == 6 and controller.in_flight == 0
+
+
+def test_retry_policy():
+    def fail_twice(status, calls):
+        calls.append(status)
+        if len(calls) < 3:
+            raise http_error(status)
+        return 'done'
+
+    calls = []
+    controller = RequestController()
+    policy = RetryPolicy(tries=5, delay=0.01, controller=controller)
+    assert policy.call(fail_twice, (503, calls)) == 'done'
+    assert len(calls) == 3 and controller.retries == 2
+
+    # Errors that give_up accepts are raised without retrying
+    calls = []
+    with pytest.raises(requests.HTTPError):
+        policy.call(fail_twice, (404, calls), give_up=lambda e: e.response.status_code == 404)
+    assert len(calls) == 1 and controller.retries == 2
+
+    # The last error is raised once the tries run out
+    calls = []
+    with pytest.raises(requests.HTTPError):
+        RetryPolicy(tries=2, delay=0.01).call(fail_twice, (503, calls))
+    assert len(calls) == 2
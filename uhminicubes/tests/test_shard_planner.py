@@ -0,0 +1,51 @@
+import os
+import sys
+import pytest
+
+UHMINICUBES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(UHMINICUBES_DIR, 'data-process'))
+
+from shard_planner import plan_shards, save_plan, load_plan
+
+
+"""
+Checks that the shard planner splits frames into balanced shards without splitting
+a group, and that a saved plan is only reused with the settings it was made from.
+
+Example:
+    python -m pytest uhminicubes/tests/test_shard_planner.py
+"""
+
+
+def test_plan_shards_balanced():
+    items = list(range(10))
+    shards = plan_shards(items, n_shards=3)
+    assert sum(shards, []) == items
+    assert [len(shard) for shard in shards] == [3, 4, 3]
+    assert [len(shard) for shard in plan_shards(items, shard_size=4)] == [3, 4, 3]
+    assert plan_shards([], n_shards=3) == []
+    with pytest.raises(Exception):
+        plan_shards(items, n_shards=3, shard_size=4)
+
+
+def test_plan_shards_keeps_groups_whole():
+    items = list(range(12))
+    groups = ['2022_1']*5 + ['2022_2']*2 + ['2023_1']*5
+    shards = plan_shards(items, n_shards=4, groups=groups)
+    assert sum(shards, []) == items
+    # Every group is in exactly one shard, even with more shards asked for than fit
+    shard_of_item = {item: k for k, shard in enumerate(shards) for item in shard}
+    for group in set(groups):
+        assert len({shard_of_item[i] for i in items if groups[i] == group}) == 1
+    assert len(shards) == 3
+
+
+def test_plan_inputs(tmp_path):
+    path = f'{tmp_path}/plans/DMV.json'
+    inputs = {'first_time': 1655294400, 'last_time': 1655295000, 'n_times': 2, 'n_shards': 2}
+    assert save_plan(path, [[1655294400], [1655295000]], inputs) == [[1655294400], [1655295000]]
+    # A second process keeps the plan that was saved first
+    assert save_plan(path, [[1655294400, 1655295000]], inputs) == [[1655294400], [1655295000]]
+    assert load_plan(path, inputs) == [[1655294400], [1655295000]]
+    with pytest.raises(ValueError, match='--plan_only'):
+        load_plan(path, dict(inputs, n_shards=4))
@@ -0,0 +1,46 @@
+import os
+import sys
+import pytest
+
+UHMINICUBES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(UHMINICUBES_DIR, 'data-download'))
+sys.path.append(os.path.join(UHMINICUBES_DIR, 'data-process'))
+
+from synthetic_fixtures import GOES_tif_bytes
+from tif_check import check_tif, is_complete_tif
+
+
+"""
+Checks that the header-only GeoTIFF check finds truncated downloads.
+
+Example:
+    python -m pytest uhminicubes/tests/test_tif_check.py
+"""
+
+DMV_EXPORT = [18, True, 292000, 4372200]
+
+
+@pytest.mark.parametrize('native', [False, True])
+def test_complete_tif(tmp_path, native):
+    tif = GOES_tif_bytes(DMV_EXPORT, native=native)
+    layout = check_tif(tif)
+    assert (layout['width'], layout['height'], layout['bands']) == (45, 45, 4)
+    assert layout['size'] == len(tif) and layout['end'] <= len(tif)
+
+    with open(f'{tmp_path}/GOES_image.tif', 'wb') as f:
+        f.write(tif)
+    assert is_complete_tif(f'{tmp_path}/GOES_image.tif')
+
+
+def test_truncated_tif(tmp_path):
+    tif = GOES_tif_bytes(DMV_EXPORT)
+    end = check_tif(tif)['end']
+
+    # Missing the last byte of the image data, and missing the second half of the file
+    with pytest.raises(ValueError, match='truncated'):
+        check_tif(tif[:end - 1])
+    for n in [end - 1, len(tif)//2, 4, 0]:
+        with open(f'{tmp_path}/GOES_image.tif', 'wb') as f:
+            f.write(tif[:n])
+        assert not is_complete_tif(f'{tmp_path}/GOES_image.tif')
+        assert not is_complete_tif(tif[:n])